@@ -0,0 +1,114 @@
+"""
+Benchmark of sendqueue.py against the local SMTP stand-in of fakesmtp.py.
+
+--messages messages are queued in bursts of --burst, and the wall time
+until the queue is empty is measured for
+
+    queue       SmtpSender: one connection and login, reused for the bursts
+    connect     a new connection and login for every message, like a sender
+                without a queue would do
+
+With --outage the server refuses connections while the first half of the
+messages is queued and comes back after that many seconds, when the
+sender is told that the network changed.  --fail-rate refuses messages
+with a temporary error, so they are retried after next_time() with
+--constant:
+
+    python3 bench_send.py --messages 2000 --latency 0.001 --fail-rate 0.05
+"""
+
+import os
+import smtplib
+import tempfile
+import time
+
+import click
+
+from fakesmtp import FakeSmtpServer
+from sendqueue import SendQueue, SmtpSender
+
+
+def gen_message(i):
+    return ("From: alice@example.org\r\nTo: bob@example.org\r\n"
+            "Message-ID: <msg%d@example.org>\r\nSubject: msg%d\r\n\r\n"
+            "Hello i am the body of msg%d\r\n" % (i, i, i)).encode("ascii")
+
+
+def wait_empty(queue, timeout):
+    deadline = time.time() + timeout
+    while len(queue) and time.time() < deadline:
+        time.sleep(0.005)
+    return len(queue)
+
+
+def run_queue(server, path, num_messages, burst, constant, outage, timeout):
+    queue = SendQueue(path, constant=constant)
+    sender = SmtpSender(queue, "127.0.0.1", server.port, "alice@example.org", "secret",
+                        ssl=False)
+    sender.min_connect_delay = constant
+    sender.start()
+    t0 = time.time()
+    if outage:
+        server.down = True
+    for i in range(num_messages):
+        queue.add("alice@example.org", ["bob@example.org"], gen_message(i))
+        if (i + 1) % burst == 0:
+            sender.wakeup()
+        if outage and i + 1 == num_messages // 2:
+            time.sleep(outage)
+            server.down = False
+            sender.network_changed()
+    sender.wakeup()
+    left = wait_empty(queue, timeout)
+    duration = time.time() - t0
+    sender.stop()
+    queue.close()
+    return duration, left, sender.stats
+
+
+def run_connect(server, num_messages):
+    t0 = time.time()
+    for i in range(num_messages):
+        smtp = smtplib.SMTP("127.0.0.1", server.port)
+        smtp.login("alice@example.org", "secret")
+        try:
+            smtp.sendmail("alice@example.org", ["bob@example.org"], gen_message(i))
+        except smtplib.SMTPDataError:
+            pass
+        smtp.quit()
+    return time.time() - t0
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--messages", "num_messages", type=int, default=1000,
+              help="(default 1000) messages to send")
+@click.option("--burst", type=int, default=20, help="(default 20) messages queued at once")
+@click.option("--latency", type=float, default=0.0,
+              help="(default 0) seconds the server waits before answering a command")
+@click.option("--fail-rate", type=float, default=0.0,
+              help="(default 0) fraction of messages refused temporarily")
+@click.option("--constant", type=float, default=0.05,
+              help="(default 0.05) backoff constant of next_time()")
+@click.option("--outage", type=float, default=0.0,
+              help="(default 0) seconds the server is down in the middle")
+@click.option("--timeout", type=float, default=300, help="(default 300) give up after")
+def main(num_messages, burst, latency, fail_rate, constant, outage, timeout):
+    print("%-8s %9s %8s %8s %8s %8s %8s" % (
+          "mode", "seconds", "msgs/s", "conns", "logins", "retried", "unsent"))
+    server = FakeSmtpServer(latency=latency, fail_rate=fail_rate).start()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        duration, left, stats = run_queue(server, os.path.join(tmpdir, "outbox.sqlite"),
+                                          num_messages, burst, constant, outage, timeout)
+    print("%-8s %9.2f %8.0f %8d %8d %8d %8d" % (
+          "queue", duration, (num_messages - left) / duration, server.stats["connections"],
+          server.stats["logins"], stats["retried"], left))
+    server.stats.clear()
+    duration = run_connect(server, num_messages)
+    print("%-8s %9.2f %8.0f %8d %8d %8s %8d" % (
+          "connect", duration, num_messages / duration, server.stats["connections"],
+          server.stats["logins"], "-", server.stats["refused"]))
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
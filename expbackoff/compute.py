@@ -13,25 +13,27 @@
 
 if smtp thread fails to establish smtp then
 it waits until the minimum next backoff time and  GOTO 1b)
+
+sendqueue.py implements this policy: SendQueue keeps the pending
+messages in SQLite ordered by next_time(), SmtpSender sends them.
 """
 
-import math
 import random
 
 def next_time(start_time, retries, constant):
-    N = random.randint(0, math.pow(2, retries) - 1)
+    N = random.randint(0, 2 ** retries - 1)
     return start_time + (N * constant)
 
 
 
-
-for constant in [5, 15, 60]:
-    print("")
-    print("constant = {}".format(constant))
-    start_time = 0.0
-    for i in range(10):
-        t = next_time(start_time, i, constant)
-        print(int(t))
+if __name__ == "__main__":
+    for constant in [5, 15, 60]:
+        print("")
+        print("constant = {}".format(constant))
+        start_time = 0.0
+        for i in range(10):
+            t = next_time(start_time, i, constant)
+            print(int(t))
 
 
 
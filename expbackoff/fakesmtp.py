@@ -0,0 +1,157 @@
+"""
+A small in-process SMTP server standing in for a mail server when
+benchmarking the send queue.  It speaks just enough ESMTP over plain TCP
+for smtplib: EHLO/HELO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP and
+QUIT, and keeps the accepted messages.  Every command can be delayed by
+a fixed latency to emulate network round-trips, a fraction of the
+messages can be refused with a temporary 451 error, single recipients
+with the code given in rcpt_codes, and while "down" is set new
+connections are closed right away (an outage).  The server
+counts connections, logins and the commands it served.
+
+    server = FakeSmtpServer(latency=0.01)
+    server.start()
+    smtp = smtplib.SMTP("127.0.0.1", server.port)
+"""
+
+import base64
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+
+
+class FakeSmtpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0, seed=0):
+        socketserver.TCPServer.__init__(self, (host, port), SmtpHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.down = False
+        self.lock = threading.RLock()
+        self.messages = []   # (mail_from, rcpt_tos, data)
+        self.rcpt_codes = {}  # recipient -> code RCPT answers instead of 250
+        self.stats = Counter()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def accept(self, mail_from, rcpt_tos, data):
+        """ return whether the message is accepted (or temporarily refused) """
+        with self.lock:
+            if self.fail_rate and self.rng.random() < self.fail_rate:
+                self.stats["refused"] += 1
+                return False
+            self.messages.append((mail_from, rcpt_tos, data))
+            return True
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.mail_from = None
+        self.rcpt_tos = []
+
+    def send(self, line):
+        self.wfile.write(line.encode("utf8") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        if server.down:
+            return
+        server.stats["connections"] += 1
+        self.send("220 fake SMTP server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode("utf8").rstrip("\r\n")
+            cmd, _, args = line.partition(" ")
+            cmd = cmd.upper()
+            server.stats[cmd] += 1
+            if server.latency:
+                time.sleep(server.latency)
+            method = getattr(self, "cmd_" + cmd.lower(), None)
+            if method is None:
+                self.send("500 unknown command %s" % (cmd,))
+                continue
+            if method(args) is False:
+                return
+
+    def cmd_ehlo(self, args):
+        self.send("250-fake.example.org")
+        self.send("250-AUTH PLAIN")
+        self.send("250 8BITMIME")
+
+    def cmd_helo(self, args):
+        self.send("250 fake.example.org")
+
+    def cmd_auth(self, args):
+        mech, _, initial = args.partition(" ")
+        if mech.upper() != "PLAIN":
+            self.send("504 unsupported mechanism")
+            return
+        if not initial:
+            self.send("334 ")
+            initial = self.rfile.readline().decode("ascii").strip()
+        base64.b64decode(initial)
+        self.server.stats["logins"] += 1
+        self.send("235 authenticated")
+
+    def cmd_mail(self, args):
+        self.mail_from = args.partition(":")[2].strip()
+        self.rcpt_tos = []
+        self.send("250 OK")
+
+    def cmd_rcpt(self, args):
+        rcpt_to = args.partition(":")[2].strip()
+        code = self.server.rcpt_codes.get(rcpt_to.strip("<>"))
+        if code is not None:
+            self.send("%d recipient refused" % (code,))
+            return
+        self.rcpt_tos.append(rcpt_to)
+        self.send("250 OK")
+
+    def cmd_data(self, args):
+        if self.mail_from is None or not self.rcpt_tos:
+            self.send("503 need MAIL and RCPT first")
+            return
+        self.send("354 end data with <CR><LF>.<CR><LF>")
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b".\r\n":
+                break
+            lines.append(line[1:] if line.startswith(b".") else line)
+        if self.server.accept(self.mail_from, self.rcpt_tos, b"".join(lines)):
+            self.send("250 OK queued")
+        else:
+            self.send("451 temporary failure, try again later")
+        self.mail_from = None
+        self.rcpt_tos = []
+
+    def cmd_rset(self, args):
+        self.mail_from = None
+        self.rcpt_tos = []
+        self.send("250 OK")
+
+    def cmd_noop(self, args):
+        self.send("250 OK")
+
+    def cmd_quit(self, args):
+        self.send("221 bye")
+        return False
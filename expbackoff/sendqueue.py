@@ -0,0 +1,319 @@
+"""
+Outgoing message queue and SMTP sender following the policy of compute.py.
+
+SendQueue keeps the messages to send in an SQLite table indexed by the
+time of their next attempt, so queued messages survive restarts and the
+due ones are an index range scan.  Every change is committed right away.
+
+SmtpSender is a thread which sends the queued messages over one
+authenticated SMTP connection, kept open for idle_timeout seconds so
+that bursts don't log in for every message.  It sends
+
+- the due messages, when the earliest next attempt time is reached
+  or a message was queued (wakeup()),
+
+- all queued messages in the order of their next attempt times, when
+  the network changed (network_changed()) or after a connection was
+  established, i.e. the EHLO and login succeeded.
+
+A message refused with a 4xx error gets its retry counter increased and
+its next attempt at next_time(now, retries, constant); one refused with
+a 5xx error is given up.  If only some recipients are refused, the
+message is retried for those refused with a 4xx error alone.  A message
+is tried at most once per round of sending, even if its next attempt
+is due right away.  If the connection can't be established or
+breaks, the messages keep their times and the sender tries to connect
+again after a backoff of its own (capped by max_connect_failures), or
+when the network changed.
+"""
+
+import smtplib
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from compute import next_time
+
+
+class QueuedMessage(object):
+    def __init__(self, id, next_time, retries, from_addr, to_addrs, data):
+        self.id = id
+        self.next_time = next_time
+        self.retries = retries
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.data = data
+
+    def __repr__(self):
+        return "<QueuedMessage {} to={} retries={} next={}>".format(
+            self.id, self.to_addrs, self.retries, self.next_time)
+
+
+class SendQueue(object):
+    """ messages waiting to be sent, ordered by their next attempt time """
+
+    def __init__(self, path, constant=15):
+        self.path = path
+        self.constant = constant
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self.conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    next_time REAL NOT NULL,
+                    retries INTEGER NOT NULL,
+                    from_addr TEXT NOT NULL,
+                    to_addrs TEXT NOT NULL,
+                    data BLOB NOT NULL);
+                CREATE INDEX IF NOT EXISTS outbox_next_time ON outbox (next_time, id);
+            """)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            cursor = self.conn.execute(sql, args)
+            self.conn.commit()
+            return cursor
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM outbox")[0][0]
+
+    def add(self, from_addr, to_addrs, data, now=None):
+        """ queue data (bytes or an email.message.Message) for sending now """
+        if not isinstance(data, bytes):
+            data = data.as_bytes()
+        assert isinstance(to_addrs, (list, tuple)) and to_addrs
+        now = time.time() if now is None else now
+        cursor = self._execute(
+            "INSERT INTO outbox (next_time, retries, from_addr, to_addrs, data) "
+            "VALUES (?, 0, ?, ?, ?)", (now, from_addr, "\n".join(to_addrs), data))
+        return cursor.lastrowid
+
+    def pending(self, now=None, limit=-1):
+        """ the messages due at now (all if None) in the order of their next attempt """
+        if now is None:
+            where, args = "", ()
+        else:
+            where, args = "WHERE next_time <= ?", (now,)
+        rows = self._query("SELECT id, next_time, retries, from_addr, to_addrs, data "
+                           "FROM outbox %s ORDER BY next_time, id LIMIT ?" % where,
+                           args + (limit,))
+        return [QueuedMessage(id, t, retries, from_addr, to_addrs.split("\n"), data)
+                for id, t, retries, from_addr, to_addrs, data in rows]
+
+    def next_due(self):
+        """ the earliest next attempt time, None if the queue is empty """
+        return self._query("SELECT MIN(next_time) FROM outbox")[0][0]
+
+    def sent(self, msg):
+        self._execute("DELETE FROM outbox WHERE id=?", (msg.id,))
+
+    def give_up(self, msg):
+        self._execute("DELETE FROM outbox WHERE id=?", (msg.id,))
+
+    def failed(self, msg, now=None, to_addrs=None):
+        """ increase the retry counter of msg and return its next attempt
+        time.  The retries go to to_addrs if given. """
+        now = time.time() if now is None else now
+        msg.retries += 1
+        msg.next_time = next_time(now, msg.retries, self.constant)
+        if to_addrs is not None:
+            msg.to_addrs = list(to_addrs)
+        self._execute("UPDATE outbox SET retries=?, next_time=?, to_addrs=? WHERE id=?",
+                      (msg.retries, msg.next_time, "\n".join(msg.to_addrs), msg.id))
+        return msg.next_time
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class SmtpSender(object):
+    # close the connection after it was unused for this many seconds
+    idle_timeout = 60.0
+    # don't try to connect more often than this after a failure
+    min_connect_delay = 1.0
+    # count at most this many failed connects for the backoff, so that it
+    # stays below 2 ** max_connect_failures times the queue's constant
+    max_connect_failures = 6
+
+    def __init__(self, queue, host, port=465, user=None, password=None, ssl=True,
+                 timeout=30.0):
+        self.queue = queue
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.ssl = ssl
+        self.timeout = timeout
+        self.stats = Counter()
+        self.smtp = None
+        self._last_used = 0.0
+        self._connect_failures = 0
+        self._connect_at = 0.0      # no connection attempt before
+        self._send_all = False
+        self._woken = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="smtp-sender", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._close()
+
+    def wakeup(self):
+        """ a message was queued """
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def network_changed(self):
+        """ the network changed: connect right away and try all messages """
+        with self._cond:
+            self._send_all = True
+            self._connect_at = 0.0
+            self._cond.notify()
+
+    def _timeout(self, now):
+        """ seconds until the sender has something to do, None for no limit """
+        times = []
+        next_due = self.queue.next_due()
+        if next_due is not None:
+            times.append(max(next_due, self._connect_at))
+        if self.smtp is not None:
+            times.append(self._last_used + self.idle_timeout)
+        return max(0.0, min(times) - now) if times else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._stopped or self._send_all or self._woken):
+                    timeout = self._timeout(time.time())
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                send_all, self._send_all, self._woken = self._send_all, False, False
+            now = time.time()
+            if now >= self._connect_at:
+                self.send_pending(send_all)
+            if self.smtp is not None and time.time() - self._last_used >= self.idle_timeout:
+                self._close()
+
+    def _connect(self):
+        cls = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        try:
+            smtp = cls(self.host, self.port, timeout=self.timeout)
+            smtp.ehlo()
+            if self.user is not None:
+                smtp.login(self.user, self.password)
+        except (OSError, smtplib.SMTPException):
+            self._connect_failures = min(self._connect_failures + 1, self.max_connect_failures)
+            self.stats["connect_failures"] += 1
+            self._connect_at = max(next_time(time.time(), self._connect_failures,
+                                             self.queue.constant),
+                                   time.time() + self.min_connect_delay)
+            return False
+        self.smtp = smtp
+        self._last_used = time.time()
+        self._connect_failures = 0
+        self._connect_at = 0.0
+        self.stats["connects"] += 1
+        return True
+
+    def _close(self):
+        smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (OSError, smtplib.SMTPException):
+                smtp.close()
+
+    def send_pending(self, send_all=False):
+        """ send the due messages (all if send_all) over one connection """
+        # a connection which was idle may have been closed by the server
+        may_reconnect = self.smtp is not None
+        if self.smtp is None:
+            if self.queue.next_due() is None:
+                return
+            if not self._connect():
+                return
+            # a successful EHLO is a reason to try everything
+            send_all = True
+        # the messages which got an answer, a retry drawn for right
+        # away waits for the next round
+        tried = set()
+        while True:
+            msgs = [msg for msg in self.queue.pending(None if send_all else time.time())
+                    if msg.id not in tried]
+            if not msgs:
+                return
+            for msg in msgs:
+                if self._send(msg) is None:
+                    self._close()
+                    self.stats["disconnects"] += 1
+                    if may_reconnect and self._connect():
+                        may_reconnect = False
+                        send_all = True
+                        break
+                    return
+                tried.add(msg.id)
+            else:
+                if send_all:
+                    return
+
+    def _send(self, msg):
+        """ send msg, return False if it was refused, None if the connection broke """
+        try:
+            refused = self.smtp.sendmail(msg.from_addr, msg.to_addrs, msg.data)
+        except smtplib.SMTPServerDisconnected:
+            return None
+        except smtplib.SMTPRecipientsRefused as e:
+            return self._refused(msg, e.recipients)
+        except smtplib.SMTPResponseException as e:
+            return self._refused(msg, dict.fromkeys(msg.to_addrs, (e.smtp_code, e.smtp_error)))
+        except (OSError, smtplib.SMTPException):
+            return None
+        finally:
+            self._last_used = time.time()
+        self.stats["sent"] += 1
+        if refused:
+            self.stats["partially_refused"] += 1
+            if self._retry(msg, refused):
+                return True
+        self.queue.sent(msg)
+        return True
+
+    def _refused(self, msg, refused):
+        if not self._retry(msg, refused):
+            self.queue.give_up(msg)
+            self.stats["given_up"] += 1
+        return False
+
+    def _retry(self, msg, refused):
+        """ queue msg again for the recipients refused with a 4xx code and
+        return whether there are any.  refused maps recipients to
+        (code, text) like smtplib reports them, the others are done. """
+        to_addrs = [addr for addr in msg.to_addrs if addr in refused and refused[addr][0] < 500]
+        if not to_addrs:
+            return False
+        self.queue.failed(msg, to_addrs=to_addrs)
+        self.stats["retried"] += 1
+        return True
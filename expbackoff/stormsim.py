@@ -0,0 +1,207 @@
+"""
+Simulation of the retries of a large number of queued messages after an
+outage, vectorized with NumPy over messages and backoff configurations.
+
+--messages messages are queued while the server is down for --outage
+seconds (all at the start, or with --arrival spread evenly over the
+outage) and each is first tried when it is queued.  A failed attempt at
+time t is retried at
+
+    t + randint(0, 2 ** min(retries, max_exp) - 1) * constant
+
+like next_time() of compute.py, with the exponent capped at --max-exp
+and the delay capped at --max-delay.  The server fails every attempt
+while it is down, afterwards it accepts --capacity messages per second:
+the attempts falling into a --bin second time bin succeed with
+probability min(1, free capacity / attempts).
+
+Attempts are processed one retry generation at a time for all messages
+and configurations at once (earlier generations get the capacity of a
+bin first).  Every combination of --constant and --max-exp is
+simulated until --horizon, and reported are the delivered messages, the
+attempts per message, percentiles of the delay from queueing to
+delivery, the peak of the attempts after the outage (the retry storm)
+and the time until 99% were delivered.  --timeline prints attempts and
+deliveries per second over time:
+
+    python3 stormsim.py --messages 1000000 --outage 3600 --capacity 500 \\
+        --constant 5,15,60 --max-exp 8,12,16
+"""
+
+import itertools
+import time
+
+import click
+import numpy as np
+
+
+class StormSimulation(object):
+    def __init__(self, num_messages, outage, capacity, constants, max_exps, max_delay=None,
+                 arrival="burst", bin_size=1.0, horizon=None, seed=0):
+        self.rng = np.random.default_rng(seed)
+        configs = list(itertools.product(constants, max_exps))
+        self.configs = configs
+        self.constant = np.array([c for c, e in configs], dtype=float)[:, None]
+        self.max_exp = np.array([e for c, e in configs], dtype=np.int64)[:, None]
+        self.max_delay = max_delay
+        self.num_messages = num_messages
+        self.outage = outage
+        self.capacity = capacity
+        self.bin_size = bin_size
+        if horizon is None:
+            horizon = outage + 86400.0
+        self.num_bins = int(np.ceil(horizon / bin_size))
+        self.horizon = self.num_bins * bin_size
+        if arrival == "spread":
+            queued = self.rng.uniform(0, outage, num_messages)
+        else:
+            queued = np.zeros(num_messages)
+        self.queued = queued
+        shape = (len(configs), num_messages)
+        self.next = np.broadcast_to(queued, shape).copy()
+        self.retries = np.zeros(shape, dtype=np.int64)
+        self.delivered = np.full(shape, np.nan)
+        self.attempts = np.zeros(len(configs) * self.num_bins)
+        self.sent = np.zeros(len(configs) * self.num_bins)
+        self.generations = 0
+
+    def bin_capacity(self):
+        starts = np.arange(self.num_bins) * self.bin_size
+        free = np.where(starts >= self.outage, self.capacity * self.bin_size, 0.0)
+        return np.tile(free, len(self.configs))
+
+    def run(self):
+        capacity = self.bin_capacity()
+        num_bins = self.num_bins
+        rows = np.repeat(np.arange(len(self.configs)), self.num_messages)
+        cols = np.tile(np.arange(self.num_messages), len(self.configs))
+        pending = self.next.ravel() < self.horizon
+        rows, cols = rows[pending], cols[pending]
+        while len(rows):
+            self.generations += 1
+            t = self.next[rows, cols]
+            key = rows * num_bins + (t / self.bin_size).astype(np.int64)
+            counts = np.bincount(key, minlength=len(capacity))
+            self.attempts += counts
+            free = np.maximum(capacity - self.sent, 0.0)
+            p = np.divide(free, counts, out=np.zeros_like(free), where=counts > 0)
+            ok = self.rng.random(len(key)) < p[key]
+            self.sent += np.bincount(key[ok], minlength=len(capacity))
+            self.delivered[rows[ok], cols[ok]] = t[ok]
+
+            rows, cols, t = rows[~ok], cols[~ok], t[~ok]
+            retries = self.retries[rows, cols] + 1
+            self.retries[rows, cols] = retries
+            exp = np.minimum(retries, self.max_exp[rows, 0])
+            delay = self.rng.integers(0, 2 ** exp) * self.constant[rows, 0]
+            if self.max_delay is not None:
+                delay = np.minimum(delay, self.max_delay)
+            t = t + delay
+            self.next[rows, cols] = t
+            keep = t < self.horizon
+            rows, cols = rows[keep], cols[keep]
+        return self
+
+    def report(self):
+        results = []
+        attempts = self.attempts.reshape(len(self.configs), self.num_bins)
+        sent = self.sent.reshape(len(self.configs), self.num_bins)
+        for i, (constant, max_exp) in enumerate(self.configs):
+            delivered = self.delivered[i]
+            ok = ~np.isnan(delivered)
+            delay = delivered[ok] - self.queued[ok]
+            num_ok = int(ok.sum())
+            cumulative = np.cumsum(sent[i])
+            done99 = np.searchsorted(cumulative, 0.99 * self.num_messages)
+            p50, p90, p99 = (np.percentile(delay, [50, 90, 99]) if num_ok
+                             else (np.nan, np.nan, np.nan))
+            # the retry storm when the server is back
+            up = int(np.ceil(self.outage / self.bin_size))
+            peak = up + int(attempts[i, up:].argmax())
+            results.append(dict(
+                constant=constant,
+                max_exp=max_exp,
+                delivered=num_ok,
+                attempts_per_msg=attempts[i].sum() / self.num_messages,
+                delay_p50=p50,
+                delay_p90=p90,
+                delay_p99=p99,
+                delay_max=delay.max() if num_ok else np.nan,
+                peak_rate=attempts[i, peak] / self.bin_size,
+                peak_time=peak * self.bin_size,
+                done99=(done99 + 1) * self.bin_size if done99 < self.num_bins else np.nan,
+            ))
+        return results
+
+    def timeline(self, step):
+        """ yield (time, [(attempts/s, sent/s) per config]) per step seconds """
+        per_step = max(1, int(round(step / self.bin_size)))
+        attempts = self.attempts.reshape(len(self.configs), self.num_bins)
+        sent = self.sent.reshape(len(self.configs), self.num_bins)
+        last = int(np.nonzero(attempts.any(axis=0))[0].max()) + 1
+        seconds = per_step * self.bin_size
+        for start in range(0, last, per_step):
+            yield start * self.bin_size, [
+                (attempts[i, start:start + per_step].sum() / seconds,
+                 sent[i, start:start + per_step].sum() / seconds)
+                for i in range(len(self.configs))]
+
+
+def float_list(ctx, param, value):
+    try:
+        return [float(x) for x in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("expected comma separated numbers")
+
+
+def int_list(ctx, param, value):
+    return [int(x) for x in float_list(ctx, param, value)]
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--messages", "num_messages", type=int, default=1000000,
+              help="(default 1000000) queued messages")
+@click.option("--outage", type=float, default=3600, help="(default 3600) seconds the server is down")
+@click.option("--capacity", type=float, default=500,
+              help="(default 500) messages per second the server accepts")
+@click.option("--constant", default="5,15,60", callback=float_list,
+              help="(default 5,15,60) backoff constants in seconds")
+@click.option("--max-exp", default="16", callback=int_list,
+              help="(default 16) caps of the backoff exponent")
+@click.option("--max-delay", type=float, default=None,
+              help="(default none) cap of a single backoff delay in seconds")
+@click.option("--arrival", type=click.Choice(["burst", "spread"]), default="burst",
+              help="(default burst) queue all messages at the start or over the outage")
+@click.option("--bin", "bin_size", type=float, default=1.0,
+              help="(default 1) seconds per time bin of the server capacity")
+@click.option("--horizon", type=float, default=None,
+              help="(default outage + 1 day) seconds after which retries are not simulated")
+@click.option("--timeline", type=float, default=0,
+              help="(default off) print attempts and sends per second every that many seconds")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(num_messages, outage, capacity, constant, max_exp, max_delay, arrival, bin_size,
+         horizon, timeline, seed):
+    t0 = time.time()
+    sim = StormSimulation(num_messages, outage, capacity, constant, max_exp, max_delay,
+                          arrival, bin_size, horizon, seed).run()
+    duration = time.time() - t0
+    print("%d messages, %.0fs outage, capacity %.0f/s, %d generations in %.1fs" % (
+          num_messages, outage, capacity, sim.generations, duration))
+    print("%8s %7s | %9s %9s %9s %9s %9s %9s %10s %9s %9s" % (
+          "constant", "max-exp", "delivered", "tries/msg", "p50", "p90", "p99", "max",
+          "peak/s", "at", "99% at"))
+    for r in sim.report():
+        print("%8.1f %7d | %8.2f%% %9.2f %9.0f %9.0f %9.0f %9.0f %10.0f %9.0f %9.0f" % (
+              r["constant"], r["max_exp"], 100.0 * r["delivered"] / num_messages,
+              r["attempts_per_msg"], r["delay_p50"], r["delay_p90"], r["delay_p99"],
+              r["delay_max"], r["peak_rate"], r["peak_time"], r["done99"]))
+    if timeline:
+        print("")
+        print("%9s | %s" % ("time", " | ".join("%5g/%-3d tries/s  sent/s" % config
+                                              for config in sim.configs)))
+        for t, rates in sim.timeline(timeline):
+            print("%9.0f | %s" % (t, " | ".join("%15.0f %7.0f" % rate for rate in rates)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark of a membership change in a large group.
+
+A group of --members members is set up through a queued MTA (the creator
+adds everybody and sends the whole log once), then --changes times the
+creator adds a new peer or removes another member and the MTA delivers
+everything this causes, including the answers of the recipients.
+Reported per change are the messages (one per recipient), bytes,
+deliveries and the processing time of the MTA and the peers, and the
+deliveries which failed (window peers which joined later can't replay a
+DEL of a member they never saw added):
+
+    python3 bench_fanout.py --members 10,100,1000 --protocol window,orset
+"""
+
+import random
+import time
+
+import click
+
+from group import MTA
+from sim import PROTOCOLS, payload_size, protocol_list, int_list
+
+
+class CountingMTA(MTA):
+    def __init__(self):
+        MTA.__init__(self, verbose=False, queued=True)
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def relay(self, from_addr, to_addrs, chat_id, payload, mid=None):
+        self.messages += len(to_addrs)
+        self.bytes += len(to_addrs) * payload_size(payload)
+        return MTA.relay(self, from_addr, to_addrs, chat_id, payload, mid)
+
+    def deliver(self, addr, from_addr, mid, chat_id, payload):
+        try:
+            MTA.deliver(self, addr, from_addr, mid, chat_id, payload)
+        except ValueError:
+            # the member list can't be replayed, a DEL came before its ADD
+            self.errors += 1
+
+
+def setup_group(protocol, num_members):
+    mta = CountingMTA()
+    mta.chat_class = PROTOCOLS[protocol]
+    creator = "member0@example.org"
+    chat = mta.get_peer(creator)._chats[1] = mta.chat_class.create_new(1, creator, mta=mta)
+    for i in range(1, num_members):
+        chat.add_contact(creator, "member%d@example.org" % i)
+    # the whole log, also for the window protocol
+    chat.window = len(chat.log)
+    chat.send_out_last_log()
+    del chat.window
+    mta.flush()
+    return mta
+
+
+def run(protocol, num_members, num_changes, rng):
+    mta = setup_group(protocol, num_members)
+    creator = "member0@example.org"
+    mta.messages = mta.bytes = 0
+    deliveries = 0
+    t0 = time.time()
+    chat = mta.get_peer(creator)._chats[1]
+    for i in range(num_changes):
+        others = chat.members[1:]
+        if others and rng.random() < 0.5:
+            chat.remove_contact(creator, rng.choice(others))
+            chat.send_out_last_log()
+        else:
+            chat.add_contact_and_send(creator, "new%d@example.org" % i)
+        deliveries += mta.flush()
+    duration = time.time() - t0
+    return dict(errors=mta.errors,
+                msgs=mta.messages / float(num_changes),
+                bytes=mta.bytes / float(num_changes),
+                deliveries=deliveries / float(num_changes),
+                ms=1000.0 * duration / num_changes)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--members", default="10,100,1000", callback=int_list,
+              help="(default 10,100,1000) group sizes")
+@click.option("--protocol", default="window,orset", callback=protocol_list,
+              help="(default window,orset) window (group.Chat) or orset (orset.ORSetChat)")
+@click.option("--changes", type=int, default=20, help="(default 20) changes per group")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(members, protocol, changes, seed):
+    print("%-8s %7s | %9s %11s %10s %9s %7s" % (
+          "protocol", "members", "msgs/chg", "bytes/chg", "delivered", "ms/chg", "errors"))
+    for name in protocol:
+        for num_members in members:
+            result = run(name, num_members, changes, random.Random(seed))
+            print("%-8s %7d | %9.1f %11.0f %10.1f %9.2f %7d" % (
+                  name, num_members, result["msgs"], result["bytes"],
+                  result["deliveries"], result["ms"], result["errors"]))
+
+
+if __name__ == "__main__":
+    main()
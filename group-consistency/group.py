@@ -0,0 +1,257 @@
+
+import random
+from collections import deque
+from itertools import count
+
+_mcount = count()
+
+def message_id():
+    return "MsgId{}".format(next(_mcount))
+
+
+
+class Entry:
+    def __init__(self, message_id, addr, op, other_addr):
+        assert op in ("add", "del")
+        self.message_id = message_id
+        self.addr = addr
+        self.op = op
+        self.other_addr = other_addr
+
+    def __str__(self):
+        return "Entry: <{}> {} {} {}".format(self.message_id, self.addr, self.op.upper(), self.other_addr)
+    __repr__ = __str__
+
+    def size(self):
+        """ bytes of the entry in a message (fields and separators) """
+        return len(self.message_id) + len(self.addr) + len(self.op) + len(self.other_addr) + 4
+
+class Peer:
+    def __init__(self, addr, mta):
+        self.addr = addr
+        self.mta = mta
+        self._chats = {}
+        self._known_message_ids = set()
+
+    def process_incoming(self, from_addr, message_id, chat_id, payload):
+        """ process a delivered message, return False if it was a duplicate """
+        if message_id in self._known_message_ids:
+            return False
+        self._known_message_ids.add(message_id)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self.mta.chat_class.joined(chat_id, self.addr, mta=self.mta)
+            self._chats[chat_id] = chat
+        chat.receive_log(payload)
+        return True
+
+    def __eq__(self, other):
+        return self.addr == other.addr
+
+    def __ne__(self, other):
+        return self.addr != other.addr
+
+    def __hash__(self):
+        return hash(self.addr)
+
+    def __str__(self):
+        return "Contact<{}>".format(self.addr)
+
+    def __repr__(self):
+        return str(self)
+
+
+class Chat:
+    """ a group chat as seen by one peer.
+
+    The member list is what replaying the log gives: ADDs append, DELs
+    remove the first occurrence.  It and a count per address are kept up
+    to date as entries are appended instead of replaying the log on every
+    access, so is_member() doesn't depend on the length of the history.
+    A copy of it is kept every checkpoint_interval entries, so members_at()
+    replays only the entries since the last checkpoint.
+    """
+    checkpoint_interval = 100
+    # number of the last log entries sent with every message
+    window = 10
+
+    def __init__(self, chat_id, mta):
+        self.id = chat_id
+        self._known_message_ids = set()
+        self.mta = mta
+        self.log =[]
+        self._members = []         # the member list
+        self._counts = {}          # addr -> number of times it is in the member list
+        self._error = None         # set by a DEL of a non-member
+        self._checkpoints = [[]]   # member lists after 0, interval, 2*interval ... entries
+
+    def __str__(self):
+        return "Chat{} len={}".format(self.id, len(self.members))
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    @property
+    def members(self):
+        if self._error is not None:
+            raise ValueError(self._error)
+        return list(self._members)
+
+    def is_member(self, addr):
+        if self._error is not None:
+            raise ValueError(self._error)
+        return addr in self._counts
+
+    def first_member(self):
+        if self._error is not None:
+            raise ValueError(self._error)
+        return self._members[0]
+
+    def members_at(self, num_entries):
+        """ return the member list after the first num_entries log entries """
+        i = min(num_entries // self.checkpoint_interval, len(self._checkpoints) - 1)
+        members = list(self._checkpoints[i])
+        for entry in self.log[i * self.checkpoint_interval:num_entries]:
+            if entry.op == "add":
+                members.append(entry.other_addr)
+            elif entry.op == "del":
+                members.remove(entry.other_addr)
+        return members
+
+    def append_entry(self, entry):
+        self.log.append(entry)
+        if self._error is not None:
+            return
+        addr = entry.other_addr
+        if entry.op == "add":
+            self._members.append(addr)
+            self._counts[addr] = self._counts.get(addr, 0) + 1
+        elif entry.op == "del":
+            num = self._counts.get(addr)
+            if num is None:
+                self._error = "{} not a member when replaying {}".format(addr, entry)
+                return
+            self._members.remove(addr)
+            if num == 1:
+                del self._counts[addr]
+            else:
+                self._counts[addr] = num - 1
+        if len(self.log) % self.checkpoint_interval == 0:
+            self._checkpoints.append(list(self._members))
+
+    @classmethod
+    def create_new(cls, chat_id, contact, mta):
+        chat = cls(chat_id, mta=mta)
+        # add ourself as first member
+        chat.add_contact(contact, contact)
+        return chat
+
+    @classmethod
+    def joined(cls, chat_id, contact, mta):
+        """ the chat of contact, who received a first message of it """
+        chat = cls(chat_id, mta=mta)
+        chat.add_contact(contact, contact)
+        return chat
+
+    def add_contact_and_send(self, contact, other_contact):
+        self.add_contact(contact, other_contact)
+        self.send_out_last_log()
+
+    def add_contact(self, contact, other_contact):
+        if self.is_member(other_contact):
+            raise ValueError("already a member {}".format(other_contact))
+        assert isinstance(contact, str) and isinstance(other_contact, str)
+        entry = Entry(message_id(), contact, "add", other_contact)
+        self.append_entry(entry)
+
+    def remove_contact(self, contact, other_contact):
+        assert isinstance(contact, str) and isinstance(other_contact, str)
+        if not self.is_member(other_contact):
+            raise ValueError("{} not a member".format(other_contact))
+        entry = Entry(message_id(), contact, "del", other_contact)
+        self.append_entry(entry)
+
+    def send_out_last_log(self):
+        members = self.members
+        self.mta.relay(from_addr=members[0], to_addrs=members[1:], chat_id=self.id,
+                       payload=self.log[-self.window:])
+
+    def receive_log(self, log):
+        if random.random() > 1.8:
+            print("{}: failed randomly to receive log len={}".format(self, len(log)))
+            return
+        for entry in log:
+            if entry.message_id not in self._known_message_ids:
+                self._known_message_ids.add(entry.message_id)
+                if entry.other_addr != self.first_member():
+                    self.append_entry(entry)
+
+
+class MTA:
+    """ relays messages to the peers.
+
+    A message is one payload object which all recipients share, it is
+    neither copied nor printed per recipient.  With queued=True relay()
+    only appends it to a queue per recipient and flush() delivers the
+    queued messages (and those relayed while delivering) one recipient
+    after the other.  Peers drop messages whose message id they already
+    processed, relay(mid=...) sends such a duplicate.
+    """
+    # the class of the chats of the peers
+    chat_class = Chat
+
+    def __init__(self, verbose=True, queued=False):
+        self.addr2peer = {}
+        self.verbose = verbose
+        self.queued = queued
+        self.queues = {}           # addr -> deque of (from_addr, mid, chat_id, payload)
+        self.duplicates = 0        # deliveries dropped by the peer
+
+    def get_peer(self, addr):
+        peer = self.addr2peer.get(addr)
+        if peer is None:
+            peer = self.addr2peer[addr] = Peer(addr, self)
+        return peer
+
+    def relay(self, from_addr, to_addrs, chat_id, payload, mid=None):
+        if mid is None:
+            mid = message_id()
+        if self.verbose:
+            print("relaying to {}: {}".format(", ".join(to_addrs), payload))
+        if self.queued:
+            message = (from_addr, mid, chat_id, payload)
+            for addr in to_addrs:
+                queue = self.queues.get(addr)
+                if queue is None:
+                    queue = self.queues[addr] = deque()
+                queue.append(message)
+        else:
+            for addr in to_addrs:
+                self.deliver(addr, from_addr, mid, chat_id, payload)
+        return mid
+
+    def deliver(self, addr, from_addr, mid, chat_id, payload):
+        if not self.get_peer(addr).process_incoming(from_addr, mid, chat_id, payload):
+            self.duplicates += 1
+
+    def flush(self):
+        """ deliver the queued messages, return how many """
+        num = 0
+        queues = self.queues
+        while queues:
+            addr = next(iter(queues))
+            queue = queues[addr]
+            while queue:
+                self.deliver(addr, *queue.popleft())
+                num += 1
+            del queues[addr]
+        return num
+
+    def ensure_consistent_member_lists(self, chat_id):
+        last = None
+        for addr, peer in self.addr2peer.items():
+            members = peer._chats[chat_id].members
+            if last is None:
+                last = members
+            else:
+                assert sorted(last) == sorted(members)
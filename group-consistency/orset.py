@@ -0,0 +1,293 @@
+"""
+Group membership as an observed-remove set with delta sync.
+
+The log of group.py's Chat is replayed in arrival order and a message
+carries its last Chat.window entries, so peers diverge when messages get
+lost or reordered and every message costs the whole window.  ORSetChat
+is a drop-in replacement (set MTA.chat_class) which converges however
+its entries arrive:
+
+- every ADD is tagged with its unique message id; a DEL carries the tags
+  of the ADDs of the member its author had seen.  A member is listed
+  while it has an ADD whose tag was not removed, which doesn't depend on
+  the order of the entries (a concurrent ADD wins over a DEL).
+
+- each entry gets the next sequence number of its author.  The clock of
+  a chat is the highest sequence number of each author up to which all
+  entries are known.  Every message carries the sender's clock.
+
+- a peer keeps the clock each member is assumed to have: the clock of
+  the last message it got from, sent to or saw sent to the member.  A
+  message carries only the entries its recipients are assumed to lack;
+  recipients with different clocks (like a joining member) get separate
+  messages.  A recipient whose state is the sender's afterwards doesn't
+  look at the other members at all, so a change costs linear in the
+  group size.  A recipient sends the entries it has to the members which
+  lack them, which happens when changes were made concurrently and did
+  not reach everybody.
+
+- a recipient whose clock is behind the sender's after applying a message
+  missed a message.  It asks the sender for the missing entries with a
+  request carrying its clock, which the sender answers with exactly
+  those.  Lost messages are so repaired with the next message which
+  reaches the peer.
+
+- the assumptions can be wrong when messages get lost, so a peer also
+  keeps the clock each member is known to have: the clock of the last
+  message or request it got from the member itself.  sync(), called
+  periodically, sends our clock to the members whose known clock is
+  behind it and asks them to answer with theirs; one which lacks entries
+  answers with a request.  It does nothing once every member answered,
+  so it costs nothing in a quiet chat and repairs the last lost message
+  of a busy one.
+"""
+
+from group import Entry, message_id
+
+
+class ClockedEntry(Entry):
+    def __init__(self, message_id, addr, seq, op, other_addr, tags=()):
+        Entry.__init__(self, message_id, addr, op, other_addr)
+        self.seq = seq
+        self.tags = tags    # for a DEL: the removed ADDs
+
+    def size(self):
+        return (Entry.size(self) + len(str(self.seq)) + 1 +
+                sum(len(tag) + 1 for tag in self.tags))
+
+
+class Delta(object):
+    """ the payload of an ORSetChat message """
+
+    def __init__(self, sender, clock, entries, to_addrs, request=False, ack=False):
+        self.sender = sender
+        self.clock = clock
+        self.entries = entries
+        # the recipients, like the To header (not counted in size())
+        self.to_addrs = to_addrs
+        self.request = request
+        # the recipients should answer with their clock
+        self.ack = ack
+
+    def size(self):
+        return (len(self.sender) + 1 +
+                sum(len(addr) + len(str(seq)) + 2 for addr, seq in self.clock.items()) +
+                sum(entry.size() for entry in self.entries))
+
+    def __repr__(self):
+        return "Delta<{} clock={} entries={}{}{}>".format(
+            self.sender, self.clock, self.entries, " request" if self.request else "",
+            " ack" if self.ack else "")
+
+
+class ORSetChat(object):
+    def __init__(self, chat_id, mta, addr=None):
+        self.id = chat_id
+        self.mta = mta
+        self.addr = addr
+        self.log = []            # the entries in the order they were received
+        self.clock = {}          # author -> sequence number up to which all are known
+        self.known = {}          # member -> the clock it was seen to have
+        self.assumed = {}        # member -> the clock it is assumed to have
+        self._entries = {}       # author -> {sequence number: entry}
+        self._tags = {}          # member -> tags of its ADDs which were not removed
+        self._removed = set()    # removed tags
+        self._farewell = []      # members removed since the last message
+        self._pending = []       # (to_addrs, clock) of received messages, not yet in assumed
+
+    def __str__(self):
+        return "ORSetChat{} len={}".format(self.id, len(self._tags))
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    @classmethod
+    def create_new(cls, chat_id, contact, mta):
+        chat = cls(chat_id, mta=mta, addr=contact)
+        chat.add_contact(contact, contact)
+        return chat
+
+    @classmethod
+    def joined(cls, chat_id, contact, mta):
+        # the ADD of contact is in the messages
+        return cls(chat_id, mta=mta, addr=contact)
+
+    @property
+    def members(self):
+        """ ourself first (unless removed), then in order of joining """
+        if self.addr in self._tags:
+            return [self.addr] + [addr for addr in self._tags if addr != self.addr]
+        return list(self._tags)
+
+    def is_member(self, addr):
+        return addr in self._tags
+
+    def members_at(self, num_entries):
+        """ return the member list after the first num_entries received entries """
+        chat = ORSetChat(self.id, None, self.addr)
+        for entry in self.log[:num_entries]:
+            chat.append_entry(entry)
+        return chat.members
+
+    def append_entry(self, entry):
+        """ apply entry unless already known, return whether it was new """
+        entries = self._entries.setdefault(entry.addr, {})
+        if entry.seq in entries:
+            return False
+        entries[entry.seq] = entry
+        self.log.append(entry)
+        seq = self.clock.get(entry.addr, 0)
+        while seq + 1 in entries:
+            seq += 1
+        self.clock[entry.addr] = seq
+
+        addr = entry.other_addr
+        if entry.op == "add":
+            if entry.message_id not in self._removed:
+                self._tags.setdefault(addr, set()).add(entry.message_id)
+        else:
+            self._removed.update(entry.tags)
+            tags = self._tags.get(addr)
+            if tags is not None:
+                tags.difference_update(entry.tags)
+                if not tags:
+                    del self._tags[addr]
+        return True
+
+    def _new_entry(self, contact, op, other_contact, tags=()):
+        assert isinstance(contact, str) and isinstance(other_contact, str)
+        seq = self.clock.get(contact, 0) + 1
+        self.append_entry(ClockedEntry(message_id(), contact, seq, op, other_contact, tags))
+
+    def add_contact(self, contact, other_contact):
+        if self.is_member(other_contact):
+            raise ValueError("already a member {}".format(other_contact))
+        self._new_entry(contact, "add", other_contact)
+
+    def remove_contact(self, contact, other_contact):
+        if not self.is_member(other_contact):
+            raise ValueError("{} not a member".format(other_contact))
+        self._new_entry(contact, "del", other_contact, tuple(self._tags[other_contact]))
+        self._farewell.append(other_contact)
+
+    def add_contact_and_send(self, contact, other_contact):
+        self.add_contact(contact, other_contact)
+        self.send_out_last_log()
+
+    def missing_entries(self, recipients):
+        """ the entries which the assumed clock of one of the recipients
+        doesn't cover """
+        self._merge_pending()
+        missing = []
+        for author, entries in self._entries.items():
+            have = min(self.assumed.get(addr, {}).get(author, 0) for addr in recipients)
+            top = self.clock.get(author, 0)
+            missing.extend(entries[seq] for seq in range(have + 1, top + 1))
+            if len(entries) > top:
+                # the ones after a gap
+                missing.extend(entry for seq, entry in entries.items() if seq > top + 1)
+        return missing
+
+    def send_out_last_log(self):
+        to_addrs = [addr for addr in self.members if addr != self.addr] + self._farewell
+        self._farewell = []
+        if to_addrs:
+            self._send(to_addrs)
+
+    def sync(self):
+        """ send our clock to the members which were not seen with it,
+        asking for theirs.  Return whether a message was sent. """
+        stale = [addr for addr in self.members
+                 if addr != self.addr and self._lacks(addr, self.known)]
+        if not stale:
+            return False
+        # a member which lacks entries requests them
+        payload = Delta(self.addr, dict(self.clock), [], stale, ack=True)
+        self.mta.relay(from_addr=self.addr, to_addrs=stale, chat_id=self.id, payload=payload)
+        return True
+
+    def _send(self, to_addrs):
+        """ send each recipient the entries it lacks.
+
+        Recipients with the same clock get one message, so a joining
+        member gets the history without it being sent to everybody.
+        All messages list all recipients, which are assumed to end up
+        with our clock.
+        """
+        self._merge_pending()
+        groups = {}
+        for addr in to_addrs:
+            key = tuple(sorted(self.assumed.get(addr, {}).items()))
+            groups.setdefault(key, []).append(addr)
+        clock = dict(self.clock)
+        for addrs in groups.values():
+            payload = Delta(self.addr, clock, self.missing_entries(addrs), to_addrs)
+            self.mta.relay(from_addr=self.addr, to_addrs=addrs, chat_id=self.id,
+                           payload=payload)
+        for addr in to_addrs:
+            _merge_clock(self.assumed, addr, clock)
+
+    def _request(self, addr):
+        payload = Delta(self.addr, dict(self.clock), [], [addr], request=True)
+        self.mta.relay(from_addr=self.addr, to_addrs=[addr], chat_id=self.id, payload=payload)
+
+    def _merge_pending(self):
+        """ merge the clocks of the received messages into those assumed
+        for their recipients """
+        pending = self._pending
+        self._pending = []
+        for to_addrs, clock in pending:
+            for addr in to_addrs:
+                _merge_clock(self.assumed, addr, clock)
+
+    def _lacks(self, addr, clocks=None):
+        """ whether addr's clock, by default the assumed one, is behind ours """
+        known = (self.assumed if clocks is None else clocks).get(addr, {})
+        return any(known.get(author, 0) < seq for author, seq in self.clock.items())
+
+    def _complete(self):
+        """ whether there are no gaps in the known entries """
+        entries = self._entries
+        return all(len(entries[author]) == seq for author, seq in self.clock.items())
+
+    def receive_log(self, delta):
+        for entry in delta.entries:
+            self.append_entry(entry)
+        sender = delta.sender
+        clock = self.clock
+        # the sender's clock is what it really has
+        _merge_clock(self.known, sender, delta.clock)
+        if delta.request or delta.ack:
+            self._merge_pending()
+            self.assumed[sender] = dict(self.known[sender])
+        else:
+            # the recipients are assumed to have got the sender's
+            # entries, which is only needed when we send, merging it
+            # right away would cost the size of the group with every message
+            self._pending.append((delta.to_addrs, delta.clock))
+            self._pending.append(([sender], delta.clock))
+        requested = any(clock.get(author, 0) < seq for author, seq in delta.clock.items())
+        if requested:
+            # a message to us got lost, the request carries our clock
+            self._request(sender)
+        if not delta.request and not delta.ack and clock == delta.clock and self._complete():
+            # we have what the sender has, and so are assumed to have its recipients
+            return
+        # send what we have to whom lacks it: the requesting sender and
+        # members the entries of concurrent changes didn't reach
+        self._merge_pending()
+        behind = [addr for addr in self.members if addr != self.addr and self._lacks(addr)]
+        if sender not in behind and (delta.request and self._lacks(sender) or
+                                     delta.ack and not requested):
+            # for an ack even an empty message, it carries our clock
+            behind.append(sender)
+        if behind:
+            self._send(behind)
+
+
+def _merge_clock(clocks, addr, clock):
+    """ raise the clock of addr in clocks to clock """
+    known = clocks.setdefault(addr, {})
+    for author, seq in clock.items():
+        if known.get(author, 0) < seq:
+            known[author] = seq
@@ -0,0 +1,409 @@
+"""
+Discrete-event simulation of the membership protocol of group.py.
+
+Peers and chats are the classes of group.py, only the MTA is replaced:
+SimMTA delivers every relayed message as an event after a random delay
+(latency plus an exponentially distributed jitter, so that messages
+overtake each other) or drops it with probability loss.  Simulated time
+is in seconds, nothing sleeps.
+
+A run creates chats of --members members drawn from --peers peers.  The
+creator of a chat adds the initial members one by one, then --changes
+times a random member (or with --changed-by creator the creator) adds or
+removes someone, with exponentially distributed pauses of mean
+--interval.  The simulation knows the
+expected member list of each chat (all changes applied in the order they
+were made) and reports
+
+    converged   chats where every expected member has the expected list
+                after all messages were delivered
+    settle      seconds from a change until all expected members agree
+                (median, p90), changes which never settled
+    msgs        messages (one per recipient), log entries and bytes sent
+                per change
+    errors      deliveries which failed with ValueError, because the
+                member list could not be replayed (a DEL before its ADD)
+    speed       simulated events per second
+
+--protocol orset runs the chats of orset.py instead of group.Chat, whose
+members call sync() every --sync-interval seconds while the chat has
+changes ahead or sync() sent something.  --messages sends that many chat
+messages per chat in between the changes, which carry the membership
+like the changes do.  --duplicate
+delivers messages a second time, which the peers drop by message id.
+
+Options given as comma separated lists are swept over all combinations:
+
+    python3 sim.py --chats 1000 --peers 5000 --jitter 0,1,5 --loss 0,0.01,0.05
+"""
+
+import heapq
+import itertools
+import random
+import time
+from itertools import count
+
+import click
+
+from group import MTA, Chat, message_id
+from orset import Delta, ORSetChat
+
+PROTOCOLS = {"window": Chat, "orset": ORSetChat}
+
+
+class Simulation(object):
+    """ event queue ordered by simulated time """
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = 0
+        self._queue = []
+        self._seq = count()
+
+    def schedule(self, delay, func, *args):
+        heapq.heappush(self._queue, (self.now + delay, next(self._seq), func, args))
+
+    def run(self):
+        queue = self._queue
+        while queue:
+            self.now, _, func, args = heapq.heappop(queue)
+            self.events += 1
+            func(*args)
+
+
+class SimMTA(MTA):
+    """ relays each message to each recipient as a delayed, possibly lost event.
+
+    Without jitter all recipients get a message at the same time, so the
+    fan-out is one event delivering the shared payload to all of them.
+    With probability duplicate a recipient gets a message a second time
+    (as after a re-download), which its peer drops by the message id.
+    """
+
+    def __init__(self, sim, rng, latency=1.0, jitter=0.0, loss=0.0, duplicate=0.0):
+        MTA.__init__(self, verbose=False)
+        self.sim = sim
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.messages = 0      # one per recipient
+        self.entries = 0       # log entries in these messages
+        self.bytes = 0         # their size
+        self.lost = 0
+        self.errors = 0        # deliveries the peer failed to process
+        # called with (addr, chat_id) after each delivery
+        self.on_deliver = None
+
+    def relay(self, from_addr, to_addrs, chat_id, payload, mid=None):
+        if mid is None:
+            mid = message_id()
+        rng = self.rng
+        num_entries = len(payload_entries(payload))
+        size = payload_size(payload)
+        batch = []
+        for addr in to_addrs:
+            self.messages += 1
+            self.entries += num_entries
+            self.bytes += size
+            if self.loss and rng.random() < self.loss:
+                self.lost += 1
+                continue
+            if self.jitter:
+                delay = self.latency + rng.expovariate(1.0 / self.jitter)
+                self.sim.schedule(delay, self.deliver_batch, [addr], from_addr, mid,
+                                  chat_id, payload)
+            else:
+                batch.append(addr)
+            if self.duplicate and rng.random() < self.duplicate:
+                delay = self.latency + rng.expovariate(1.0 / (self.jitter or self.latency))
+                self.sim.schedule(delay, self.deliver_batch, [addr], from_addr, mid,
+                                  chat_id, payload)
+        if batch:
+            self.sim.schedule(self.latency, self.deliver_batch, batch, from_addr, mid,
+                              chat_id, payload)
+        return mid
+
+    def deliver_batch(self, addrs, from_addr, mid, chat_id, payload):
+        for addr in addrs:
+            self.deliver(addr, from_addr, mid, chat_id, payload)
+
+    def deliver(self, addr, from_addr, mid, chat_id, payload):
+        try:
+            MTA.deliver(self, addr, from_addr, mid, chat_id, payload)
+        except ValueError:
+            # the member list can't be replayed, a DEL came before its ADD
+            self.errors += 1
+        if self.on_deliver is not None:
+            self.on_deliver(addr, chat_id)
+
+
+class ChatState(object):
+    """ what the simulation expects of a chat """
+
+    def __init__(self, chat_id, creator, reference):
+        self.id = chat_id
+        self.creator = creator
+        # a chat which got every change as it was made
+        self.reference = reference
+        self.expected = []     # its sorted member list, None if it can't be replayed
+        self.targets = set()   # the members to check
+        self.behind = set()    # targets which don't agree yet
+        self.changes = []      # times of the changes which didn't settle yet
+        self.peers = set()     # the peers which got the chat
+        self.until = 0.0       # time of the last scheduled change or message
+
+
+class GroupSimulation(object):
+    def __init__(self, num_peers, num_chats, members, changes, interval,
+                 latency, jitter, loss, changed_by="members", protocol="window",
+                 messages=0, duplicate=0.0, sync_interval=60.0, seed=0):
+        self.rng = random.Random(seed)
+        self.sim = Simulation()
+        self.mta = SimMTA(self.sim, self.rng, latency, jitter, loss, duplicate)
+        self.mta.chat_class = PROTOCOLS[protocol]
+        self.mta.on_deliver = self.delivered
+        self.peers = ["peer%d@example.org" % i for i in range(num_peers)]
+        self.num_chats = num_chats
+        self.members = min(members, num_peers)
+        self.changes = changes
+        self.interval = interval
+        self.changed_by = changed_by
+        self.messages = messages
+        self.sync_interval = sync_interval
+        self.chats = {}
+        self.settle_times = []
+        self.num_changes = 0
+
+    def members_of(self, addr, chat_id):
+        """ the member list of addr's chat or None """
+        peer = self.mta.addr2peer.get(addr)
+        chat = peer and peer._chats.get(chat_id)
+        if chat is None:
+            return None
+        try:
+            return chat.members
+        except ValueError:
+            # a DEL was received before its ADD
+            return None
+
+    def agrees(self, addr, state):
+        if state.expected is None:
+            return False
+        members = self.members_of(addr, state.id)
+        return (members is not None and len(members) == len(state.expected) and
+                sorted(members) == state.expected)
+
+    def check(self, addr, state):
+        if self.agrees(addr, state):
+            state.behind.discard(addr)
+        else:
+            state.behind.add(addr)
+        self.settle(state)
+
+    def settle(self, state):
+        if not state.behind and state.changes:
+            now = self.sim.now
+            self.settle_times.extend(now - t for t in state.changes)
+            state.changes = []
+
+    def changed(self, state, entry):
+        self.num_changes += 1
+        state.reference.append_entry(entry)
+        try:
+            state.expected = sorted(state.reference.members)
+            state.targets = set(state.expected)
+        except ValueError:
+            # the changes contradict each other, no member list can agree
+            state.expected = None
+        state.changes.append(self.sim.now)
+        state.behind = set(addr for addr in state.targets if not self.agrees(addr, state))
+        self.settle(state)
+
+    def delivered(self, addr, chat_id):
+        state = self.chats[chat_id]
+        state.peers.add(addr)
+        if addr in state.targets:
+            self.check(addr, state)
+
+    def create_chat(self, chat_id):
+        addrs = self.rng.sample(self.peers, self.members)
+        creator, others = addrs[0], addrs[1:]
+        peer = self.mta.get_peer(creator)
+        chat_class = self.mta.chat_class
+        chat = peer._chats[chat_id] = chat_class.create_new(chat_id, creator, mta=self.mta)
+        state = self.chats[chat_id] = ChatState(chat_id, creator, chat_class(chat_id, None))
+        state.peers.add(creator)
+        self.changed(state, chat.log[-1])
+        for addr in others:
+            chat.add_contact_and_send(creator, addr)
+            self.changed(state, chat.log[-1])
+        for num, func in ((self.changes, self.change), (self.messages, self.send_message)):
+            t = 0.0
+            for i in range(num):
+                t += self.rng.expovariate(1.0 / self.interval)
+                self.sim.schedule(t, func, state)
+            state.until = max(state.until, t)
+        if self.sync_interval and hasattr(chat_class, "sync"):
+            self.sim.schedule(self.sync_interval, self.sync, state)
+
+    def sender(self, state):
+        """ a random expected member which has the chat, or None """
+        if self.changed_by == "creator":
+            candidates = [state.creator] if state.creator in state.targets else []
+        else:
+            candidates = [addr for addr in state.targets
+                          if self.members_of(addr, state.id) is not None]
+        if not candidates:
+            return None
+        return self.rng.choice(sorted(candidates))
+
+    def change(self, state):
+        """ a random member which has the chat adds or removes someone """
+        rng = self.rng
+        addr = self.sender(state)
+        if addr is None:
+            return
+        chat = self.mta.addr2peer[addr]._chats[state.id]
+        others = [member for member in chat.members if member != addr]
+        if others and rng.random() < 0.5:
+            chat.remove_contact(addr, rng.choice(others))
+            chat.send_out_last_log()
+        else:
+            other = rng.choice(self.peers)
+            if other == addr or chat.is_member(other):
+                return
+            chat.add_contact_and_send(addr, other)
+        self.changed(state, chat.log[-1])
+
+    def send_message(self, state):
+        """ a random member sends a chat message, which carries the membership """
+        addr = self.sender(state)
+        if addr is not None:
+            self.mta.addr2peer[addr]._chats[state.id].send_out_last_log()
+
+    def sync(self, state):
+        """ the members which have the chat call its sync() """
+        sent = False
+        for addr in sorted(state.peers):
+            chat = self.mta.addr2peer[addr]._chats.get(state.id)
+            if chat is not None and chat.is_member(addr):
+                sent = chat.sync() or sent
+        if sent or self.sim.now < state.until:
+            self.sim.schedule(self.sync_interval, self.sync, state)
+
+    def run(self):
+        for chat_id in range(self.num_chats):
+            self.create_chat(chat_id)
+        self.sim.run()
+        return self
+
+    def report(self):
+        """ return a dict of the measured values """
+        settle = sorted(self.settle_times)
+        num_changes = max(self.num_changes, 1)
+        return dict(
+            converged=sum(1 for state in self.chats.values() if not state.behind),
+            settle_median=percentile(settle, 0.5),
+            settle_p90=percentile(settle, 0.9),
+            unsettled=self.num_changes - len(settle),
+            msgs_per_change=self.mta.messages / float(num_changes),
+            entries_per_change=self.mta.entries / float(num_changes),
+            bytes_per_change=self.mta.bytes / float(num_changes),
+            lost=self.mta.lost,
+            duplicates=self.mta.duplicates,
+            errors=self.mta.errors,
+            events=self.sim.events,
+        )
+
+
+def payload_entries(payload):
+    return payload.entries if isinstance(payload, Delta) else payload
+
+
+def payload_size(payload):
+    if isinstance(payload, Delta):
+        return payload.size()
+    return sum(entry.size() for entry in payload)
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def float_list(ctx, param, value):
+    try:
+        return [float(x) for x in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("expected comma separated numbers")
+
+
+def int_list(ctx, param, value):
+    return [int(x) for x in float_list(ctx, param, value)]
+
+
+def protocol_list(ctx, param, value):
+    protocols = value.split(",")
+    for protocol in protocols:
+        if protocol not in PROTOCOLS:
+            raise click.BadParameter("unknown protocol {}".format(protocol))
+    return protocols
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--peers", "num_peers", type=int, default=2000, help="(default 2000) number of peers")
+@click.option("--chats", "num_chats", type=int, default=1000,
+              help="(default 1000) number of chats")
+@click.option("--members", default="5", callback=int_list,
+              help="(default 5) initial members per chat")
+@click.option("--changes", default="5", callback=int_list,
+              help="(default 5) membership changes per chat after the creation")
+@click.option("--interval", default="10", callback=float_list,
+              help="(default 10) mean seconds between the changes of a chat")
+@click.option("--latency", default="1", callback=float_list,
+              help="(default 1) minimum seconds a message takes")
+@click.option("--jitter", default="1", callback=float_list,
+              help="(default 1) mean seconds a message takes beyond --latency")
+@click.option("--loss", default="0", callback=float_list,
+              help="(default 0) probability of a message getting lost")
+@click.option("--changed-by", type=click.Choice(["members", "creator"]), default="members",
+              help="(default members) who makes the membership changes")
+@click.option("--protocol", default="window", callback=protocol_list,
+              help="(default window) window (group.Chat) or orset (orset.ORSetChat)")
+@click.option("--messages", type=int, default=0,
+              help="(default 0) chat messages per chat, sent like the changes")
+@click.option("--duplicate", type=float, default=0,
+              help="(default 0) probability of a message getting delivered twice")
+@click.option("--sync-interval", type=float, default=60,
+              help="(default 60) seconds between the sync() calls of the orset chats, 0 for none")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(num_peers, num_chats, members, changes, interval, latency, jitter, loss,
+         changed_by, protocol, messages, duplicate, sync_interval, seed):
+    print("%d peers, %d chats, changed by %s, %d messages per chat" % (
+          num_peers, num_chats, changed_by, messages))
+    print("%-8s %7s %7s %8s %7s %6s %6s | %9s %8s %8s %9s %8s %11s %9s %7s %10s" % (
+          "protocol", "members", "changes", "interval", "latency", "jitter", "loss",
+          "converged", "settle", "p90", "unsettled", "msgs/chg", "entries/chg", "bytes/chg",
+          "errors", "events/s"))
+    for params in itertools.product(protocol, members, changes, interval, latency, jitter,
+                                    loss):
+        t0 = time.time()
+        result = GroupSimulation(num_peers, num_chats, *params[1:], changed_by=changed_by,
+                                 protocol=params[0], messages=messages,
+                                 duplicate=duplicate, sync_interval=sync_interval,
+                                 seed=seed).run().report()
+        duration = time.time() - t0
+        print("%-8s %7d %7d %8.1f %7.2f %6.2f %6.3f | %8.1f%% %8.2f %8.2f %9d %8.1f %11.1f "
+              "%9.0f %7d %10.0f" % (
+                  params + (100.0 * result["converged"] / num_chats, result["settle_median"],
+                            result["settle_p90"], result["unsettled"],
+                            result["msgs_per_change"], result["entries_per_change"],
+                            result["bytes_per_change"], result["errors"],
+                            result["events"] / duration)))
+
+
+if __name__ == "__main__":
+    main()
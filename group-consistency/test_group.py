@@ -1,141 +1,8 @@
-
-import random
 import pytest
-from itertools import count
-
-_mcount = count()
-
-def message_id():
-    return "MsgId{}".format(next(_mcount))
-
-
-
-class Entry:
-    def __init__(self, message_id, addr, op, other_addr):
-        assert op in ("add", "del")
-        self.message_id = message_id
-        self.addr = addr
-        self.op = op
-        self.other_addr = other_addr
-
-    def __str__(self):
-        return "Entry: <{}> {} {} {}".format(self.message_id, self.addr, self.op.upper(), self.other_addr)
-    __repr__ = __str__
-
-class Peer:
-    def __init__(self, addr, mta):
-        self.addr = addr
-        self.mta = mta
-        self._chats = {}
-        self._known_message_ids = set()
-
-    def process_incoming(self, from_addr, message_id, chat_id, payload):
-        chat = self._chats.get(chat_id)
-        if chat is None:
-            chat = Chat(chat_id, mta=self.mta)
-            self._chats[chat_id] = chat
-            chat.add_contact(self.addr, self.addr)
-        chat.receive_log(payload)
-
-    def __eq__(self, other):
-        return self.addr == other.addr
-
-    def __ne__(self, other):
-        return self.addr != other.addr
-
-    def __hash__(self):
-        return hash(self.addr)
-
-    def __str__(self):
-        return "Contact<{}>".format(self.addr)
-
-    def __repr__(self):
-        return str(self)
-
-
-class Chat:
-    def __init__(self, chat_id, mta):
-        self.id = chat_id
-        self._known_message_ids = set()
-        self.mta = mta
-        self.log =[]
-
-    def __str__(self):
-        return "Chat{} len={}".format(self.id, len(self.members))
-
-    def __eq__(self, other):
-        return self.id == other.id
-
-    @property
-    def members(self):
-        members = []
-        for entry in self.log:
-            if entry.op == "add":
-                members.append(entry.other_addr)
-            elif entry.op == "del":
-                members.remove(entry.other_addr)
-        return members
-
-    @classmethod
-    def create_new(cls, chat_id, contact, mta):
-        chat = cls(chat_id, mta=mta)
-        # add ourself as first member
-        chat.add_contact(contact, contact)
-        return chat
-
-    def add_contact_and_send(self, contact, other_contact):
-        self.add_contact(contact, other_contact)
-        self.send_out_last_log()
-
-    def add_contact(self, contact, other_contact):
-        if other_contact in self.members:
-            raise ValueError("already a member {}".format(other_contact))
-        assert isinstance(contact, str) and isinstance(other_contact, str)
-        entry = Entry(message_id(), contact, "add", other_contact)
-        self.log.append(entry)
-
-    def remove_contact(self, contact, other_contact):
-        assert isinstance(contact, str) and isinstance(other_contact, str)
-        if other_contact not in self.members:
-            raise ValueError("{} not a member".format(other_contact))
-        entry = Entry(message_id(), contact, "del", other_contact)
-        self.log.append(entry)
-
-    def send_out_last_log(self):
-        to_addrs = self.members[1:]
-        self.mta.relay(from_addr=self.members[0], to_addrs=to_addrs, chat_id=self.id,
-                       payload=self.log[-10:])
-
-    def receive_log(self, log):
-        if random.random() > 1.8:
-            print("{}: failed randomly to receive log len={}".format(self, len(log)))
-            return
-        for entry in log:
-            if entry.message_id not in self._known_message_ids:
-                self._known_message_ids.add(entry.message_id)
-                if entry.other_addr != self.members[0]:
-                    self.log.append(entry)
-
-
-class MTA:
-    def __init__(self):
-        self.addr2peer = {}
-
-    def relay(self, from_addr, to_addrs, chat_id, payload):
-        mid = message_id()
-        for addr in to_addrs:
-            peer = self.addr2peer.setdefault(addr, Peer(addr, self))
-            print("relaying to {}: {}".format(addr, payload))
-            peer.process_incoming(from_addr, mid, chat_id, payload)
-
-    def ensure_consistent_member_lists(self, chat_id):
-        last = None
-        for addr, peer in self.addr2peer.items():
-            members = peer._chats[chat_id].members
-            if last is None:
-                last = members
-            else:
-                assert sorted(last) == sorted(members)
+
+from group import Chat, Entry, MTA
+from sim import GroupSimulation
+
 
 @pytest.fixture
 def mta():
@@ -161,3 +28,118 @@ def test_membership_basic(mta):
 
     mta.ensure_consistent_member_lists(10)
 
+
+def test_members_long_history(mta, monkeypatch):
+    monkeypatch.setattr(Chat, "checkpoint_interval", 4)
+    chat = Chat.create_new(10, "zero", mta=mta)
+    history = [["zero"]]
+    for i in range(10):
+        chat.add_contact("zero", "alice")
+        chat.add_contact("zero", "bob{}".format(i))
+        chat.remove_contact("zero", "alice")
+        history.extend([history[-1] + ["alice"], history[-1] + ["alice", "bob{}".format(i)],
+                        history[-1] + ["bob{}".format(i)]])
+    assert chat.members == history[-1]
+    assert chat.is_member("bob9") and not chat.is_member("alice")
+    for i, members in enumerate(history):
+        assert chat.members_at(i + 1) == members
+
+    chat.receive_log([Entry("unknown-del", "bob1", "del", "alice")])
+    with pytest.raises(ValueError):
+        chat.members
+    assert chat.members_at(len(history)) == history[-1]
+
+
+def test_simulation_converges_without_loss():
+    result = GroupSimulation(num_peers=50, num_chats=20, members=4, changes=3, interval=10,
+                             latency=1, jitter=0, loss=0, changed_by="creator").run().report()
+    assert result["converged"] == 20
+    assert result["unsettled"] == 0
+    assert result["settle_p90"] == pytest.approx(1.0)
+
+
+def test_simulation_loss():
+    sim = GroupSimulation(num_peers=50, num_chats=20, members=4, changes=0, interval=10,
+                          latency=1, jitter=0, loss=1.0).run()
+    result = sim.report()
+    assert result["converged"] == 0
+    # the creator sends each of its three adds to all members so far
+    assert result["lost"] == sim.mta.messages == 20 * (1 + 2 + 3)
+
+
+def test_orset_converges_out_of_order():
+    from orset import ORSetChat
+    chat = ORSetChat.create_new(10, "zero", mta=None)
+    chat.add_contact("zero", "alice")
+    chat.add_contact("zero", "bob")
+    chat.remove_contact("zero", "alice")
+    chat.add_contact("zero", "alice")
+    other = ORSetChat.joined(10, "bob", mta=None)
+    for entry in reversed(chat.log):
+        other.append_entry(entry)
+    assert not other.append_entry(chat.log[0])
+    assert sorted(other.members) == sorted(chat.members) == ["alice", "bob", "zero"]
+    assert other.clock == chat.clock == {"zero": 5}
+
+
+@pytest.mark.parametrize("loss", [0, 0.1])
+def test_simulation_orset(loss):
+    kwargs = dict(num_peers=50, num_chats=20, members=4, changes=5, interval=10,
+                  latency=1, jitter=2, loss=loss, messages=5)
+    window = GroupSimulation(protocol="window", **kwargs).run().report()
+    result = GroupSimulation(protocol="orset", **kwargs).run().report()
+    assert result["errors"] == 0
+    # sync() repairs what the lost messages missed
+    assert result["converged"] == 20
+    assert result["unsettled"] == 0
+    assert result["bytes_per_change"] < window["bytes_per_change"]
+
+
+def test_mta_queued_shares_payload_and_drops_duplicates():
+    mta = MTA(verbose=False, queued=True)
+    chat = Chat.create_new(10, "zero", mta=mta)
+    chat.add_contact("zero", "alice")
+    chat.add_contact("zero", "bob")
+    payload = chat.log[:]
+    mid = mta.relay("zero", ["alice", "bob"], 10, payload)
+    assert mta.queues["alice"][0][3] is mta.queues["bob"][0][3] is payload
+    assert "alice" not in mta.addr2peer
+    mta.relay("zero", ["alice"], 10, payload, mid=mid)
+    assert mta.flush() == 3
+    assert mta.duplicates == 1 and not mta.queues
+    assert mta.get_peer("alice")._chats[10].members == ["alice", "zero", "bob"]
+
+
+def test_simulation_duplicates():
+    kwargs = dict(num_peers=50, num_chats=10, members=4, changes=3, interval=10,
+                  latency=1, jitter=0, loss=0, changed_by="creator")
+    result = GroupSimulation(duplicate=0.5, **kwargs).run().report()
+    assert result["duplicates"] > 0
+    assert result["converged"] == 10
+    plain = GroupSimulation(**kwargs).run()
+    # without jitter a message is one event for all its recipients
+    assert plain.sim.events < plain.mta.messages
+
+
+def test_orset_sync_repairs_lost_message():
+    from orset import ORSetChat
+    mta = MTA(verbose=False, queued=True)
+    mta.chat_class = ORSetChat
+    chat = mta.get_peer("zero")._chats[10] = ORSetChat.create_new(10, "zero", mta=mta)
+    chat.add_contact_and_send("zero", "alice")
+    mta.flush()
+    alice = mta.get_peer("alice")._chats[10]
+    # the message about bob never reaches alice
+    chat.add_contact_and_send("zero", "bob")
+    del mta.queues["alice"]
+    mta.flush()
+    assert alice.members == ["alice", "zero"]
+    assert chat.sync()
+    mta.flush()
+    assert sorted(alice.members) == ["alice", "bob", "zero"]
+    # alice's request carried her clock from before the answer
+    assert chat.known["alice"] == {"zero": 2}
+    assert chat.sync()
+    mta.flush()
+    assert chat.known["alice"] == chat.known["bob"] == chat.clock
+    assert not chat.sync()
@@ -0,0 +1,219 @@
+"""
+Latency of the jobs of the imap thread under load.
+
+Jobs are submitted at random (Poisson) times at --rate per second for
+--duration seconds, in three classes:
+
+    urgent      user activity (send, delete), deadline 0
+    soon        e.g. marking a message seen, deadline --soon seconds
+    background  e.g. fetching a folder, no deadline, --keys different
+                keys so that they repeat
+
+Performing a job takes --job-time seconds on average, entering IDLE
+takes --idle-rtt seconds (the round-trip of the IDLE command) and IDLE
+ends after --idle-timeout seconds.  Compared are
+
+    queue       the original model of run.py: a FIFO drained with a 0.1s
+                get() timeout and an IDLE interrupted by every job
+    scheduler   scheduler.JobScheduler: priorities, coalescing, and IDLE
+                only interrupted by deadlines (--idle-rtt ahead)
+
+Reported are the submit-to-start latencies per class, the jobs performed,
+the IDLE commands and how many of them were interrupted, the share of
+the time spent in IDLE, and the "soon" jobs which started after their
+deadline:
+
+    python3 bench_jobs.py --rate 20 --duration 10
+"""
+
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+
+import click
+
+from scheduler import JobScheduler
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(list)   # key -> [(cls, submitted, deadline)]
+        self.latencies = defaultdict(list)
+        self.missed = 0
+        self.performed = 0
+
+    def submitted(self, key, cls, deadline):
+        now = time.time()
+        with self.lock:
+            self.pending[key].append((cls, now, None if deadline is None else now + deadline))
+
+    def started(self, key, one=False):
+        now = time.time()
+        with self.lock:
+            self.performed += 1
+            subs = self.pending[key]
+            served = subs[:1] if one else subs
+            self.pending[key] = subs[len(served):]
+        for cls, submitted, deadline in served:
+            self.latencies[cls].append(now - submitted)
+            if deadline is not None and deadline > submitted and now > deadline:
+                self.missed += 1
+
+
+class Workload(object):
+    def __init__(self, rate, duration, soon, keys, seed):
+        self.rate = rate
+        self.duration = duration
+        self.soon = soon
+        self.keys = keys
+        self.seed = seed
+
+    def jobs(self):
+        """ yield (delay, key, cls, priority, deadline) """
+        rng = random.Random(self.seed)
+        t = 0.0
+        i = 0
+        while True:
+            delay = rng.expovariate(self.rate)
+            t += delay
+            if t > self.duration:
+                return
+            i += 1
+            x = rng.random()
+            if x < 0.2:
+                yield delay, "user%d" % i, "urgent", 2, 0.0
+            elif x < 0.5:
+                yield delay, "seen%d" % i, "soon", 1, self.soon
+            else:
+                yield delay, "fetch%d" % rng.randrange(self.keys), "background", 0, None
+
+    def submit_all(self, submit):
+        for delay, key, cls, priority, deadline in self.jobs():
+            time.sleep(delay)
+            submit(key, cls, priority, deadline)
+
+
+def run_queue(workload, recorder, job_time, idle_rtt, idle_timeout):
+    jobs = queue.Queue()
+    e_interrupt_idle = threading.Event()
+    stop = threading.Event()
+    stats = dict(interrupts=0, idles=0, idle_time=0.0)
+    rng = random.Random(1)
+
+    def imap_thread():
+        while not stop.is_set():
+            while 1:
+                try:
+                    key = jobs.get(timeout=0.1)
+                except queue.Empty:
+                    break
+                recorder.started(key, one=True)
+                time.sleep(rng.expovariate(1.0 / job_time))
+            e_interrupt_idle.clear()
+            time.sleep(idle_rtt)
+            stats["idles"] += 1
+            t0 = time.time()
+            if e_interrupt_idle.wait(timeout=idle_timeout):
+                stats["interrupts"] += 1
+            stats["idle_time"] += time.time() - t0
+
+    def submit(key, cls, priority, deadline):
+        recorder.submitted(key, cls, deadline)
+        jobs.put(key)
+        e_interrupt_idle.set()
+
+    thread = threading.Thread(target=imap_thread)
+    thread.start()
+    stats["start"] = time.time()
+    workload.submit_all(submit)
+    while not jobs.empty():
+        time.sleep(0.01)
+    stats["end"] = time.time()
+    stop.set()
+    e_interrupt_idle.set()
+    thread.join()
+    return stats
+
+
+def run_scheduler(workload, recorder, job_time, idle_rtt, idle_timeout):
+    scheduler = JobScheduler(lead=idle_rtt)
+    stop = threading.Event()
+    stats = dict(interrupts=0, idles=0, idle_time=0.0)
+    rng = random.Random(1)
+
+    def imap_thread():
+        while not stop.is_set():
+            while 1:
+                job = scheduler.pop()
+                if job is None:
+                    break
+                recorder.started(job.key)
+                time.sleep(rng.expovariate(1.0 / job_time))
+            time.sleep(idle_rtt)
+            stats["idles"] += 1
+            t0 = time.time()
+            if scheduler.idle(idle_timeout) != "timeout":
+                stats["interrupts"] += 1
+            stats["idle_time"] += time.time() - t0
+
+    def submit(key, cls, priority, deadline):
+        recorder.submitted(key, cls, deadline)
+        scheduler.submit(key, priority, deadline)
+
+    thread = threading.Thread(target=imap_thread)
+    thread.start()
+    stats["start"] = time.time()
+    workload.submit_all(submit)
+    while len(scheduler):
+        time.sleep(0.01)
+    stats["end"] = time.time()
+    stop.set()
+    scheduler.interrupt()
+    thread.join()
+    return stats
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--rate", type=float, default=20, help="(default 20) jobs per second")
+@click.option("--duration", type=float, default=10, help="(default 10) seconds of submitting")
+@click.option("--soon", type=float, default=0.5,
+              help="(default 0.5) deadline of the 'soon' jobs in seconds")
+@click.option("--keys", type=int, default=5, help="(default 5) different background jobs")
+@click.option("--job-time", type=float, default=0.005,
+              help="(default 0.005) mean seconds to perform a job")
+@click.option("--idle-rtt", type=float, default=0.02,
+              help="(default 0.02) seconds to enter IDLE")
+@click.option("--idle-timeout", type=float, default=2.0,
+              help="(default 2) seconds after which IDLE ends")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(rate, duration, soon, keys, job_time, idle_rtt, idle_timeout, seed):
+    workload = Workload(rate, duration, soon, keys, seed)
+    print("%-10s %-10s | %6s %8s %8s %8s | %9s %6s %10s %6s %7s" % (
+          "mode", "class", "jobs", "p50", "p90", "p99", "performed", "idles", "interrupts",
+          "idle%", "missed"))
+    for mode, func in (("queue", run_queue), ("scheduler", run_scheduler)):
+        recorder = Recorder()
+        stats = func(workload, recorder, job_time, idle_rtt, idle_timeout)
+        for i, cls in enumerate(("urgent", "soon", "background")):
+            latencies = recorder.latencies[cls]
+            idle_share = 100.0 * stats["idle_time"] / (stats["end"] - stats["start"])
+            summary = ("| %9d %6d %10d %5.1f%% %7d" % (
+                recorder.performed, stats["idles"], stats["interrupts"], idle_share,
+                recorder.missed) if i == 0 else "|")
+            print("%-10s %-10s | %6d %8.3f %8.3f %8.3f %s" % (
+                  mode if i == 0 else "", cls, len(latencies), percentile(latencies, 0.5),
+                  percentile(latencies, 0.9), percentile(latencies, 0.99), summary))
+
+
+if __name__ == "__main__":
+    main()
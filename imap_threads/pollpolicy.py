@@ -0,0 +1 @@
+../move_imap/pollpolicy.py
\ No newline at end of file
@@ -3,9 +3,11 @@ from __future__ import print_function
 import threading
 import re
 import random
-import queue
 import time
 
+from pollpolicy import PollPolicy
+from scheduler import JobScheduler
+
 
 
 class AppState:
@@ -15,34 +17,40 @@ class AppState:
     # in "bg" and "fg" respectively
     FOREGROUND = True
 
-    # this event is used to signal that an ongoing imap_idle() call
-    # shall be interrupted which happens if there is user-generated
-    # activity (sending/deleting a message etc.)
-    e_interrupt_idle = threading.Event()
-
-
-    # we keep an imap_thread and a queue to communicate with it
+    # we keep an imap_thread and a scheduler to communicate with it.
+    # an ongoing imap_idle() call is interrupted through the scheduler
+    # when a job's deadline is reached, which for user-generated
+    # activity (sending/deleting a message etc.) is right away
     imap_thread = None
-    imap_queue = queue.Queue()
+    scheduler = JobScheduler()
+
+    # decides between IDLE and polling, and how often to poll.  the
+    # times are shortened for this demo
+    poll_policy = PollPolicy(foreground=True, now=time.time())
+    poll_policy.idle_timeout = 10
+    poll_policy.min_interval = 5
+    poll_policy.fg_max_interval = poll_policy.max_interval = 60
 
 
 
 def interrupt_idle():
     log("triggering interrupt_idle")
-    AppState.e_interrupt_idle.set()
+    AppState.scheduler.interrupt()
 
 
-def imap_idle():
-    AppState.e_interrupt_idle.clear()
+def imap_idle(timeout=10):
     log("***************** IMAP-IDLE BEGIN")
-    if AppState.e_interrupt_idle.wait(timeout=10):
-        log("IDLE INTERRUPTED")
+    reason = AppState.scheduler.idle(timeout=timeout)
+    if reason != "timeout":
+        log("IDLE INTERRUPTED", reason)
     log("***************** IMAP-IDLE FINISH")
 
 
 def imap_poll():
     """ poll for new messages in a non-blocking way (not long-running). """
     log("***************** IMAP-poll called (non-blocking)")
+    # this demo never finds new messages
+    AppState.poll_policy.observe(time.time(), 0)
 
 
 class ImapThread(threading.Thread):
@@ -56,8 +64,9 @@ class ImapThread(threading.Thread):
     def _run(self):
         while 1:
             perform_jobs()
-            if AppState.FOREGROUND:
-                imap_idle()
+            mode, seconds = AppState.poll_policy.next_wakeup(time.time())
+            if mode == "idle":
+                imap_idle(seconds)
             else:
                 imap_poll()
                 break
@@ -68,18 +77,19 @@ class ImapThread(threading.Thread):
 def perform_jobs():
     log("** perform_jobs: starting loop")
     while 1:
-        try:
-            x = AppState.imap_queue.get(timeout=0.1)
-        except queue.Empty:
+        job = AppState.scheduler.pop()
+        if job is None:
             break
-        else:
-            log("- processing job:", x)
+        log("- processing job:", job.key, "waited %.3f" % (job.started - job.submitted))
     log("** perform_jobs: finished loop")
 
 
 
 def on_receive():
-    if not AppState.imap_thread.is_alive():
+    mode, seconds = AppState.poll_policy.next_wakeup(time.time())
+    if mode == "poll" and seconds > 0:
+        log("next poll in %.1f seconds, doing nothing" % seconds)
+    elif not AppState.imap_thread.is_alive():
         log("no imap thread active: starting one")
         start_imap_thread()
     else:
@@ -99,14 +109,16 @@ def ui_thread():
         raw = raw_input()
         if raw == "bg":
             AppState.FOREGROUND = False
+            AppState.poll_policy.set_foreground(False)
             interrupt_idle()
         elif raw == "fg":
             AppState.FOREGROUND = True
+            AppState.poll_policy.set_foreground(True)
             on_receive()
         else:
-            # we simulate some imap related activity
-            AppState.imap_queue.put(raw)
-            interrupt_idle()
+            # we simulate some imap related activity, which is to
+            # be performed right away
+            AppState.scheduler.submit(raw, priority=1, deadline=0)
 
 
 
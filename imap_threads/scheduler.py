@@ -0,0 +1,150 @@
+"""
+Job scheduler for the imap thread of run.py.
+
+The imap thread alternates between performing the queued jobs and
+IMAP-IDLE.  With a plain queue every job interrupts IDLE, and draining
+the queue ends with a get() timeout.  JobScheduler instead orders the
+jobs by priority (higher first), then by deadline, then by submission,
+and
+
+- coalesces jobs: submitting a job whose key is already queued doesn't
+  queue it twice, the queued job keeps the higher priority and the
+  earlier deadline,
+
+- pop() returns right away, None if there is no job,
+
+- idle(timeout) blocks like IMAP-IDLE until the timeout, interrupt(),
+  or until the earliest deadline of a queued job is reached (lead
+  seconds before, to leave IDLE in time).  A job without a deadline
+  waits for the end of IDLE, one with deadline 0 interrupts it right
+  away.
+
+Every job records when it was submitted and started, for measuring the
+latency of the scheduling.
+"""
+
+import heapq
+import threading
+import time
+from itertools import count
+
+
+class Job(object):
+    def __init__(self, key, priority, deadline, payload, submitted):
+        self.key = key
+        self.priority = priority
+        self.deadline = deadline      # absolute time.time() or None
+        self.payload = payload
+        self.submitted = submitted
+        self.started = None
+        self.coalesced = 0            # submissions merged into this job
+
+    def __repr__(self):
+        return "<Job {} prio={} deadline={}>".format(self.key, self.priority, self.deadline)
+
+
+class JobScheduler(object):
+    def __init__(self, lead=0.0):
+        # idle() ends this many seconds before a deadline, the time it
+        # takes to leave IDLE
+        self.lead = lead
+        self._cond = threading.Condition()
+        self._seq = count()
+        self._jobs = {}            # key -> queued Job
+        self._queue = []           # (-priority, deadline, seq, job), outdated ones skipped
+        self._deadlines = []       # (deadline, seq, job), outdated ones skipped
+        self._interrupted = False
+        self.stats = dict(submitted=0, coalesced=0, interrupts=0, deadline_interrupts=0)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, key, priority=0, deadline=None, payload=None):
+        """ queue a job (or merge it into the queued one with the same key)
+
+        deadline is in seconds from now, the job should start before.
+        """
+        now = time.time()
+        if deadline is not None:
+            deadline = now + deadline
+        with self._cond:
+            self.stats["submitted"] += 1
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = Job(key, priority, deadline, payload, now)
+            else:
+                self.stats["coalesced"] += 1
+                job.coalesced += 1
+                if payload is not None:
+                    job.payload = payload
+                if priority <= job.priority and (deadline is None or (
+                        job.deadline is not None and job.deadline <= deadline)):
+                    return job
+                job.priority = max(priority, job.priority)
+                if deadline is not None and (job.deadline is None or deadline < job.deadline):
+                    job.deadline = deadline
+            seq = next(self._seq)
+            heapq.heappush(self._queue, (-job.priority, _inf(job.deadline), seq, job))
+            if job.deadline is not None:
+                heapq.heappush(self._deadlines, (job.deadline, seq, job))
+                if job.deadline == self._deadlines[0][0]:
+                    self._cond.notify_all()
+            return job
+
+    def _current(self, job, priority, deadline):
+        return (self._jobs.get(job.key) is job and job.priority == priority and
+                _inf(job.deadline) == deadline)
+
+    def pop(self):
+        """ return the next job to perform, None if there is none """
+        with self._cond:
+            queue = self._queue
+            while queue:
+                priority, deadline, seq, job = heapq.heappop(queue)
+                if self._current(job, -priority, deadline):
+                    del self._jobs[job.key]
+                    job.started = time.time()
+                    return job
+            return None
+
+    def next_deadline(self):
+        """ the earliest deadline of the queued jobs, None if no job has one """
+        with self._cond:
+            deadlines = self._deadlines
+            while deadlines:
+                deadline, seq, job = deadlines[0]
+                if self._jobs.get(job.key) is job and job.deadline == deadline:
+                    return deadline
+                heapq.heappop(deadlines)
+            return None
+
+    def interrupt(self):
+        """ end the current (or next) idle() call """
+        with self._cond:
+            self._interrupted = True
+            self._cond.notify_all()
+
+    def idle(self, timeout):
+        """ block for up to timeout seconds, return why idle ended:
+        "timeout", "interrupt" or "deadline" """
+        end = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._interrupted:
+                    self._interrupted = False
+                    self.stats["interrupts"] += 1
+                    return "interrupt"
+                now = time.time()
+                deadline = self.next_deadline()
+                if deadline is not None:
+                    deadline -= self.lead
+                if deadline is not None and deadline <= now:
+                    self.stats["deadline_interrupts"] += 1
+                    return "deadline"
+                if now >= end:
+                    return "timeout"
+                self._cond.wait(min(end, _inf(deadline)) - now)
+
+
+def _inf(deadline):
+    return float("inf") if deadline is None else deadline
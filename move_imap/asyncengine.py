@@ -0,0 +1,521 @@
+"""
+Asyncio engine for the mover.
+
+The threaded engine runs one OS thread with a blocking IMAPClient per
+folder.  Here every folder of every account is a task on one event loop,
+talking IMAP through AsyncIMAPClient, a small asyncio client for the
+commands ImapConn needs (LOGIN, CAPABILITY, ENABLE, SELECT, CREATE,
+UID FETCH, UID MOVE, IDLE, and STATUS, NOTIFY and NOOP for
+multifolder.py).  FETCH responses are parsed with IMAPClient's response
+parser, so AsyncImapConn sees the same data as the threaded ImapConn and
+shares all of its message processing.
+"""
+
+import asyncio
+import itertools
+import re
+import time
+
+from imapclient.exceptions import IMAPClientError, IMAPClientAbortError
+from imapclient.response_parser import parse_fetch_response
+
+from connection import ConnectionManager
+from movequeue import compress_uids
+from move_imap import ImapConn, INBOX, SENT, MVBOX, FETCH_FIELDS, CONNECTION_ERRORS
+
+LITERAL_RE = re.compile(br"\{(\d+)\}\r\n$")
+UNTAGGED_RE = re.compile(br"\* (?:(\d+) )?([A-Za-z-]+)(?: (.*))?$", re.S)
+STATUS_RE = re.compile(br'(?:"((?:[^"\\]|\\.)*)"|(\S+)) \(([^)]*)\)$')
+
+# readexactly() raises IncompleteReadError, an EOFError, on closed connections
+ASYNC_CONNECTION_ERRORS = CONNECTION_ERRORS + (EOFError,)
+
+
+def quote(s):
+    return '"%s"' % s.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parse_status(data):
+    """ return (folder name, {item: number}) of a STATUS response like
+    b'"Sent" (UIDNEXT 5 MESSAGES 3)' """
+    m = STATUS_RE.match(data.strip())
+    if m is None:
+        return None, {}
+    quoted, atom, items = m.groups()
+    name = re.sub(br"\\(.)", br"\1", quoted) if quoted is not None else atom
+    items = items.split()
+    return name.decode("utf8"), dict((items[i].upper(), int(items[i + 1]))
+                                     for i in range(0, len(items) - 1, 2))
+
+
+def join_uids(messages):
+    if isinstance(messages, (str, int)):
+        return str(messages)
+    return ",".join(str(uid) for uid in messages)
+
+
+class AsyncIMAPClient(object):
+    def __init__(self, host, port=993, ssl_context=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        # seconds to wait for the completion of a command
+        self.timeout = timeout
+        self.writer = None
+        self.welcome = None
+        self._tags = itertools.count(1)
+        self._idle_tag = None
+        self._capabilities = None
+        # extensions the server confirmed with ENABLED
+        self.enabled = set()
+        # data of VANISHED responses, which may arrive with any command
+        self._vanished = []
+        # data of STATUS responses, asked for or sent because of NOTIFY
+        self._statuses = []
+        # whether the server reported new messages outside of IDLE
+        self.exists_seen = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context)
+        self.welcome = (await asyncio.wait_for(self._read_response(), self.timeout))[0]
+
+    def ssl_object(self):
+        return self.writer.get_extra_info("ssl_object")
+
+    async def _send(self, line):
+        self.writer.write(line.encode("utf8") + b"\r\n")
+        await self.writer.drain()
+
+    async def _read_response(self):
+        """ read one response and return it as a list of items in the format
+        of imaplib: lines with a literal become (line, literal) tuples. """
+        items = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise IMAPClientError("connection to %s closed" % (self.host,))
+            m = LITERAL_RE.search(line)
+            if m is None:
+                items.append(line.rstrip(b"\r\n"))
+                return items
+            literal = await self.reader.readexactly(int(m.group(1)))
+            items.append((line.rstrip(b"\r\n"), literal))
+
+    def _untagged(self, items):
+        """ return (type, items) with the '* [num] TYPE' prefix stripped like imaplib """
+        first = items[0][0] if isinstance(items[0], tuple) else items[0]
+        m = UNTAGGED_RE.match(first)
+        if m is None:
+            return None, items
+        num, typ, rest = m.groups()
+        data = b" ".join(x for x in (num, rest) if x is not None)
+        if isinstance(items[0], tuple):
+            items = [(data, items[0][1])] + items[1:]
+        else:
+            items = [data] + items[1:]
+        return typ.upper(), items
+
+    async def _command(self, *args):
+        """ run a command and return its untagged responses as (type, items) """
+        tag = "A%04d" % next(self._tags)
+        await self._send("%s %s" % (tag, " ".join(args)))
+        return await asyncio.wait_for(self._wait_tagged(tag, args[0]), self.timeout)
+
+    async def _wait_tagged(self, tag, name):
+        untagged = []
+        btag = tag.encode("ascii") + b" "
+        while True:
+            items = await self._read_response()
+            first = items[0][0] if isinstance(items[0], tuple) else items[0]
+            if first.startswith(btag):
+                status, _, text = first[len(btag):].partition(b" ")
+                if status.upper() != b"OK":
+                    raise IMAPClientError("%s failed: %s" % (name, text.decode("utf8", "replace")))
+                return untagged
+            if first.startswith(b"* "):
+                typ, items = self._untagged(items)
+                if typ == b"VANISHED":
+                    self._vanished.append(items[0])
+                elif typ == b"STATUS":
+                    self._statuses.append(items[0])
+                elif typ == b"EXISTS":
+                    self.exists_seen = True
+                untagged.append((typ, items))
+
+    async def login(self, user, password):
+        await self._command("LOGIN", quote(user), quote(password))
+
+    async def capabilities(self):
+        if self._capabilities is None:
+            for typ, items in await self._command("CAPABILITY"):
+                if typ == b"CAPABILITY":
+                    self._capabilities = tuple(items[0].upper().split())
+        return self._capabilities
+
+    async def has_capability(self, capability):
+        return capability.upper().encode("ascii") in await self.capabilities()
+
+    async def enable(self, *capabilities):
+        enabled = []
+        names = " ".join(c.decode("ascii") if isinstance(c, bytes) else c for c in capabilities)
+        for typ, items in await self._command("ENABLE", names):
+            if typ == b"ENABLED":
+                enabled.extend(items[0].upper().split())
+        self.enabled.update(enabled)
+        return enabled
+
+    def pop_vanished(self):
+        vanished, self._vanished = self._vanished, []
+        return vanished
+
+    def pop_statuses(self):
+        statuses, self._statuses = self._statuses, []
+        return statuses
+
+    async def select_folder(self, folder, readonly=False):
+        info = {}
+        for typ, items in await self._command("EXAMINE" if readonly else "SELECT", quote(folder)):
+            if typ in (b"EXISTS", b"RECENT"):
+                info[typ] = int(items[0])
+            elif typ == b"OK":
+                m = re.match(br"\[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]", items[0])
+                if m:
+                    info[m.group(1)] = int(m.group(2))
+        return info
+
+    async def create_folder(self, folder):
+        await self._command("CREATE", quote(folder))
+
+    async def status(self, folder, items=(b"UIDNEXT", b"MESSAGES")):
+        """ return the STATUS of a folder like {b'UIDNEXT': 5, b'MESSAGES': 3},
+        the response is also kept for pop_statuses() """
+        names = " ".join(item.decode("ascii") for item in items)
+        for typ, data in await self._command("STATUS", quote(folder), "(%s)" % names):
+            if typ == b"STATUS":
+                name, status = parse_status(data[0])
+                if name == folder:
+                    return status
+        return {}
+
+    async def notify(self, *args):
+        await self._command("NOTIFY", *args)
+
+    async def noop(self):
+        await self._command("NOOP")
+
+    async def fetch(self, messages, data, modifiers=None):
+        fields = " ".join(field.decode("ascii").upper() for field in data)
+        args = ["UID", "FETCH", join_uids(messages), "(%s)" % fields]
+        if modifiers:
+            args.append("(%s)" % " ".join(modifiers).upper())
+        untagged = await self._command(*args)
+        text = []
+        for typ, items in untagged:
+            if typ == b"FETCH":
+                text.extend(items)
+        return parse_fetch_response(text, True, True)
+
+    async def move(self, messages, folder):
+        await self._command("UID", "MOVE", join_uids(messages), quote(folder))
+
+    async def idle(self):
+        self._idle_tag = "A%04d" % next(self._tags)
+        await self._send("%s IDLE" % (self._idle_tag,))
+        while True:
+            items = await self._read_response()
+            if items[0].startswith(b"+"):
+                return
+
+    async def idle_check(self, timeout=None):
+        """ wait up to timeout seconds for an untagged response during IDLE
+        and return responses like IMAPClient, e.g. [(5, b'EXISTS')] """
+        try:
+            items = await asyncio.wait_for(self._read_response(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        typ, items = self._untagged(items)
+        if typ is None:
+            return []
+        data = items[0] if isinstance(items[0], bytes) else items[0][0]
+        if typ == b"VANISHED":
+            self._vanished.append(data)
+        elif typ == b"STATUS":
+            self._statuses.append(data)
+        num = data.split(b" ", 1)[0]
+        return [(int(num), typ) if num.isdigit() else (typ, data)]
+
+    async def idle_done(self):
+        await self._send("DONE")
+        tag, self._idle_tag = self._idle_tag, None
+        return await asyncio.wait_for(self._wait_tagged(tag, "IDLE"), self.timeout)
+
+    async def logout(self):
+        try:
+            await self._command("LOGOUT")
+        except IMAPClientError:
+            pass
+        self.writer.close()
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class AsyncImapConn(ImapConn):
+    """ ImapConn whose IMAP commands run as coroutines on an event loop. """
+
+    # AsyncIMAPClient collects the VANISHED responses itself
+    client_reports_vanished = True
+
+    def __init__(self, store, foldername, conn_info, connmanager=None):
+        ImapConn.__init__(self, store, foldername, conn_info, connmanager)
+        self.event_initial_polling_complete = asyncio.Event()
+
+    async def connect(self):
+        with self.wlog("IMAP_CONNECT {}: {}".format(self.MUSER, self.MPASSWORD), "connect"):
+            capabilities = await self.open_connection()
+            await self.select()
+            self.log('capabilities', capabilities)
+
+    async def open_connection(self):
+        """ connect and log in, return the capabilities of the server """
+        t0 = time.time()
+        self.conn = AsyncIMAPClient(self.MHOST, self.port or (993 if self.use_ssl else 143),
+                                    ssl_context=self.connmanager.ssl_context,
+                                    timeout=self.socket_timeout)
+        await self.conn.connect()
+        await self.conn.login(self.MUSER, self.MPASSWORD)
+        self.connmanager.connected(self.foldername, time.time() - t0,
+                                   self.conn.ssl_object() if self.use_ssl else None)
+        self.log(self.conn.welcome)
+        capabilities = await self.conn.capabilities()
+        self.check_capabilities(capabilities)
+        if self.want_qresync(capabilities):
+            self.qresync = b"QRESYNC" in await self.conn.enable(b"QRESYNC")
+        return capabilities
+
+    async def use_connection(self, conn):
+        """ take over a logged-in connection of the same account """
+        self.conn = conn
+        self.check_capabilities(await conn.capabilities())
+        self.qresync = b"QRESYNC" in conn.enabled
+
+    async def select(self):
+        """ select our folder, creating it if it doesn't exist """
+        try:
+            self.select_info = await self.conn.select_folder(self.foldername)
+        except IMAPClientError:
+            await self.ensure_folder_exists()
+            self.select_info = await self.conn.select_folder(self.foldername)
+        self.log('folder has %d messages' % self.select_info[b'EXISTS'])
+        self.check_select_info()
+
+    async def connect_with_backoff(self):
+        while True:
+            delay = self.connmanager.delay(self.foldername)
+            if delay:
+                self.log("connecting in %.1f secs" % (delay,))
+                await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                return
+            except ASYNC_CONNECTION_ERRORS as e:
+                self.connection_failed("connect failed:", e)
+
+    async def ensure_folder_exists(self):
+        with self.wlog("ensure_folder_exists: {}".format(self.foldername)):
+            try:
+                await self.conn.create_folder(self.foldername)
+            except IMAPClientError as e:
+                if "ALREADYEXISTS" in str(e):
+                    return
+                print("EXCEPTION:" + str(e))
+
+    async def move(self, uids):
+        uidset = compress_uids(uids)
+        self.log("IMAP_MOVE to {}: {}".format(MVBOX, uidset))
+        try:
+            with self.timed("move"):
+                await self.conn.move(uidset, MVBOX)
+        except IMAPClientAbortError:
+            raise
+        except IMAPClientError as e:
+            self.log("IMAP_MOVE {} failed: {}".format(uidset, e))
+            return e
+        self.log("IMAP_MOVE {} successfully completed.".format(uidset))
+
+    async def perform_imap_idle(self, timeout=None):
+        if self.movequeue.due():
+            self.log("perform_imap_idle skipped because moves are due")
+            return True
+        if self.conn.exists_seen:
+            # the server won't report these messages again in IDLE
+            self.log("perform_imap_idle skipped because new messages arrived")
+            return True
+        with self.wlog("IMAP_IDLE()", "idle"):
+            await self.conn.idle()
+            deadline = None if timeout is None else time.time() + timeout
+            interrupted = False
+            while not interrupted:
+                wait = self.idle_wait(deadline)
+                if wait <= 0:
+                    break
+                responses = await self.conn.idle_check(timeout=wait)
+                self.log("Server sent:", responses if responses else "nothing")
+                for resp in responses:
+                    if resp[1] == b"EXISTS":
+                        interrupted = True
+            await self.conn.idle_done()
+        return interrupted
+
+    async def wait_for_messages(self):
+        if self.policy is None:
+            return await self.perform_imap_idle()
+        mode, seconds = self.next_wait()
+        if mode == "idle":
+            return await self.perform_imap_idle(timeout=seconds)
+        seconds = self.poll_wait_time(seconds)
+        if seconds > 0:
+            with self.wlog("POLL_WAIT %.0f secs" % (seconds,), "poll_wait"):
+                await asyncio.sleep(seconds)
+        return False
+
+    async def perform_imap_fetch(self):
+        self.conn.exists_seen = False
+        if self.folder_unchanged():
+            self.log("HIGHESTMODSEQ %s unchanged since last sync, nothing to fetch" % (
+                     self.select_modseq,))
+            self.fetch_done()
+            return
+        range = "%s:*" % (self.last_sync_uid + 1,)
+        with self.wlog("IMAP_PERFORM_FETCH %s" % (range,)):
+            vanished_args = self.vanished_fetch_args()
+            if vanished_args is not None:
+                await self.conn.fetch(vanished_args[0], [b"UID"], modifiers=vanished_args[1])
+            with self.timed("fetch_list"):
+                sizes = await self.conn.fetch(range, [b"RFC822.SIZE"])
+            chunks = list(self.iter_new_uid_chunks(sizes))
+            if 1 < self.sync_connections < len(chunks):
+                await self.fetch_chunks_parallel(chunks)
+            else:
+                for chunk in chunks:
+                    with self.timed("fetch_headers"):
+                        resp = await self.conn.fetch(chunk, FETCH_FIELDS)
+                    self.process_fetch_chunk(resp)
+                    await self.sync_store()
+                    await self.perform_imap_jobs()
+            self.process_vanished(self.pop_vanished())
+
+        self.log("last-sync-uid after fetch:", self.last_sync_uid)
+        self.fetch_done()
+        await self.sync_store()
+
+    async def open_fetch_connection(self):
+        conn = AsyncIMAPClient(self.MHOST, self.port or (993 if self.use_ssl else 143),
+                               ssl_context=self.connmanager.ssl_context,
+                               timeout=self.socket_timeout)
+        await conn.connect()
+        await conn.login(self.MUSER, self.MPASSWORD)
+        select_info = await conn.select_folder(self.foldername, readonly=True)
+        if select_info.get(b"UIDVALIDITY", 0) != self.uidvalidity:
+            await conn.logout()
+            raise IMAPClientAbortError("UIDVALIDITY of %s changed" % (self.foldername,))
+        return conn
+
+    async def fetch_chunks_parallel(self, chunks):
+        num = min(self.sync_connections, len(chunks))
+        window = 2 * num
+        conns = asyncio.Queue()
+        opened = []
+
+        async def open_conn():
+            conn = await self.open_fetch_connection()
+            opened.append(conn)
+            conns.put_nowait(conn)
+
+        async def fetch(chunk):
+            conn = await conns.get()
+            try:
+                with self.timed("fetch_headers"):
+                    return await conn.fetch(chunk, FETCH_FIELDS)
+            finally:
+                conns.put_nowait(conn)
+
+        tasks = {}
+        opening = [asyncio.ensure_future(open_conn()) for _ in range(num)]
+        with self.wlog("parallel fetch of %d chunks over %d connections" % (len(chunks), num)):
+            try:
+                await asyncio.gather(*opening)
+                for i in range(len(chunks)):
+                    for j in range(i, min(i + window, len(chunks))):
+                        if j not in tasks:
+                            tasks[j] = asyncio.ensure_future(fetch(chunks[j]))
+                    self.process_fetch_chunk(await tasks.pop(i))
+                    await self.sync_store()
+                    await self.perform_imap_jobs()
+            finally:
+                pending = opening + list(tasks.values())
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                for conn in opened:
+                    try:
+                        await conn.logout()
+                    except ASYNC_CONNECTION_ERRORS:
+                        pass
+
+    async def sync_store(self):
+        """ ImapConn.sync_store() on the loop: the other folders change the
+        store meanwhile, which a worker thread couldn't write consistently """
+        ImapConn.sync_store(self)
+
+    def pop_vanished(self):
+        return self.conn.pop_vanished()
+
+    async def evict_old_threads(self):
+        """ ImapConn.evict_old_threads() on the loop, like sync_store() """
+        ImapConn.evict_old_threads(self)
+
+    async def perform_imap_jobs(self):
+        if not self.movequeue.due():
+            return
+        with self.wlog("perform_imap_jobs()"):
+            for batch in self.movequeue.batches():
+                error = await self.move(batch)
+                if error is not None and len(batch) > 1:
+                    for uid in batch:
+                        self.finish_move([uid], await self.move([uid]))
+                else:
+                    self.finish_move(batch, error)
+
+    async def run(self, mvbox=None):
+        await self.connect_with_backoff()
+        if mvbox is not None and self.foldername == INBOX:
+            # INBOX loop should wait until MVBOX polled once
+            await mvbox.event_initial_polling_complete.wait()
+        while True:
+            try:
+                await self.perform_imap_jobs()
+                await self.perform_imap_fetch()
+                if self.foldername == MVBOX:
+                    # signal that MVBOX has polled once
+                    self.event_initial_polling_complete.set()
+                elif self.foldername == INBOX:
+                    self.forget_about_too_old_pending_messages()
+                    await self.evict_old_threads()
+                self.connmanager.healthy(self.foldername)
+                await self.wait_for_messages()
+            except ASYNC_CONNECTION_ERRORS as e:
+                self.connection_failed("connection lost, reconnecting:", e)
+                await self.connect_with_backoff()
+
+
+async def run_account(store, conn_info, pendingtimeout):
+    """ watch INBOX, Sent and DeltaChat of one account until cancelled """
+    connmanager = ConnectionManager(conn_info[0], AsyncImapConn.use_ssl)
+    mvbox = AsyncImapConn(store, MVBOX, conn_info, connmanager)
+    inbox = AsyncImapConn(store, INBOX, conn_info, connmanager)
+    inbox.pendingtimeout = pendingtimeout
+    sent = AsyncImapConn(store, SENT, conn_info, connmanager)
+    await asyncio.gather(mvbox.run(), inbox.run(mvbox), sent.run())
@@ -0,0 +1,276 @@
+"""
+End-to-end throughput benchmark of the mover against the fake IMAP server.
+
+The fake server runs in a child process, which floods its INBOX with
+synthetic threads built with gen_mail_msg: Delta Chat threads (which are
+to be moved to DeltaChat) and classic email threads (which stay).  With
+--out-of-order a fraction of the replies arrives before their parent.
+The mover (one account, INBOX/Sent/DeltaChat) runs in this process, so
+its memory growth is measured without the server's copy of the messages.
+
+Reported are messages/sec (until the last Delta Chat message was moved),
+the latency from a message's arrival to its MOVE, memory growth, the
+time spent in store.sync() and the mover's per-phase timings.  With
+--single-connection the folders are watched over one connection (see
+multifolder.py), with --notify the server offers NOTIFY for that.
+
+    python3 bench_e2e.py --threads 1000 --thread-length 5 --out-of-order 0.2
+    python3 bench_e2e.py --threads 200 --rate 400 --single-connection --notify
+"""
+
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import click
+
+import move_imap
+from move_imap import ImapConn, INBOX, SENT, MVBOX, make_store
+from fakeimap import FakeImapServer
+from metrics import METRICS
+from send_unordered_message import gen_mail_msg
+
+MESSAGE_ID_RE = re.compile(br"^Message-ID:\s*(\S+)", re.I | re.M)
+
+
+class BenchServer(FakeImapServer):
+    def __init__(self, *args, **kwargs):
+        FakeImapServer.__init__(self, *args, **kwargs)
+        self.moved_at = {}
+
+    def on_move(self, foldername, destname, raw):
+        if destname == MVBOX:
+            self.moved_at[MESSAGE_ID_RE.search(raw).group(1)] = time.time()
+
+
+def gen_threads(num_threads, thread_length, dc_ratio, out_of_order):
+    """ return the raw messages in arrival order and the message-ids
+    which should end up in the DeltaChat folder """
+    messages = []
+    to_move = set()
+    for i in range(num_threads):
+        dc = random.random() < dc_ratio
+        thread = []
+        parent = None
+        for j in range(thread_length):
+            msg = gen_mail_msg(From="alice@example.org", To=["bob@example.org"],
+                               Subject="thread%d msg%d" % (i, j), replying=parent, dc=dc)
+            parent = msg["Message-ID"]
+            raw = msg.as_bytes()
+            thread.append(raw)
+            if dc:
+                to_move.add(MESSAGE_ID_RE.search(raw).group(1))
+        for j in range(1, thread_length):
+            # the reply overtakes its parent
+            if random.random() < out_of_order:
+                thread[j - 1], thread[j] = thread[j], thread[j - 1]
+        messages.append(thread)
+    # interleave the threads like concurrent conversations
+    arrival = []
+    while messages:
+        thread = random.choice(messages)
+        arrival.append(thread.pop(0))
+        if not thread:
+            messages.remove(thread)
+    return arrival, to_move
+
+
+def serve(pipe, latency, rate, messages, notify=False):
+    """ child process: run the server, append the messages on "go"
+    and answer "moved" and "report" requests """
+    server = BenchServer(latency=latency, notify=notify).start()
+    server.create_folder(SENT)
+    pipe.send(server.port)
+    arrived_at = {}
+
+    def flood():
+        for raw in messages:
+            arrived_at[MESSAGE_ID_RE.search(raw).group(1)] = time.time()
+            server.append(INBOX, raw)
+            if rate:
+                time.sleep(1.0 / rate)
+
+    while True:
+        cmd = pipe.recv()
+        if cmd == "go":
+            threading.Thread(target=flood, daemon=True).start()
+        elif cmd == "moved":
+            pipe.send(len(server.moved_at))
+        elif cmd == "report":
+            pipe.send((arrived_at, server.moved_at, dict(server.stats)))
+            server.stop()
+            return
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def start_mover(engine, store, conn_info, pendingtimeout, single_connection=False):
+    """ run the mover in background threads and return a function stopping
+    it and the list of exceptions its threads (or task) died with """
+    errors = []
+    if engine == "asyncio":
+        if single_connection:
+            from multifolder import run_account
+        else:
+            from asyncengine import run_account
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(run_account(store, conn_info, pendingtimeout))
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            except BaseException as e:
+                errors.append(e)
+                traceback.print_exc()
+
+        threading.Thread(target=run, daemon=True).start()
+        return lambda: loop.call_soon_threadsafe(task.cancel), errors
+    move_imap.mvbox = ImapConn(store, MVBOX, conn_info)
+    inbox = ImapConn(store, INBOX, conn_info, move_imap.mvbox.connmanager)
+    inbox.pendingtimeout = pendingtimeout
+    sent = ImapConn(store, SENT, conn_info, move_imap.mvbox.connmanager)
+
+    def run(imapconn):
+        try:
+            imapconn._run_in_thread()
+        except BaseException as e:
+            errors.append(e)
+            raise
+
+    for imapconn in (move_imap.mvbox, inbox, sent):
+        threading.Thread(target=run, args=(imapconn,), daemon=True).start()
+    # daemon threads end with the process
+    return lambda: None, errors
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--threads", "num_threads", type=int, default=500,
+              help="(default 500) number of threads")
+@click.option("--thread-length", type=int, default=4, help="(default 4) messages per thread")
+@click.option("--dc-ratio", type=float, default=0.8,
+              help="(default 0.8) fraction of Delta Chat threads")
+@click.option("--out-of-order", type=float, default=0.2,
+              help="(default 0.2) probability of a reply arriving before its parent")
+@click.option("--rate", type=float, default=0,
+              help="messages per second arriving in INBOX (default: as fast as possible)")
+@click.option("--latency", type=float, default=0.0,
+              help="(default 0) seconds the server waits before answering a command")
+@click.option("--engine", type=click.Choice(["asyncio", "threads"]), default="asyncio")
+@click.option("--single-connection", is_flag=True, default=False,
+              help="watch all folders over one connection (asyncio engine only)")
+@click.option("--notify", is_flag=True, default=False,
+              help="let the server advertise NOTIFY")
+@click.option("--storage", type=click.Choice(["journal", "pickle", "sqlite"]), default="journal")
+@click.option("--timeout", type=float, default=300,
+              help="(default 300) give up waiting for the moves after this many seconds")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(num_threads, thread_length, dc_ratio, out_of_order, rate, latency, engine,
+         single_connection, notify, storage, timeout, seed):
+    random.seed(seed)
+    messages, to_move = gen_threads(num_threads, thread_length, dc_ratio, out_of_order)
+
+    pipe, child_pipe = multiprocessing.Pipe()
+    child = multiprocessing.get_context("fork").Process(
+        target=serve, args=(child_pipe, latency, rate, messages, notify))
+    child.start()
+    port = pipe.recv()
+
+    ImapConn.port = port
+    ImapConn.use_ssl = False
+    store = make_store(storage, os.path.join(tempfile.mkdtemp(), "bench"))
+    sync_times = []
+    store_sync = store.sync
+
+    def timed_sync():
+        t0 = time.time()
+        store_sync()
+        sync_times.append(time.time() - t0)
+    store.sync = timed_sync
+
+    ImapConn.verbose = False
+    # no other output than the report
+    out = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    def report(line):
+        out.write(line + "\n")
+
+    rss_before = rss_kb()
+    stop, errors = start_mover(engine, store, ("127.0.0.1", "user", "password"), 3600,
+                               single_connection)
+    # let the mover connect and poll the empty folders once
+    time.sleep(0.5)
+    t0 = time.time()
+    pipe.send("go")
+    moved = 0
+    while time.time() - t0 < timeout:
+        pipe.send("moved")
+        moved = pipe.recv()
+        if moved >= len(to_move) or errors:
+            break
+        time.sleep(0.05)
+    duration = time.time() - t0
+    if errors:
+        # the tracebacks went to stderr
+        report("ERROR: the mover died after %.2f secs with %r" % (duration, errors[0]))
+        child.terminate()
+        os._exit(1)
+    stop()
+    rss_after = rss_kb()
+    pipe.send("report")
+    arrived_at, moved_at, stats = pipe.recv()
+    child.join()
+
+    latencies = [moved_at[mid] - arrived_at[mid] for mid in moved_at]
+    wrong = set(moved_at) - to_move
+    report("%d messages in %d threads (%d to move), %s engine%s, %s storage" % (
+           len(messages), num_threads, len(to_move), engine,
+           " (single connection)" if single_connection else "", storage))
+    if moved < len(to_move):
+        report("TIMEOUT: only %d of %d messages were moved" % (moved, len(to_move)))
+    if wrong:
+        report("ERROR: %d messages were moved which should stay" % len(wrong))
+    report("throughput:   %8.0f msgs/sec (%.2f secs)" % (len(messages) / duration, duration))
+    report("move latency: %8.3f secs median, %.3f p90, %.3f max" % (
+           percentile(latencies, 0.5), percentile(latencies, 0.9), max(latencies or [0])))
+    report("memory:       %8.1f MB rss growth, %.1f MB peak rss, %.2f KB per message" % (
+           (rss_after - rss_before) / 1024.0,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+           (rss_after - rss_before) / float(len(messages))))
+    report("db sync:      %8.3f secs total in %d syncs, %.1f ms max" % (
+           sum(sync_times), len(sync_times), max(sync_times or [0]) * 1000))
+    report("imap:         %s" % ", ".join("%s=%d" % item for item in sorted(stats.items())))
+    phases = {}
+    for (account, folder, phase), histogram in METRICS.histograms.items():
+        count, total = phases.get(phase, (0, 0.0))
+        phases[phase] = (count + histogram.count, total + histogram.total)
+    report("phases:       %s" % ", ".join(
+           "%s=%dx%.1fms" % (phase, count, total * 1000 / count)
+           for phase, (count, total) in sorted(phases.items())))
+    out.flush()
+    # the threads engine can't be stopped
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark the initial fetch of a folder against the local fake IMAP server.
+
+"per-message" replays what perform_imap_fetch used to do (one header
+FETCH for the whole range, then one body FETCH per new message),
+"chunked" runs ImapConn.perform_imap_fetch with the given chunk limits,
+"parallel" does the same fetching the chunks over --sync-connections
+connections.  Each mode starts with a fresh server and INBOX, and each
+command is delayed by --latency seconds to emulate the network.
+
+    python3 bench_fetch.py --messages 5000 --latency 0.002
+    python3 bench_fetch.py --messages 20000 --latency 0.05 --modes chunked,parallel
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import click
+from imapclient import IMAPClient
+
+from fakeimap import FakeImapServer
+from move_imap import ImapConn, INBOX, MVBOX, FETCH_FIELDS
+from messagestore import DictMessageStore
+from persistentdict import PersistentDict
+from send_unordered_message import gen_mail_msg
+
+
+def gen_messages(num_messages, thread_length=5):
+    messages = []
+    parent = None
+    for i in range(num_messages):
+        if i % thread_length == 0:
+            parent = None
+        msg = gen_mail_msg(From="alice@example.org", To=["bob@example.org"],
+                           Subject="msg%d" % i, replying=parent)
+        parent = msg["Message-ID"]
+        messages.append(msg.as_bytes())
+    return messages
+
+
+def connect(server):
+    conn = IMAPClient("127.0.0.1", port=server.port, ssl=False)
+    conn.login("user", "password")
+    conn.select_folder(INBOX)
+    return conn
+
+
+def run_per_message(server):
+    conn = connect(server)
+    resp = conn.fetch(conn.search(["ALL"]), FETCH_FIELDS)
+    for uid in sorted(resp):
+        conn.fetch(uid, [b"BODY.PEEK[]"])
+    conn.logout()
+
+
+def run_chunked(server, chunk_size, chunk_bytes, sync_connections=1):
+    tmpdir = tempfile.mkdtemp()
+    store = DictMessageStore(PersistentDict(os.path.join(tmpdir, "bench.db"), flag="n"))
+    ImapConn.port = server.port
+    ImapConn.use_ssl = False
+    imapconn = ImapConn(store, INBOX, conn_info=("127.0.0.1", "user", "password"))
+    imapconn.fetch_chunk_size = chunk_size
+    imapconn.fetch_chunk_bytes = chunk_bytes
+    imapconn.sync_connections = sync_connections
+    imapconn.pendingtimeout = 3600
+    with contextlib.redirect_stdout(io.StringIO()):
+        imapconn.connect()
+        imapconn.perform_imap_fetch()
+    imapconn.conn.logout()
+    # every message was fetched once
+    assert store.count() == sum(len(server.folders[name].messages) for name in (INBOX, MVBOX))
+
+
+def measure(server, func, *args):
+    server.stats.clear()
+    t0 = time.time()
+    func(server, *args)
+    duration = time.time() - t0
+    return server.stats["UID FETCH"], server.stats["UID MOVE"], duration
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--messages", type=int, default=2000, help="(default 2000) messages in INBOX")
+@click.option("--latency", type=float, default=0.001,
+              help="(default 0.001) seconds the server waits before answering a command")
+@click.option("--chunk-size", type=int, default=ImapConn.fetch_chunk_size,
+              help="(default %d) uids per FETCH in chunked mode" % ImapConn.fetch_chunk_size)
+@click.option("--chunk-bytes", type=int, default=ImapConn.fetch_chunk_bytes,
+              help="(default %d) estimated header bytes per FETCH in chunked mode"
+                   % ImapConn.fetch_chunk_bytes)
+@click.option("--sync-connections", type=int, default=ImapConn.sync_connections,
+              help="(default %d) connections fetching chunks in parallel mode"
+                   % ImapConn.sync_connections)
+@click.option("--modes", default="per-message,chunked,parallel",
+              help="(default per-message,chunked,parallel) comma separated modes to run")
+def main(messages, latency, chunk_size, chunk_bytes, sync_connections, modes):
+    raw_messages = gen_messages(messages)
+    print("%d messages, %.1f ms latency per command" % (messages, latency * 1000))
+    print("%-12s %10s %10s %10s %12s" % ("mode", "fetches", "moves", "secs", "msgs/sec"))
+    for name, func, args in [
+            ("per-message", run_per_message, ()),
+            ("chunked", run_chunked, (chunk_size, chunk_bytes)),
+            ("parallel", run_chunked, (chunk_size, chunk_bytes, sync_connections))]:
+        if name not in modes.split(","):
+            continue
+        server = FakeImapServer(latency=latency).start()
+        # the chunked fetch moves the Delta Chat messages between chunks
+        server.create_folder(MVBOX)
+        for raw in raw_messages:
+            server.append(INBOX, raw)
+        fetches, moves, duration = measure(server, func, *args)
+        print("%-12s %10d %10d %10.2f %12.0f" % (name, fetches, moves, duration,
+                                                messages / duration))
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the header parsing done for every fetched message.
+
+"email" is what process_fetched_message used to do (email.message_from_bytes
+and reading the fields from the Message), "scan" is headers.parse_fields.
+The corpus are the header blocks the mover's FETCH returns for generated
+Delta Chat and classic messages: CRLF line endings, long folded To/Cc
+lists, encoded display names, and a few folded In-Reply-To fields and
+messages without Message-ID.
+
+    python3 bench_headers.py --messages 20000
+"""
+
+import email
+import email.header
+import random
+import time
+
+import click
+
+from fakeimap import header_fields
+from headers import parse_fields
+from messagestore import normalized_messageid
+from send_unordered_message import gen_mail_msg
+
+FIELDS = ["from", "to", "cc", "date", "chat-version", "message-id", "in-reply-to"]
+
+
+def gen_corpus(num_messages):
+    corpus = []
+    parent = None
+    for i in range(num_messages):
+        to = ["user%d@example.org" % random.randrange(1000)
+              for _ in range(random.choice([1, 1, 1, 2, 5, 20]))]
+        msg = gen_mail_msg(From="alice@example.org", To=to, Subject="msg%d" % i,
+                           replying=parent if random.random() < 0.7 else None,
+                           dc=random.random() < 0.5)
+        if random.random() < 0.3:
+            name = email.header.Header("Jörg Müller", "utf-8").encode()
+            msg.replace_header("From", "%s <joerg@example.org>" % name)
+        if random.random() < 0.2:
+            msg["Cc"] = ", ".join("cc%d@example.org" % j for j in range(random.randrange(10)))
+        raw = msg.as_bytes().replace(b"\n", b"\r\n")
+        if random.random() < 0.01:
+            raw = raw.replace(b"\r\nIn-Reply-To: ", b"\r\nIn-Reply-To:\r\n ")
+        if random.random() < 0.005:
+            del msg["Message-ID"]
+            raw = msg.as_bytes().replace(b"\n", b"\r\n")
+        parent = msg["Message-ID"] or parent
+        corpus.append(header_fields(raw, FIELDS))
+    return corpus
+
+
+def parse_email(raw):
+    msg = email.message_from_bytes(raw)
+    message_id = normalized_messageid(msg) if msg["Message-ID"] is not None else None
+    return message_id, msg.get("In-Reply-To", "").lower(), msg.get("Chat-Version")
+
+
+def timeit(func, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for raw in corpus:
+            func(raw)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--messages", type=int, default=20000, help="(default 20000) header blocks")
+@click.option("--repeat", type=int, default=3, help="(default 3) runs, the best one counts")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(messages, repeat, seed):
+    random.seed(seed)
+    corpus = gen_corpus(messages)
+    size = sum(len(raw) for raw in corpus)
+    print("%d header blocks, %.0f bytes on average" % (len(corpus), size / float(len(corpus))))
+    results = {}
+    for name, func in (("email", parse_email), ("scan", parse_fields)):
+        elapsed = timeit(func, corpus, repeat)
+        results[name] = elapsed
+        print("%-6s %8.2f us/message %10.0f messages/sec" % (
+              name, elapsed * 1e6 / len(corpus), len(corpus) / elapsed))
+    print("speedup: %.1fx" % (results["email"] / results["scan"]))
+
+    # where do both disagree (folded In-Reply-To, missing Message-ID)?
+    differ = 0
+    for raw in corpus:
+        if parse_email(raw) != parse_fields(raw):
+            differ += 1
+    print("%d header blocks parsed differently" % differ)
+
+
+if __name__ == "__main__":
+    main()
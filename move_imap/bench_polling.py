@@ -0,0 +1,211 @@
+"""
+Simulation of the wakeups and delivery latency of the ways to wait for
+new messages, over --days days of an app switching between foreground
+and background.
+
+Messages arrive in conversations: --conversations per day at random
+times, each a burst of on average --burst messages --gap seconds apart
+on average.  The app is in the foreground for --fg-minutes and in the
+background for --bg-minutes on average (both exponentially distributed),
+and fetches the waiting messages whenever it comes to the foreground.
+Compared are
+
+    idle        IDLE all the time: a wakeup per message and per renewal of
+                the IDLE after --idle-timeout seconds
+    fixed-N     IDLE in the foreground, a poll every N seconds (--fixed) in
+                the background, like the timer of imap_threads/run.py
+    adaptive    pollpolicy.PollPolicy: IDLE in the foreground, in the
+                background a poll interval adapted to the arrival rate
+
+Reported are the wakeups per hour (in total and in the background) and
+percentiles of the time from the arrival of a message to its fetch:
+
+    python3 bench_polling.py --days 30 --conversations 20
+"""
+
+import random
+
+import click
+
+from pollpolicy import PollPolicy
+
+
+def gen_arrivals(rng, horizon, conversations, burst, gap):
+    arrivals = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(conversations / 86400.0)
+        if t >= horizon:
+            break
+        s = t
+        while s < horizon:
+            arrivals.append(s)
+            if rng.random() < 1.0 / burst:
+                break
+            s += rng.expovariate(1.0 / gap)
+    arrivals.sort()
+    return arrivals
+
+
+def gen_switches(rng, horizon, fg_seconds, bg_seconds):
+    """ return the times at which the app changes between foreground and
+    background, starting in the background """
+    switches = []
+    t = 0.0
+    foreground = False
+    while t < horizon:
+        t += rng.expovariate(1.0 / (fg_seconds if foreground else bg_seconds))
+        switches.append(min(t, horizon))
+        foreground = not foreground
+    return switches
+
+
+class FixedPolicy(object):
+    """ IDLE in the foreground, poll every interval seconds in the background """
+    def __init__(self, interval, idle_timeout, now=0.0):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.foreground = False
+        self.last_check = now
+
+    def observe(self, now, num_messages):
+        self.last_check = now
+
+    def set_foreground(self, foreground):
+        self.foreground = foreground
+
+    def next_wakeup(self, now):
+        if self.foreground:
+            return "idle", self.idle_timeout
+        return "poll", max(0.0, self.last_check + self.interval - now)
+
+
+class AlwaysIdle(FixedPolicy):
+    def next_wakeup(self, now):
+        return "idle", self.idle_timeout
+
+
+class Result(object):
+    def __init__(self):
+        self.wakeups = 0
+        self.bg_wakeups = 0
+        self.latencies = []
+
+    def wakeup(self, foreground):
+        self.wakeups += 1
+        if not foreground:
+            self.bg_wakeups += 1
+
+
+def simulate(policy, arrivals, switches):
+    result = Result()
+    pending = []
+    i = 0
+    t = 0.0
+    foreground = False
+    policy.set_foreground(foreground)
+    for end in switches:
+        mode, seconds = policy.next_wakeup(t)
+        if mode == "idle":
+            # every arrival ends the IDLE, and the IDLE is renewed
+            # every idle_timeout seconds
+            while i < len(arrivals) and arrivals[i] < end:
+                result.wakeup(foreground)
+                result.latencies.append(0.0)
+                policy.observe(arrivals[i], 1)
+                i += 1
+            renewals = int((end - t) / seconds)
+            result.wakeups += renewals
+            if not foreground:
+                result.bg_wakeups += renewals
+        else:
+            while True:
+                mode, seconds = policy.next_wakeup(t)
+                t += seconds
+                if t >= end:
+                    break
+                while i < len(arrivals) and arrivals[i] <= t:
+                    pending.append(arrivals[i])
+                    i += 1
+                result.wakeup(foreground)
+                result.latencies.extend(t - arrival for arrival in pending)
+                policy.observe(t, len(pending))
+                pending = []
+            while i < len(arrivals) and arrivals[i] < end:
+                pending.append(arrivals[i])
+                i += 1
+        t = end
+        foreground = not foreground
+        policy.set_foreground(foreground)
+        if foreground:
+            # coming to the foreground fetches what is waiting
+            result.wakeup(foreground)
+            result.latencies.extend(t - arrival for arrival in pending)
+            policy.observe(t, len(pending))
+            pending = []
+    return result
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def int_list(ctx, param, value):
+    try:
+        return [int(x) for x in value.split(",") if x]
+    except ValueError:
+        raise click.BadParameter("expected comma separated numbers")
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--days", type=float, default=30, help="(default 30) days to simulate")
+@click.option("--conversations", type=float, default=20,
+              help="(default 20) conversations per day")
+@click.option("--burst", type=float, default=5,
+              help="(default 5) mean messages per conversation")
+@click.option("--gap", type=float, default=60,
+              help="(default 60) mean seconds between the messages of a conversation")
+@click.option("--fg-minutes", type=float, default=5,
+              help="(default 5) mean minutes the app stays in the foreground")
+@click.option("--bg-minutes", type=float, default=120,
+              help="(default 120) mean minutes the app stays in the background")
+@click.option("--idle-timeout", type=float, default=PollPolicy.idle_timeout,
+              help="(default %d) seconds after which an IDLE is renewed" % PollPolicy.idle_timeout)
+@click.option("--fixed", default="60,300,900", callback=int_list,
+              help="(default 60,300,900) background poll intervals of the fixed policies")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(days, conversations, burst, gap, fg_minutes, bg_minutes, idle_timeout, fixed, seed):
+    rng = random.Random(seed)
+    horizon = days * 86400.0
+    arrivals = gen_arrivals(rng, horizon, conversations, burst, gap)
+    switches = gen_switches(rng, horizon, fg_minutes * 60, bg_minutes * 60)
+    hours = horizon / 3600.0
+
+    def adaptive():
+        policy = PollPolicy(foreground=False)
+        policy.idle_timeout = idle_timeout
+        return policy
+
+    policies = [("idle", AlwaysIdle(None, idle_timeout))]
+    policies += [("fixed-%d" % interval, FixedPolicy(interval, idle_timeout))
+                 for interval in fixed]
+    policies += [("adaptive", adaptive())]
+
+    print("%d messages in %.0f days, %d foreground sessions" % (
+          len(arrivals), days, len(switches) // 2))
+    print("%-10s | %9s %11s | %8s %8s %8s %8s" % (
+          "policy", "wakeups/h", "bg wakeups/h", "p50", "p90", "p99", "max"))
+    for name, policy in policies:
+        result = simulate(policy, arrivals, switches)
+        latencies = result.latencies
+        print("%-10s | %9.1f %12.1f | %8.0f %8.0f %8.0f %8.0f" % (
+              name, result.wakeups / hours, result.bg_wakeups / hours,
+              percentile(latencies, 0.5), percentile(latencies, 0.9),
+              percentile(latencies, 0.99), max(latencies) if latencies else float("nan")))
+
+
+if __name__ == "__main__":
+    main()
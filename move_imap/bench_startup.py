@@ -0,0 +1,103 @@
+"""
+Benchmark opening a large database in pickle and in snapshot format.
+
+A database of --messages resolved messages (and --active pending or
+moving ones) is written in both formats.  Each is then opened in a
+fresh child process, which reports the time until the DictMessageStore
+is usable, the time of a first lookup and of the first use of the thread
+index (which is built then) and the memory this took.
+
+    python3 bench_startup.py --messages 100000
+"""
+
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+
+import click
+
+from messagestore import DictMessageStore, MessageRecord
+from persistentdict import JournaledDict
+from threadindex import (
+    DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_MOVING,
+    DC_CONSTANT_MSG_MOVESTATE_STAY,
+)
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def gen_records(num_messages, num_active):
+    records = []
+    parent = ""
+    for i in range(num_messages + num_active):
+        message_id = "<%d.%d@example.org>" % (random.getrandbits(48), i)
+        if i < num_messages:
+            move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
+        else:
+            move_state = random.choice([DC_CONSTANT_MSG_MOVESTATE_PENDING,
+                                        DC_CONSTANT_MSG_MOVESTATE_MOVING])
+        records.append(MessageRecord(
+            message_id, parent if random.random() < 0.7 else "",
+            "1.0" if random.random() < 0.5 else None, "INBOX", i + 1, move_state,
+            time.time()))
+        parent = message_id
+    return records
+
+
+def write_db(path, db_format, records):
+    store = DictMessageStore(JournaledDict(path, flag="n", format=db_format))
+    for msg in records:
+        store.add(msg)
+    store.set_folder_value("INBOX", "last_sync_uid", len(records))
+    store.sync()
+    store.db.compact()
+
+
+def open_db(path, db_format, message_id, pipe):
+    """ child process: open the database and report timings and memory """
+    rss_before = rss_kb()
+    t0 = time.time()
+    store = DictMessageStore(JournaledDict(path, format=db_format))
+    t1 = time.time()
+    assert store.get(message_id) is not None
+    t2 = time.time()
+    store.threads.next_move_state(message_id)
+    t3 = time.time()
+    pipe.send((t1 - t0, t2 - t1, t3 - t2, rss_kb() - rss_before))
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--messages", type=int, default=100000, help="(default 100000) resolved messages")
+@click.option("--active", type=int, default=100,
+              help="(default 100) pending and moving messages")
+@click.option("--seed", type=int, default=0, help="(default 0) random seed")
+def main(messages, active, seed):
+    random.seed(seed)
+    records = gen_records(messages, active)
+    message_id = random.choice(records).message_id
+    tmpdir = tempfile.mkdtemp()
+    print("%d messages (%d active)" % (messages + active, active))
+    print("%-10s %10s %10s %10s %12s %10s" % (
+          "format", "MB", "open ms", "get ms", "threads ms", "rss MB"))
+    for db_format in ("pickle", "snapshot"):
+        path = os.path.join(tmpdir, db_format + ".db")
+        write_db(path, db_format, records)
+        pipe, child_pipe = multiprocessing.Pipe()
+        child = multiprocessing.get_context("fork").Process(
+            target=open_db, args=(path, db_format, message_id, child_pipe))
+        child.start()
+        open_secs, get_secs, threads_secs, rss = pipe.recv()
+        child.join()
+        print("%-10s %10.1f %10.1f %10.3f %12.1f %10.1f" % (
+              db_format, os.path.getsize(path) / 1e6, open_secs * 1000, get_secs * 1000,
+              threads_secs * 1000, rss / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
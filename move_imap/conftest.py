@@ -0,0 +1,28 @@
+import pytest
+
+from fakeimap import FakeImapServer
+from move_imap import ImapConn
+
+
+def start_server(monkeypatch, **kwargs):
+    server = FakeImapServer(**kwargs).start()
+    monkeypatch.setattr(ImapConn, "port", server.port)
+    monkeypatch.setattr(ImapConn, "use_ssl", False)
+    monkeypatch.setattr(ImapConn, "verbose", False)
+    return server
+
+
+@pytest.fixture
+def imap_server(monkeypatch):
+    """ a running FakeImapServer, which ImapConns connect to """
+    server = start_server(monkeypatch)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def qresync_server(monkeypatch):
+    """ like imap_server, with CONDSTORE and QRESYNC """
+    server = start_server(monkeypatch, condstore=True)
+    yield server
+    server.stop()
@@ -0,0 +1,150 @@
+"""
+Connection handling shared by the folders of one account.
+
+A ConnectionManager hands out one SSL context per account, which
+remembers the TLS session of the last connection to the server so new
+connections resume it instead of doing a full handshake.  When a folder
+fails to connect or loses its connection, the manager tells it how long
+to wait before the next attempt: a random multiple of backoff_constant
+between 0 and 2**retries - 1, like ``next_time`` in
+expbackoff/compute.py, capped at backoff_max seconds.  It also counts
+connects, reconnects and failures per folder and times them.
+"""
+
+import random
+import ssl
+import threading
+import time
+
+
+# retries beyond this don't grow the backoff (a delay of 2**62 steps is
+# forever anyway), so a folder which fails for months doesn't overflow
+MAX_BACKOFF_EXPONENT = 62
+
+
+def next_backoff(retries, constant, max_delay=None):
+    """ return a random delay for the given number of retries: a multiple
+    of constant between 0 and 2**retries - 1 times constant """
+    limit = (1 << min(retries, MAX_BACKOFF_EXPONENT)) - 1
+    if max_delay is not None:
+        limit = min(limit, int(max_delay // constant))
+    return random.randint(0, limit) * constant
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """ SSLContext which resumes the last TLS session to the same host.
+
+    Works for blocking sockets (IMAPClient) and memory BIOs (asyncio). """
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = {}
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if kwargs.get("session") is None:
+            kwargs["session"] = self.sessions.get(kwargs.get("server_hostname"))
+        return ssl.SSLContext.wrap_socket(self, sock, *args, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, **kwargs):
+        if kwargs.get("session") is None:
+            kwargs["session"] = self.sessions.get(kwargs.get("server_hostname"))
+        return ssl.SSLContext.wrap_bio(self, incoming, outgoing, *args, **kwargs)
+
+    def remember(self, hostname, sslobj):
+        """ keep the session of an established connection for resuming it.
+        With TLS 1.3 the session ticket is only sent after the handshake,
+        so call this after the first response was read. """
+        if sslobj is not None and sslobj.session is not None:
+            self.sessions[hostname] = sslobj.session
+
+
+def make_ssl_context():
+    ssl_context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_default_certs()
+
+    # don't check if certificate hostname doesn't match target hostname
+    ssl_context.check_hostname = False
+
+    # don't check if the certificate is trusted by a certificate authority
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+class ConnStats(object):
+    def __init__(self):
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.resumed = 0
+        self.connect_time_total = 0.0
+        self.last_connect_time = None
+        # consecutive failures since the folder last completed a cycle
+        self.retries = 0
+        # when the folder lost its connection (None while connected)
+        self.lost_at = None
+        self.downtime_total = 0.0
+
+    def asdict(self):
+        return {
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "resumed": self.resumed,
+            "last_connect_time": self.last_connect_time,
+            "avg_connect_time": (self.connect_time_total / self.connects
+                                 if self.connects else None),
+            "downtime": self.downtime_total,
+        }
+
+
+class ConnectionManager(object):
+    # seconds per backoff step and the maximum delay between attempts
+    backoff_constant = 1.0
+    backoff_max = 300.0
+
+    def __init__(self, host, use_ssl=True):
+        self.host = host
+        self.use_ssl = use_ssl
+        self.ssl_context = make_ssl_context() if use_ssl else None
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, foldername):
+        with self._lock:
+            return self.stats.setdefault(foldername, ConnStats())
+
+    def delay(self, foldername):
+        """ seconds to wait before the next connect attempt of the folder """
+        return next_backoff(self._stats(foldername).retries,
+                            self.backoff_constant, self.backoff_max)
+
+    def connected(self, foldername, connect_time, sslobj=None):
+        stats = self._stats(foldername)
+        if stats.connects:
+            stats.reconnects += 1
+        stats.connects += 1
+        stats.connect_time_total += connect_time
+        stats.last_connect_time = connect_time
+        if stats.lost_at is not None:
+            stats.downtime_total += time.time() - stats.lost_at
+            stats.lost_at = None
+        if sslobj is not None:
+            if sslobj.session_reused:
+                stats.resumed += 1
+            self.ssl_context.remember(self.host, sslobj)
+
+    def failed(self, foldername):
+        """ a connect attempt failed or an established connection broke """
+        stats = self._stats(foldername)
+        stats.failures += 1
+        stats.retries += 1
+        if stats.lost_at is None:
+            stats.lost_at = time.time()
+
+    def healthy(self, foldername):
+        """ the folder completed a cycle, start over with short delays """
+        self._stats(foldername).retries = 0
+
+    def status(self):
+        with self._lock:
+            return dict((foldername, stats.asdict())
+                        for foldername, stats in self.stats.items())
@@ -0,0 +1,425 @@
+"""
+Move Delta Chat messages for many accounts from one process.
+
+All accounts share one asyncio event loop and a bounded pool of
+logged-in IMAP connections, which are handed from folder to folder of
+the same account.  Every folder (INBOX, Sent, DeltaChat of every account) is
+scheduled on its own: folders which recently received messages are kept
+in IDLE (as long as idle slots are free), quiet folders are polled with
+an interval that doubles up to --max-interval while nothing arrives.
+
+The accounts file is a JSON list of objects with "host", "user",
+"password" and optionally "name" (database name, default: user)::
+
+    python3 daemon.py accounts.json --connections 50 --status-file status.json
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+import click
+
+from asyncengine import AsyncImapConn, ASYNC_CONNECTION_ERRORS
+from connection import ConnectionManager
+from metrics import METRICS, serve_http
+from move_imap import INBOX, SENT, MVBOX, make_store
+from movequeue import MoveQueue
+from retention import Retention, DAY
+
+
+class DaemonImapConn(AsyncImapConn):
+    """ AsyncImapConn which counts fetched and moved messages for its account """
+
+    def __init__(self, account, foldername):
+        AsyncImapConn.__init__(self, account.store, foldername, account.conn_info,
+                               account.connmanager)
+        self.account = account
+
+    def process_fetched_message(self, uid, data, timestamp_fetch):
+        AsyncImapConn.process_fetched_message(self, uid, data, timestamp_fetch)
+        self.account.fetched += 1
+
+    def moves_done(self, moved_msgs):
+        now = time.time()
+        for dbmsg in moved_msgs:
+            self.account.record_move(now - dbmsg.fetch_retrieve_time)
+        AsyncImapConn.moves_done(self, moved_msgs)
+
+
+class Folder(object):
+    def __init__(self, account, foldername, min_interval):
+        self.account = account
+        self.foldername = foldername
+        self.imapconn = DaemonImapConn(account, foldername)
+        self.interval = min_interval
+        self.next_run = 0.0
+        self.last_activity = 0.0
+        self.last_success = None
+
+    def __repr__(self):
+        return "<Folder %s/%s>" % (self.account.name, self.foldername)
+
+
+class ConnectionPool(object):
+    """ logged-in connections shared by the folders of all accounts.
+
+    At most size connections are open.  A folder gets an idle connection
+    of its account if there is one.  Otherwise a new one is opened, and if
+    the pool is full, the longest idle connection of another account is
+    logged out to make room.  Connections which were idle for more than max_idle_age
+    seconds are not reused, servers drop them after 30 minutes.
+    """
+    max_idle_age = 25 * 60
+
+    def __init__(self, size):
+        self.size = size
+        self.num_open = 0
+        self.idle = []        # (released at, account, conn), oldest first
+        self._available = asyncio.Condition()
+        self.stats = dict(opened=0, reused=0, expired=0, evicted=0)
+
+    def _close(self, conn):
+        self.num_open -= 1
+        asyncio.ensure_future(_logout(conn))
+
+    def _take_idle(self, account):
+        """ return the most recently released usable connection of the account """
+        now = time.time()
+        for released, owner, conn in list(self.idle):
+            if now - released > self.max_idle_age:
+                self.idle.remove((released, owner, conn))
+                self.stats["expired"] += 1
+                self._close(conn)
+        for i in range(len(self.idle) - 1, -1, -1):
+            if self.idle[i][1] is account:
+                self.stats["reused"] += 1
+                return self.idle.pop(i)[2]
+        return None
+
+    async def acquire(self, imapconn):
+        """ give imapconn a logged-in connection of its account """
+        async with self._available:
+            while True:
+                conn = self._take_idle(imapconn.account)
+                if conn is not None:
+                    await imapconn.use_connection(conn)
+                    return
+                if self.num_open < self.size:
+                    break
+                if self.idle:
+                    self.stats["evicted"] += 1
+                    self._close(self.idle.pop(0)[2])
+                    continue
+                await self._available.wait()
+            self.num_open += 1
+        try:
+            await imapconn.open_connection()
+        except BaseException:
+            imapconn.close()
+            await self.release(imapconn, reuse=False)
+            raise
+        self.stats["opened"] += 1
+
+    async def release(self, imapconn, reuse=True):
+        """ take the connection back, keep it for the account if reuse """
+        conn, imapconn.conn = imapconn.conn, None
+        async with self._available:
+            if reuse and conn is not None:
+                self.idle.append((time.time(), imapconn.account, conn))
+            else:
+                self.num_open -= 1
+                if conn is not None:
+                    asyncio.ensure_future(_logout(conn))
+            self._available.notify()
+
+    def status(self):
+        return dict(self.stats, open=self.num_open, idle=len(self.idle))
+
+
+async def _logout(conn):
+    try:
+        await conn.logout()
+    except ASYNC_CONNECTION_ERRORS:
+        conn.shutdown()
+
+
+class Account(object):
+    def __init__(self, name, conn_info, store, pendingtimeout, min_interval):
+        self.name = name
+        self.conn_info = conn_info
+        self.store = store
+        self.connmanager = ConnectionManager(conn_info[0], AsyncImapConn.use_ssl)
+        self.started = time.time()
+        self.fetched = 0
+        self.moved = 0
+        self.polls = 0
+        self.errors = 0
+        self.move_lag_total = 0.0
+        self.mvbox_polled = False
+        self.folders = [Folder(self, foldername, min_interval)
+                        for foldername in (MVBOX, INBOX, SENT)]
+        for folder in self.folders:
+            folder.imapconn.pendingtimeout = pendingtimeout
+
+    def record_move(self, lag):
+        self.moved += 1
+        self.move_lag_total += lag
+
+    def status(self, now):
+        elapsed = max(now - self.started, 1e-6)
+        last = [folder.last_success for folder in self.folders]
+        return {
+            "name": self.name,
+            "fetched": self.fetched,
+            "moved": self.moved,
+            "polls": self.polls,
+            "errors": self.errors,
+            "fetched_per_min": self.fetched * 60.0 / elapsed,
+            "moved_per_min": self.moved * 60.0 / elapsed,
+            # seconds since the least recently synced folder was synced
+            "sync_lag": None if None in last else now - min(last),
+            # average seconds from fetching a message to moving it
+            "move_lag": self.move_lag_total / self.moved if self.moved else None,
+            # connects, reconnects and connect latency per folder
+            "connections": self.connmanager.status(),
+        }
+
+
+class Daemon(object):
+    def __init__(self, accounts, connections=20, max_idle=None, min_interval=5,
+                 max_interval=600, hot_window=300, idle_timeout=600):
+        self.accounts = accounts
+        self.pool = ConnectionPool(connections)
+        # always leave connections for polling the quiet folders
+        self.max_idle = max(connections // 2, 1) if max_idle is None else max_idle
+        self.num_workers = connections
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hot_window = hot_window
+        self.idle_timeout = idle_timeout
+        self.idling = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        for account in accounts:
+            for folder in account.folders:
+                self.schedule(folder, 0)
+
+    def schedule(self, folder, delay):
+        folder.next_run = time.time() + delay
+        heapq.heappush(self._queue, (folder.next_run, next(self._seq), folder))
+        self._wakeup.set()
+
+    async def next_due(self):
+        while True:
+            now = time.time()
+            if self._queue and self._queue[0][0] <= now:
+                return heapq.heappop(self._queue)[2]
+            timeout = self._queue[0][0] - now if self._queue else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def take_due(self, account):
+        """ remove and return a due folder of the account, or None """
+        now = time.time()
+        for i, (next_run, seq, folder) in enumerate(self._queue):
+            if next_run <= now and folder.account is account:
+                self._queue[i] = self._queue[-1]
+                self._queue.pop()
+                heapq.heapify(self._queue)
+                return folder
+        return None
+
+    async def worker(self):
+        folder = None
+        while True:
+            if folder is None:
+                folder = await self.next_due()
+            if folder.foldername == INBOX and not folder.account.mvbox_polled:
+                # INBOX should wait until MVBOX polled once
+                self.schedule(folder, 1)
+                folder = None
+                continue
+            delay = await self.service(folder)
+            self.schedule(folder, delay)
+            # the other due folders of the account get the connection next
+            folder = self.take_due(folder.account)
+
+    async def service(self, folder):
+        """ sync a folder, IDLE on it while it is active, and return the
+        delay until it should be synced again. """
+        account = folder.account
+        imapconn = folder.imapconn
+        try:
+            await self.pool.acquire(imapconn)
+        except ASYNC_CONNECTION_ERRORS as e:
+            return self.failed(folder, "connect failed, rescheduling:", e)
+        try:
+            await imapconn.select()
+            while True:
+                account.polls += 1
+                last_sync_uid = imapconn.last_sync_uid
+                await imapconn.perform_imap_jobs()
+                await imapconn.perform_imap_fetch()
+                if folder.foldername == MVBOX:
+                    account.mvbox_polled = True
+                elif folder.foldername == INBOX:
+                    imapconn.forget_about_too_old_pending_messages()
+                    await imapconn.evict_old_threads()
+                now = time.time()
+                folder.last_success = now
+                account.connmanager.healthy(folder.foldername)
+                # new uids arrived (messages fetched again don't count)
+                if imapconn.last_sync_uid > last_sync_uid:
+                    folder.last_activity = now
+                    folder.interval = self.min_interval
+                else:
+                    folder.interval = min(folder.interval * 2, self.max_interval)
+                if now - folder.last_activity > self.hot_window or self.idling >= self.max_idle:
+                    break
+                self.idling += 1
+                try:
+                    await imapconn.perform_imap_idle(timeout=self.idle_timeout)
+                finally:
+                    self.idling -= 1
+            # don't leave queued moves behind until the next poll
+            wait = imapconn.movequeue.wait_time()
+            if wait is not None:
+                await asyncio.sleep(wait)
+                await imapconn.perform_imap_jobs()
+            # expunges reported for this folder, before another one is selected
+            imapconn.process_vanished(imapconn.pop_vanished())
+        except ASYNC_CONNECTION_ERRORS as e:
+            interval = self.failed(folder, "error, rescheduling:", e)
+            await self.pool.release(imapconn, reuse=False)
+            return interval
+        await self.pool.release(imapconn)
+        return folder.interval
+
+    def failed(self, folder, msg, error):
+        """ count a broken connection and return the delay until the next try """
+        folder.account.errors += 1
+        folder.imapconn.connection_failed(msg, error)
+        folder.interval = max(self.min_interval, min(
+            folder.account.connmanager.delay(folder.foldername), self.max_interval))
+        return folder.interval
+
+    def status(self):
+        now = time.time()
+        return {
+            "time": now,
+            "idling": self.idling,
+            "pool": self.pool.status(),
+            "accounts": [account.status(now) for account in self.accounts],
+            # per-folder phase timings and counters by login user
+            "metrics": METRICS.asdict(),
+        }
+
+    async def write_status(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.status(), f, indent=1)
+            os.rename(tmp, path)
+
+    async def run(self, status_file=None, status_interval=30):
+        tasks = [self.worker() for _ in range(self.num_workers)]
+        if status_file:
+            tasks.append(self.write_status(status_file, status_interval))
+        await asyncio.gather(*tasks)
+
+
+def load_accounts(path, basedir, storage, pendingtimeout, min_interval, db_format="snapshot"):
+    with open(path) as f:
+        entries = json.load(f)
+    accounts = []
+    for entry in entries:
+        name = entry.get("name") or entry["user"]
+        store = make_store(storage, os.path.join(basedir, name), db_format)
+        conn_info = (entry["host"], entry["user"], entry["password"])
+        accounts.append(Account(name, conn_info, store, pendingtimeout, min_interval))
+    return accounts
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--basedir", type=click.Path(),
+              default=click.get_app_dir("imap_move_chats"),
+              help="directory where database files are stored")
+@click.option("--storage", type=click.Choice(["journal", "pickle", "sqlite"]), default="journal",
+              help="(default journal) database format, see move_imap.py --help")
+@click.option("--db-format", type=click.Choice(["snapshot", "pickle"]), default="snapshot",
+              help="(default snapshot) file format of the journal and pickle storage")
+@click.option("--pendingtimeout", type=int, default=3600,
+              help="(default 3600) seconds which a message is still considered for moving "
+                   "even though it has no determined thread-start message")
+@click.option("--connections", type=int, default=20,
+              help="(default 20) maximum number of IMAP connections for all accounts")
+@click.option("--max-idle", type=int, default=None,
+              help="maximum number of connections kept in IDLE (default: half of --connections)")
+@click.option("--min-interval", type=float, default=5,
+              help="(default 5) seconds between polls of an active folder")
+@click.option("--max-interval", type=float, default=600,
+              help="(default 600) seconds between polls of a quiet folder")
+@click.option("--hot-window", type=float, default=300,
+              help="(default 300) folders which received messages within this many "
+                   "seconds are kept in IDLE")
+@click.option("--move-batch", type=int, default=MoveQueue.max_batch,
+              help="(default %d) maximum number of messages moved with one MOVE command"
+                   % MoveQueue.max_batch)
+@click.option("--move-delay", type=float, default=MoveQueue.move_delay,
+              help="(default %s) seconds a message may wait for more messages to be moved "
+                   "with the same MOVE command" % MoveQueue.move_delay)
+@click.option("--retain-days", type=float, default=Retention.max_age / DAY,
+              help="(default %g) evict threads without new messages for this many days "
+                   "from the databases" % (Retention.max_age / DAY))
+@click.option("--max-messages", type=int, default=Retention.max_messages,
+              help="per account, evict the least recently active threads while more "
+                   "messages are stored (default: no limit)")
+@click.option("--sync-connections", type=int, default=1,
+              help="(default 1) extra connections per folder fetching a large sync in "
+                   "parallel, not counted in --connections")
+@click.option("--status-file", type=click.Path(), default=None,
+              help="periodically write per-account throughput and lag as JSON to this file")
+@click.option("--status-interval", type=float, default=30,
+              help="(default 30) seconds between status file updates")
+@click.option("-q", "--quiet", is_flag=True, default=False,
+              help="don't print what every folder is doing")
+@click.option("--metrics-port", type=int, default=None,
+              help="serve per-folder timings and counters on "
+                   "http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json")
+@click.argument("accounts-file", type=click.Path(exists=True), required=True)
+def main(basedir, storage, db_format, pendingtimeout, connections, max_idle, min_interval, max_interval,
+         hot_window, move_batch, move_delay, retain_days, max_messages,
+         sync_connections, status_file, status_interval, quiet, metrics_port, accounts_file):
+    AsyncImapConn.verbose = not quiet
+    AsyncImapConn.sync_connections = sync_connections
+    if metrics_port:
+        serve_http(METRICS, metrics_port)
+    MoveQueue.max_batch = move_batch
+    MoveQueue.move_delay = move_delay
+    Retention.max_age = retain_days * DAY
+    Retention.max_messages = max_messages
+    if not os.path.exists(basedir):
+        os.makedirs(basedir)
+
+    async def run():
+        accounts = load_accounts(accounts_file, basedir, storage, pendingtimeout, min_interval,
+                                 db_format)
+        daemon = Daemon(accounts, connections=connections, max_idle=max_idle,
+                        min_interval=min_interval, max_interval=max_interval,
+                        hot_window=hot_window)
+        await daemon.run(status_file, status_interval)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+A small in-process IMAP server for benchmarking ImapConn without a real
+mail server.  It speaks just enough IMAP4rev1 over plain TCP for
+IMAPClient: LOGIN, CAPABILITY, SELECT, CREATE, STATUS, NOOP, LOGOUT, UID
+SEARCH (ALL and UID criteria), UID FETCH, UID MOVE and IDLE.  Sessions
+learn about messages appended to or expunged from their selected folder
+(by other sessions or by the test code) through EXISTS and EXPUNGE
+responses, right away while in IDLE and otherwise after their next NOOP,
+UID FETCH or UID MOVE.  With notify=True the server advertises NOTIFY,
+and sessions which listed other folders with NOTIFY SET (mailboxes ...)
+get STATUS (UIDNEXT MESSAGES) responses for them the same way.  With
+condstore=True it also keeps mod-sequences and supports ENABLE QRESYNC,
+HIGHESTMODSEQ and UID FETCH (CHANGEDSINCE n VANISHED) for messages
+removed with expunge().  Every command can be delayed by a fixed latency
+to emulate network round-trips, and the server counts the commands it
+served.
+
+    server = FakeImapServer(latency=0.01)
+    server.start()
+    server.append("INBOX", msg.as_bytes())
+    conn = IMAPClient("127.0.0.1", port=server.port, ssl=False)
+"""
+
+import bisect
+import re
+import select
+import socketserver
+import threading
+import time
+from collections import Counter
+
+
+def parse_args(line):
+    """ split an IMAP command line into atoms, quoted strings and (nested) lists """
+    tokens = re.findall(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()"]+\[[^\]]*\]|[^\s()"]+', line)
+    stack = [[]]
+    for tok in tokens:
+        if tok == "(":
+            stack.append([])
+        elif tok == ")":
+            lst = stack.pop()
+            stack[-1].append(lst)
+        elif tok.startswith('"'):
+            stack[-1].append(re.sub(r'\\(.)', r'\1', tok[1:-1]))
+        else:
+            stack[-1].append(tok)
+    return stack[0]
+
+
+def quote(name):
+    return '"%s"' % name.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parse_uid_set(spec, max_uid):
+    """ return the set of uids denoted by an IMAP sequence-set like '1,5:7,9:*' """
+    uids = set()
+    for part in spec.split(","):
+        if ":" in part:
+            lo, hi = [max_uid if x == "*" else int(x) for x in part.split(":")]
+            lo, hi = min(lo, hi), max(lo, hi)
+            uids.update(range(lo, hi + 1))
+        else:
+            uids.add(max_uid if part == "*" else int(part))
+    return uids
+
+
+def header_fields(raw, names):
+    """ return the header block of raw restricted to names (folded lines kept) """
+    head = re.split(br"\r?\n\r?\n", raw, 1)[0]
+    names = set(name.lower() for name in names)
+    out = []
+    keep = False
+    for line in re.split(br"\r?\n", head):
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                out.append(line)
+            continue
+        keep = line.split(b":", 1)[0].strip().lower().decode("ascii", "replace") in names
+        if keep:
+            out.append(line)
+    return b"".join(line + b"\r\n" for line in out) + b"\r\n"
+
+
+class Folder(object):
+    def __init__(self, name):
+        self.name = name
+        self.messages = {}   # uid -> raw bytes
+        self.uidnext = 1
+        self.uidvalidity = 1
+        self.highestmodseq = 1
+        self.modseqs = {}    # uid -> modseq of last change
+        self.expunge_log = []   # (modseq, uid) of expunged messages
+
+    @property
+    def max_uid(self):
+        return max(self.messages) if self.messages else 0
+
+
+class FakeImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    capabilities = ["IMAP4rev1", "IDLE", "MOVE"]
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, condstore=False, notify=False):
+        socketserver.TCPServer.__init__(self, (host, port), ImapHandler)
+        if condstore:
+            self.capabilities = self.capabilities + ["ENABLE", "CONDSTORE", "QRESYNC"]
+        if notify:
+            self.capabilities = self.capabilities + ["NOTIFY"]
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.lock = threading.RLock()
+        # notified whenever a message was appended or expunged
+        self.changed = threading.Condition(self.lock)
+        self.folders = {}
+        self.stats = Counter()
+        self._thread = None
+        self.create_folder("INBOX")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def create_folder(self, name):
+        with self.lock:
+            return self.folders.setdefault(name, Folder(name))
+
+    def append(self, foldername, raw):
+        """ add a message and return its uid """
+        with self.lock:
+            folder = self.create_folder(foldername)
+            uid = folder.uidnext
+            folder.uidnext += 1
+            folder.messages[uid] = raw
+            folder.highestmodseq += 1
+            folder.modseqs[uid] = folder.highestmodseq
+            self.changed.notify_all()
+            return uid
+
+    def expunge(self, foldername, uid):
+        with self.lock:
+            folder = self.folders[foldername]
+            del folder.messages[uid]
+            del folder.modseqs[uid]
+            folder.highestmodseq += 1
+            folder.expunge_log.append((folder.highestmodseq, uid))
+            self.changed.notify_all()
+
+    def move(self, foldername, uids, destname):
+        """ move messages to another folder and return [(old uid, new uid)] """
+        with self.lock:
+            folder = self.folders[foldername]
+            moved = []
+            for uid in sorted(uids):
+                raw = folder.messages.get(uid)
+                if raw is None:
+                    continue
+                moved.append((uid, self.append(destname, raw)))
+                self.expunge(foldername, uid)
+                self.on_move(foldername, destname, raw)
+            return moved
+
+    def on_move(self, foldername, destname, raw):
+        """ called for every moved message, e.g. to measure move latency """
+
+    def check_move(self, foldername, uids):
+        """ return a tagged "NO ..." response to refuse a UID MOVE, e.g. like
+        servers which answer "NO [EXPUNGEISSUED]" for expunged uids """
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    # responses are written in pieces, don't let them wait for ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.selected = None
+        self.qresync = False
+        # sorted uids, HIGHESTMODSEQ and UIDNEXT of the selected folder
+        # as last reported to the client
+        self.known = []
+        self.known_modseq = 0
+        self.known_uidnext = 1
+        # (UIDNEXT, MESSAGES) of the folders watched with NOTIFY as last
+        # reported to the client
+        self.notify_known = {}
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        self.wfile.write(data)
+
+    def untagged(self, line):
+        self.send("* %s\r\n" % (line,))
+
+    def handle(self):
+        self.untagged("OK fake IMAP server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode("utf8").rstrip("\r\n")
+            if not line:
+                continue
+            tag, _, rest = line.partition(" ")
+            cmd, _, args = rest.partition(" ")
+            cmd = cmd.upper()
+            if cmd == "UID":
+                sub, _, args = args.partition(" ")
+                cmd = "UID " + sub.upper()
+            server = self.server
+            server.stats[cmd] += 1
+            if server.latency:
+                time.sleep(server.latency)
+            method = getattr(self, "cmd_" + cmd.replace(" ", "_").lower(), None)
+            if method is None:
+                self.send("%s BAD unknown command %s\r\n" % (tag, cmd))
+                continue
+            try:
+                result = method(tag, parse_args(args))
+            except Exception as e:
+                self.send("%s BAD %s\r\n" % (tag, e))
+                continue
+            if result is False:
+                return
+            self.send("%s %s\r\n" % (tag, result or "OK completed"))
+
+    def cmd_capability(self, tag, args):
+        self.untagged("CAPABILITY " + " ".join(self.server.capabilities))
+
+    def cmd_login(self, tag, args):
+        return "OK [CAPABILITY %s] logged in" % " ".join(self.server.capabilities)
+
+    def report_changes(self):
+        """ send EXPUNGE (or VANISHED) and EXISTS responses for the changes
+        of the selected folder since we last reported it. """
+        folder = self.selected
+        if folder is None:
+            return
+        with self.server.lock:
+            if folder.highestmodseq == self.known_modseq:
+                return
+            start = bisect.bisect_right(folder.expunge_log, (self.known_modseq, float("inf")))
+            gone = sorted((uid for modseq, uid in folder.expunge_log[start:]), reverse=True)
+            new = [uid for uid in range(self.known_uidnext, folder.uidnext)
+                   if uid in folder.messages]
+            self.known_modseq = folder.highestmodseq
+            self.known_uidnext = folder.uidnext
+        vanished = []
+        for uid in gone:
+            # from the highest uid down, so lower sequence numbers stay valid
+            i = bisect.bisect_left(self.known, uid)
+            if i < len(self.known) and self.known[i] == uid:
+                del self.known[i]
+                if self.qresync:
+                    vanished.append(uid)
+                else:
+                    self.untagged("%d EXPUNGE" % (i + 1,))
+        if vanished:
+            self.untagged("VANISHED " + ",".join(map(str, sorted(vanished))))
+        if new:
+            self.known.extend(new)
+            self.untagged("%d EXISTS" % len(self.known))
+
+    def report_status(self):
+        """ send STATUS responses for the watched folders other than the
+        selected one which changed since we last reported them. """
+        for name, known in self.notify_known.items():
+            folder = self.server.folders.get(name)
+            if folder is None or folder is self.selected:
+                continue
+            with self.server.lock:
+                status = (folder.uidnext, len(folder.messages))
+            if status != known:
+                self.notify_known[name] = status
+                self.untagged("STATUS %s (UIDNEXT %d MESSAGES %d)" % (
+                              quote(name), status[0], status[1]))
+
+    def cmd_noop(self, tag, args):
+        self.report_changes()
+        self.report_status()
+
+    def cmd_idle(self, tag, args):
+        self.send("+ idling\r\n")
+        server = self.server
+        while True:
+            self.report_changes()
+            self.report_status()
+            with server.changed:
+                if self.selected is None or self.selected.highestmodseq == self.known_modseq:
+                    server.changed.wait(0.05)
+            # the client ends IDLE with DONE
+            if select.select([self.connection], [], [], 0)[0]:
+                break
+        line = self.rfile.readline()
+        if line.strip().upper() != b"DONE":
+            return "BAD expected DONE"
+
+    def cmd_logout(self, tag, args):
+        self.untagged("BYE")
+        self.send("%s OK logout\r\n" % (tag,))
+        return False
+
+    def cmd_enable(self, tag, args):
+        enabled = [name for name in args
+                   if name.upper() == "QRESYNC" and "QRESYNC" in self.server.capabilities]
+        if enabled:
+            self.qresync = True
+        self.untagged("ENABLED " + " ".join(enabled))
+
+    def cmd_create(self, tag, args):
+        with self.server.lock:
+            if args[0] in self.server.folders:
+                return "NO [ALREADYEXISTS] folder exists"
+            self.server.create_folder(args[0])
+
+    def cmd_status(self, tag, args):
+        with self.server.lock:
+            folder = self.server.folders.get(args[0])
+            if folder is None:
+                return "NO [NONEXISTENT] no such folder"
+            values = dict(UIDNEXT=folder.uidnext, MESSAGES=len(folder.messages),
+                          UIDVALIDITY=folder.uidvalidity, HIGHESTMODSEQ=folder.highestmodseq)
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        self.untagged("STATUS %s (%s)" % (quote(folder.name), " ".join(
+                      "%s %d" % (item.upper(), values[item.upper()]) for item in items)))
+
+    def cmd_notify(self, tag, args):
+        if "NOTIFY" not in self.server.capabilities:
+            return "BAD NOTIFY not supported"
+        self.notify_known = {}
+        if args[0].upper() == "NONE":
+            return
+        # SET (selected (events)) (mailboxes (names) (events)), the
+        # selected folder is reported with EXISTS/EXPUNGE anyway
+        for spec in args[1:]:
+            if isinstance(spec, list) and spec and str(spec[0]).lower() == "mailboxes":
+                names = spec[1] if isinstance(spec[1], list) else [spec[1]]
+                with self.server.lock:
+                    for name in names:
+                        folder = self.server.folders.get(name)
+                        if folder is not None:
+                            self.notify_known[name] = (folder.uidnext, len(folder.messages))
+
+    def cmd_select(self, tag, args):
+        with self.server.lock:
+            folder = self.server.folders.get(args[0])
+            if folder is None:
+                return "NO no such folder"
+            self.selected = folder
+            self.known = sorted(folder.messages)
+            self.known_modseq = folder.highestmodseq
+            self.known_uidnext = folder.uidnext
+            self.untagged("%d EXISTS" % len(folder.messages))
+            self.untagged("0 RECENT")
+            self.untagged("OK [UIDVALIDITY %d]" % folder.uidvalidity)
+            self.untagged("OK [UIDNEXT %d]" % folder.uidnext)
+            if "CONDSTORE" in self.server.capabilities:
+                self.untagged("OK [HIGHESTMODSEQ %d]" % folder.highestmodseq)
+            self.untagged("FLAGS (\\Seen \\Deleted)")
+        return "OK [READ-WRITE] selected"
+
+    def cmd_examine(self, tag, args):
+        return self.cmd_select(tag, args).replace("READ-WRITE", "READ-ONLY")
+
+    def cmd_uid_fetch(self, tag, args):
+        uidset, items = args[0], args[1]
+        if not isinstance(items, list):
+            items = [items]
+        modifiers = [str(x).upper() for x in args[2]] if len(args) > 2 else []
+        changedsince = None
+        if "CHANGEDSINCE" in modifiers:
+            changedsince = int(modifiers[modifiers.index("CHANGEDSINCE") + 1])
+        folder = self.selected
+        with self.server.lock:
+            requested = parse_uid_set(uidset, folder.max_uid)
+            uids = sorted(requested & set(folder.messages))
+            if changedsince is not None:
+                uids = [uid for uid in uids if folder.modseqs[uid] > changedsince]
+                if "VANISHED" in modifiers:
+                    if not self.qresync:
+                        return "BAD QRESYNC not enabled"
+                    start = bisect.bisect_right(folder.expunge_log, (changedsince, float("inf")))
+                    vanished = sorted(uid for modseq, uid in folder.expunge_log[start:]
+                                      if uid in requested)
+                    if vanished:
+                        self.untagged("VANISHED (EARLIER) " + ",".join(map(str, vanished)))
+            seqs = dict((uid, i + 1) for i, uid in enumerate(sorted(folder.messages)))
+            for uid in uids:
+                self.send_fetch(seqs[uid], uid, folder.messages[uid], items,
+                                folder.modseqs[uid])
+        self.report_changes()
+
+    def cmd_uid_search(self, tag, args):
+        folder = self.selected
+        with self.server.lock:
+            uids = set(folder.messages)
+            args = list(args)
+            while args:
+                criterion = str(args.pop(0)).upper()
+                if criterion == "UID":
+                    uids &= parse_uid_set(args.pop(0), folder.max_uid)
+                elif criterion != "ALL":
+                    return "BAD unsupported search criterion %s" % (criterion,)
+        self.untagged(" ".join(["SEARCH"] + [str(uid) for uid in sorted(uids)]))
+        self.report_changes()
+
+    def cmd_uid_move(self, tag, args):
+        folder = self.selected
+        with self.server.lock:
+            if args[1] not in self.server.folders:
+                return "NO [TRYCREATE] no such folder"
+            uids = parse_uid_set(args[0], folder.max_uid)
+            error = self.server.check_move(folder.name, uids)
+            if error is not None:
+                return error
+            moved = self.server.move(folder.name, uids, args[1])
+            if moved:
+                dest = self.server.folders[args[1]]
+                self.untagged("OK [COPYUID %d %s %s]" % (
+                    dest.uidvalidity, ",".join(str(old) for old, new in moved),
+                    ",".join(str(new) for old, new in moved)))
+        self.report_changes()
+
+    def send_fetch(self, seq, uid, raw, items, modseq=0):
+        parts = [b"UID %d" % uid]
+        for item in items:
+            name = item.upper()
+            if name == "MODSEQ":
+                parts.append(b"MODSEQ (%d)" % modseq)
+            elif name == "RFC822.SIZE":
+                parts.append(b"RFC822.SIZE %d" % len(raw))
+            elif name == "FLAGS":
+                parts.append(b"FLAGS ()")
+            elif name.startswith("BODY"):
+                key = name.replace(".PEEK", "")
+                m = re.match(r"BODY\[HEADER\.FIELDS \((.*)\)\]$", key)
+                data = header_fields(raw, m.group(1).split()) if m else raw
+                parts.append(key.encode("ascii") + b" {%d}\r\n" % len(data) + data)
+        self.send(b"* %d FETCH (" % seq + b" ".join(parts) + b")\r\n")
@@ -0,0 +1,86 @@
+"""
+Fast extraction of the header fields the mover needs.
+
+The header FETCH returns From, To, Cc, Date, Chat-Version, Message-ID
+and In-Reply-To, but only the last three decide about moving.  Instead
+of building an email.message.Message for every fetched message (which
+parses and keeps all of them) parse_fields scans the raw bytes for the
+three fields, unfolds them (RFC 5322 2.2.3) and normalizes the
+message-ids once.  Header blocks the scanner doesn't understand (e.g. a
+line which is neither a field nor a continuation) are parsed with the
+email package instead.
+
+A message without a Message-ID gets one made from a hash of its header
+block, like Delta Chat does, so it is recognized when it is fetched
+again (e.g. from the DeltaChat folder after moving it).
+"""
+
+import email
+import hashlib
+
+# field names are printable ASCII except the colon
+FIELD_NAME_BYTES = frozenset(range(33, 127)) - {ord(":")}
+
+
+def normalize_id(value):
+    """ unfold, strip and lowercase a message-id (None becomes "") """
+    if not value:
+        return ""
+    return value.replace("\r", "").replace("\n", "").strip().lower()
+
+
+def decode(value):
+    return value.decode("utf8", "replace")
+
+
+def scan_fields(raw):
+    """ return (message-id, in-reply-to, chat-version) as raw bytes (None for
+    missing fields, the first one wins), or None if raw isn't a plain
+    RFC 5322 header block """
+    values = {b"message-id": None, b"in-reply-to": None, b"chat-version": None}
+    current = None     # name of the wanted field we are reading
+    seen_field = False
+    for line in raw.split(b"\n"):
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        if not line:
+            # end of the header block
+            break
+        if line[0] in (32, 9):
+            # continuation of the previous field
+            if not seen_field:
+                return None
+            if current is not None:
+                values[current] += line
+            continue
+        name, colon, value = line.partition(b":")
+        if not colon or not name or not FIELD_NAME_BYTES.issuperset(name):
+            return None
+        seen_field = True
+        name = name.lower()
+        if name in values and values[name] is None:
+            values[name] = value
+            current = name
+        else:
+            current = None
+    return values[b"message-id"], values[b"in-reply-to"], values[b"chat-version"]
+
+
+def parse_fields(raw):
+    """ return (message-id, in-reply-to, chat-version) of a raw header block,
+    the ids normalized ("" for no In-Reply-To), chat-version None if missing """
+    fields = scan_fields(raw)
+    if fields is not None:
+        message_id, in_reply_to, chat_version = [
+            None if value is None else decode(value) for value in fields]
+    else:
+        msg = email.message_from_bytes(raw)
+        message_id, in_reply_to, chat_version = [
+            None if msg[name] is None else str(msg[name])
+            for name in ("Message-ID", "In-Reply-To", "Chat-Version")]
+    message_id = normalize_id(message_id)
+    if not message_id:
+        message_id = "<%s@missing-message-id.invalid>" % hashlib.sha1(raw).hexdigest()
+    if chat_version is not None:
+        chat_version = chat_version.strip()
+    return message_id, normalize_id(in_reply_to), chat_version
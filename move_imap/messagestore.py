@@ -0,0 +1,377 @@
+"""
+Message stores used by ImapConn.
+
+A store keeps per-folder state (e.g. "last_sync_uid") and a
+MessageRecord for each message the mover has seen, keyed by normalized
+Message-ID.  Records handed out by a store may be modified in place and
+must then be passed to update().  Every store maintains a ThreadIndex
+("threads") over the In-Reply-To links of its records and hands out one
+MoveQueue per folder, which is persisted on sync().  Its Retention
+evicts old threads, whose messages are then only kept as stubs
+(message-id -> (parent-id, Segment, time of the thread's last message)).
+
+DictMessageStore works on top of a PersistentDict/JournaledDict and does
+linear scans for its queries.  Loaded from a snapshot file (see
+snapshot.py) its messages are a SnapshotRecords mapping which creates
+records on access, the queries for pending and moving messages then
+only look at the records it keeps in memory.  Its thread index is built
+on first use, from the links stored in the snapshot.  SqliteMessageStore
+keeps the same data in an indexed SQLite table so that the lookups done
+for every fetched message (children of a parent, moving messages in a
+folder, expired pending messages) are index queries.
+"""
+
+import email.message
+import pickle
+import sqlite3
+import threading
+
+from movequeue import MoveQueue
+from retention import Retention
+from threadindex import (
+    ThreadIndex, Segment, DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+    DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+
+def normalized_messageid(msg):
+    if isinstance(msg, str):
+        return msg.lower()
+    if isinstance(msg, MessageRecord):
+        return msg.message_id
+    return msg["Message-ID"].lower()
+
+
+class MessageRecord(object):
+    """ What the mover needs to know about a message.
+
+    Built from the header fetch alone, message_id and in_reply_to are
+    stored normalized ("" if there is no In-Reply-To).
+    """
+
+    __slots__ = ("message_id", "in_reply_to", "chat_version", "foldername",
+                 "uid", "move_state", "fetch_retrieve_time")
+
+    def __init__(self, message_id, in_reply_to, chat_version, foldername, uid,
+                 move_state=DC_CONSTANT_MSG_MOVESTATE_PENDING, fetch_retrieve_time=0.0):
+        self.message_id = normalized_messageid(message_id)
+        self.in_reply_to = normalized_messageid(in_reply_to or "")
+        self.chat_version = chat_version
+        self.foldername = foldername
+        self.uid = uid
+        self.move_state = move_state
+        self.fetch_retrieve_time = fetch_retrieve_time
+
+    @classmethod
+    def from_headers(cls, msg_headers, **kwargs):
+        return cls(msg_headers["Message-ID"], msg_headers.get("In-Reply-To"),
+                   msg_headers.get("Chat-Version"), **kwargs)
+
+    @classmethod
+    def from_legacy_message(cls, msg):
+        """ convert an email.message.Message as stored by older versions """
+        return cls(msg["Message-ID"], msg.get("In-Reply-To"), msg.get("Chat-Version"),
+                   foldername=msg.foldername, uid=msg.uid, move_state=msg.move_state,
+                   fetch_retrieve_time=msg.fetch_retrieve_time)
+
+    def astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __reduce__(self):
+        # pickle as a plain tuple of values instead of a slot state dict
+        return (self.__class__, self.astuple())
+
+    def __eq__(self, other):
+        return isinstance(other, MessageRecord) and self.astuple() == other.astuple()
+
+    # records are changed in place (move_state, uid), so they can't be hashed
+    __hash__ = None
+
+    def __repr__(self):
+        return "MessageRecord(%s)" % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+
+
+class DictMessageStore(object):
+    def __init__(self, db):
+        self.db = db
+        self.messages = db.setdefault(":message-full", {})
+        # a SnapshotRecords mapping or a dict
+        self.lazy = not isinstance(self.messages, dict)
+        if not self.lazy:
+            for message_id, msg in list(self.messages.items()):
+                if isinstance(msg, email.message.Message):
+                    self.messages[message_id] = MessageRecord.from_legacy_message(msg)
+                    self.db.touch(":message-full", message_id)
+        self.thread_stubs = db.setdefault(":thread-stubs", {})
+        self._threads = None
+        self.movequeues = {}
+        self.retention = Retention(self)
+        self._lock = threading.RLock()
+
+    @property
+    def threads(self):
+        """ the ThreadIndex, built on first use """
+        with self._lock:
+            if self._threads is None:
+                stubs = [(message_id, parent_id, summary)
+                         for message_id, (parent_id, summary, last) in self.stubs()]
+                if self.lazy:
+                    self._threads = self.messages.thread_index(stubs)
+                else:
+                    self._threads = ThreadIndex(self.messages.values(), stubs)
+            return self._threads
+
+    def _active(self):
+        """ the records which may be pending or moving (and maybe more) """
+        if self.lazy:
+            return self.messages.active()
+        return list(self.messages.values())
+
+    def move_queue(self, foldername):
+        """ return the MoveQueue of foldername, shared by all its users """
+        with self._lock:
+            if foldername not in self.movequeues:
+                self.movequeues[foldername] = MoveQueue(self, foldername)
+            return self.movequeues[foldername]
+
+    def get_folder_value(self, foldername, name, default=None):
+        return self.db.setdefault(foldername, {}).get(name, default)
+
+    def set_folder_value(self, foldername, name, value):
+        self.db.setdefault(foldername, {})[name] = value
+        self.db.touch(foldername)
+
+    def has(self, message_id):
+        return normalized_messageid(message_id) in self.messages
+
+    def get(self, message_id):
+        return self.messages.get(normalized_messageid(message_id))
+
+    def add(self, msg):
+        message_id = normalized_messageid(msg)
+        assert message_id not in self.messages, message_id
+        self.messages[message_id] = msg
+        self.db.touch(":message-full", message_id)
+        self.threads.add(msg)
+
+    def update(self, msg):
+        # messages are kept in memory and are thus already up to date,
+        # only let a journaling db and the thread index know about the change.
+        # A snapshot has to keep the changed record though.
+        if self.lazy:
+            self.messages.keep(msg)
+        self.db.touch(":message-full", normalized_messageid(msg))
+        self.threads.update(msg)
+
+    def pending_children(self, message_id):
+        message_id = normalized_messageid(message_id)
+        return [msg for msg in self._active()
+                if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING and
+                msg.in_reply_to == message_id]
+
+    def moving_in_folder(self, foldername):
+        return [msg for msg in self._active()
+                if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING and
+                msg.foldername == foldername and msg.uid > 0]
+
+    def in_folder(self, foldername, uids=None):
+        """ return the messages with a known uid in foldername
+        (restricted to the given uids) """
+        return [msg for msg in list(self.messages.values())
+                if msg.foldername == foldername and msg.uid > 0 and
+                (uids is None or msg.uid in uids)]
+
+    def pending_fetched_before(self, timestamp):
+        return [msg for msg in self._active()
+                if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING and
+                msg.fetch_retrieve_time < timestamp]
+
+    def count(self):
+        return len(self.messages)
+
+    def records(self):
+        return list(self.messages.values())
+
+    def stubs(self):
+        return [(message_id, (stub[0], Segment(*stub[1:4]), stub[4]))
+                for message_id, stub in list(self.thread_stubs.items())]
+
+    def evict(self, stubs):
+        """ delete the records of stubs ({message-id: (parent-id, Segment, time)})
+        and store the stubs instead """
+        for message_id, (parent_id, summary, last) in stubs.items():
+            self.messages.pop(message_id, None)
+            self.db.touch(":message-full", message_id)
+            self.thread_stubs[message_id] = (parent_id,) + tuple(summary) + (last,)
+            self.db.touch(":thread-stubs", message_id)
+
+    def drop_stubs(self, message_ids):
+        for message_id in message_ids:
+            self.thread_stubs.pop(message_id, None)
+            self.db.touch(":thread-stubs", message_id)
+
+    def sync(self):
+        for queue in list(self.movequeues.values()):
+            queue.persist()
+        self.db.sync()
+
+    def close(self):
+        for queue in list(self.movequeues.values()):
+            queue.persist()
+        self.db.close()
+
+
+class SqliteMessageStore(object):
+    """ Message store in an SQLite file.
+
+    Each MessageRecord is one row, with indexes for in-reply-to, move
+    state, folder and fetch time.  Writes are committed on sync(), i.e.
+    once per fetch cycle.  The connection is shared between the ImapConn
+    threads and guarded by a lock.
+    """
+
+    _columns = "message_id, in_reply_to, chat_version, foldername, uid, move_state, fetch_time"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self.conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS folders (
+                    foldername TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value BLOB,
+                    PRIMARY KEY (foldername, name));
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    in_reply_to TEXT NOT NULL,
+                    chat_version TEXT,
+                    foldername TEXT NOT NULL,
+                    uid INTEGER NOT NULL,
+                    move_state INTEGER NOT NULL,
+                    fetch_time REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS messages_in_reply_to
+                    ON messages (in_reply_to, move_state);
+                CREATE INDEX IF NOT EXISTS messages_folder_state
+                    ON messages (move_state, foldername);
+                CREATE INDEX IF NOT EXISTS messages_state_fetch_time
+                    ON messages (move_state, fetch_time);
+                CREATE INDEX IF NOT EXISTS messages_folder_uid
+                    ON messages (foldername, uid);
+                CREATE TABLE IF NOT EXISTS stubs (
+                    message_id TEXT PRIMARY KEY,
+                    parent_id TEXT NOT NULL,
+                    all_dc INTEGER NOT NULL,
+                    dc_run INTEGER NOT NULL,
+                    moved INTEGER NOT NULL,
+                    last_time REAL NOT NULL);
+            """)
+        self.threads = ThreadIndex(self.records(), (
+            (message_id, parent_id, summary)
+            for message_id, (parent_id, summary, last) in self.stubs()))
+        self.movequeues = {}
+        self.retention = Retention(self)
+
+    def move_queue(self, foldername):
+        """ return the MoveQueue of foldername, shared by all its users """
+        with self._lock:
+            if foldername not in self.movequeues:
+                self.movequeues[foldername] = MoveQueue(self, foldername)
+            return self.movequeues[foldername]
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def get_folder_value(self, foldername, name, default=None):
+        rows = self._query("SELECT value FROM folders WHERE foldername=? AND name=?",
+                           (foldername, name))
+        return pickle.loads(rows[0][0]) if rows else default
+
+    def set_folder_value(self, foldername, name, value):
+        self._query("INSERT OR REPLACE INTO folders (foldername, name, value) VALUES (?, ?, ?)",
+                    (foldername, name, pickle.dumps(value, 2)))
+
+    def _select(self, where, args=()):
+        rows = self._query("SELECT %s FROM messages WHERE %s" % (self._columns, where), args)
+        return [MessageRecord(*row) for row in rows]
+
+    def has(self, message_id):
+        return bool(self._query("SELECT 1 FROM messages WHERE message_id=?",
+                                (normalized_messageid(message_id),)))
+
+    def get(self, message_id):
+        msgs = self._select("message_id=?", (normalized_messageid(message_id),))
+        return msgs[0] if msgs else None
+
+    def add(self, msg):
+        self._query("INSERT INTO messages (%s) VALUES (?, ?, ?, ?, ?, ?, ?)" % (
+                    self._columns,), msg.astuple())
+        self.threads.add(msg)
+
+    def update(self, msg):
+        self._query("INSERT OR REPLACE INTO messages (%s) VALUES (?, ?, ?, ?, ?, ?, ?)" % (
+                    self._columns,), msg.astuple())
+        self.threads.update(msg)
+
+    def pending_children(self, message_id):
+        return self._select("in_reply_to=? AND move_state=?",
+                            (normalized_messageid(message_id), DC_CONSTANT_MSG_MOVESTATE_PENDING))
+
+    def moving_in_folder(self, foldername):
+        return self._select("move_state=? AND foldername=? AND uid > 0",
+                            (DC_CONSTANT_MSG_MOVESTATE_MOVING, foldername))
+
+    def in_folder(self, foldername, uids=None):
+        msgs = self._select("foldername=? AND uid > 0", (foldername,))
+        if uids is not None:
+            msgs = [msg for msg in msgs if msg.uid in uids]
+        return msgs
+
+    def pending_fetched_before(self, timestamp):
+        return self._select("move_state=? AND fetch_time < ?",
+                            (DC_CONSTANT_MSG_MOVESTATE_PENDING, timestamp))
+
+    def count(self):
+        return self._query("SELECT COUNT(*) FROM messages")[0][0]
+
+    def records(self):
+        return self._select("1")
+
+    def stubs(self):
+        rows = self._query("SELECT message_id, parent_id, all_dc, dc_run, moved, last_time "
+                           "FROM stubs")
+        return [(row[0], (row[1], Segment(bool(row[2]), row[3], bool(row[4])), row[5]))
+                for row in rows]
+
+    def evict(self, stubs):
+        """ delete the records of stubs ({message-id: (parent-id, Segment, time)})
+        and store the stubs instead """
+        with self._lock:
+            self.conn.executemany("DELETE FROM messages WHERE message_id=?",
+                                  [(message_id,) for message_id in stubs])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO stubs (message_id, parent_id, all_dc, dc_run, moved, "
+                "last_time) VALUES (?, ?, ?, ?, ?, ?)",
+                [(message_id, parent_id) + tuple(summary) + (last,)
+                 for message_id, (parent_id, summary, last) in stubs.items()])
+
+    def drop_stubs(self, message_ids):
+        with self._lock:
+            self.conn.executemany("DELETE FROM stubs WHERE message_id=?",
+                                  [(message_id,) for message_id in message_ids])
+
+    def sync(self):
+        with self._lock:
+            for queue in list(self.movequeues.values()):
+                queue.persist()
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self.conn.close()
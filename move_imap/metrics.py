@@ -0,0 +1,194 @@
+"""
+Per-folder counters and latency histograms of the mover's phases.
+
+ImapConn times its phases with wlog(msg, phase) or timed(phase) and
+counts events with count(name), labelled with account and folder:
+
+- connect: connecting, logging in and selecting the folder
+- fetch_list: the FETCH learning the new uids and their sizes
+- fetch_headers: one header FETCH of a chunk of uids
+- resolve: processing one fetched message (determining its move state)
+- sync: writing the message store
+- move: one UID MOVE command
+- idle: waiting in IDLE
+
+The histograms use fixed buckets like Prometheus client libraries.  A
+Metrics registry can be served as Prometheus text (serve_http) or
+written as JSON (write_json_periodically), both from a daemon thread.
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram(object):
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ upper bound of the bucket containing the q-quantile """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], self.counts)),
+        }
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(**labels):
+    return ",".join('%s="%s"' % (name, escape_label(labels[name])) for name in sorted(labels))
+
+
+class Metrics(object):
+    def __init__(self, prefix="move_imap"):
+        self.prefix = prefix
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.histograms = {}   # (account, folder, phase) -> Histogram
+        self.counters = {}     # (account, folder, name) -> int
+
+    def observe(self, account, folder, phase, seconds):
+        key = (account, folder, phase)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, account, folder, name, num=1):
+        key = (account, folder, name)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + num
+
+    @contextlib.contextmanager
+    def timed(self, account, folder, phase):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(account, folder, phase, time.time() - t0)
+
+    def asdict(self):
+        """ {account: {folder: {"phases": {phase: histogram}, "counters": {name: n}}}} """
+        res = {}
+        with self._lock:
+            for (account, folder, phase), histogram in sorted(self.histograms.items()):
+                entry = res.setdefault(account, {}).setdefault(folder, {})
+                entry.setdefault("phases", {})[phase] = histogram.asdict()
+            for (account, folder, name), num in sorted(self.counters.items()):
+                entry = res.setdefault(account, {}).setdefault(folder, {})
+                entry.setdefault("counters", {})[name] = num
+        return res
+
+    def prometheus(self):
+        """ return the metrics in the Prometheus text exposition format """
+        name = self.prefix + "_phase_seconds"
+        lines = ["# HELP %s Duration of the mover's phases." % name,
+                 "# TYPE %s histogram" % name]
+        with self._lock:
+            for (account, folder, phase), histogram in sorted(self.histograms.items()):
+                labels = format_labels(account=account, folder=folder, phase=phase)
+                cumulative = 0
+                for bound, count in zip([repr(bound) for bound in BUCKETS] + ["+Inf"],
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+                lines.append("%s_sum{%s} %r" % (name, labels, histogram.total))
+                lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+            counters = {}
+            for (account, folder, counter), num in self.counters.items():
+                counters.setdefault(counter, []).append((account, folder, num))
+        for counter in sorted(counters):
+            name = "%s_%s_total" % (self.prefix, counter)
+            lines.append("# TYPE %s counter" % name)
+            for account, folder, num in sorted(counters[counter]):
+                lines.append("%s{%s} %d" % (name, format_labels(account=account, folder=folder),
+                                            num))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"time": time.time(), "started": self.started,
+                       "accounts": self.asdict()}, f, indent=1)
+        os.rename(tmp, path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == "/metrics":
+            body = metrics.prometheus().encode("utf8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics.asdict()).encode("utf8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(metrics, port, host="127.0.0.1"):
+    """ serve /metrics (Prometheus text) and /metrics.json from a daemon thread """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_json_periodically(metrics, path, interval):
+    """ write the metrics as JSON to path every interval seconds from a daemon thread """
+    def run():
+        while True:
+            time.sleep(interval)
+            metrics.write_json(path)
+    threading.Thread(target=run, daemon=True).start()
+
+
+# the registry ImapConn reports to
+METRICS = Metrics()
@@ -1,79 +1,234 @@
+import functools
 import os
+import queue
+import select
 import threading
+import concurrent.futures
 import click
-import ssl
 import atexit
-import email
+import imapclient
 from imapclient import IMAPClient
-from imapclient.exceptions import IMAPClientError
+from imapclient.exceptions import IMAPClientError, IMAPClientAbortError
 import contextlib
 import time
-from persistentdict import PersistentDict
+from persistentdict import PersistentDict, JournaledDict
+from connection import ConnectionManager
+from movequeue import MoveQueue, compress_uids
+from retention import Retention, DAY
+from metrics import METRICS, serve_http, write_json_periodically
+from pollpolicy import PollPolicy
+from headers import parse_fields
+from messagestore import (
+    DictMessageStore, SqliteMessageStore, MessageRecord,
+    DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+    DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
 
 
 INBOX = "INBOX"
 SENT = "Sent"
 MVBOX = "DeltaChat"
-DC_CONSTANT_MSG_MOVESTATE_PENDING = 1
-DC_CONSTANT_MSG_MOVESTATE_STAY = 2
-DC_CONSTANT_MSG_MOVESTATE_MOVING = 3
 
 
-def db_folder_attr(name):
+def db_folder_attr(name, default=1):
     def fget(s):
-        return s.db_folder.get(name, 1)
+        return s.store.get_folder_value(s.foldername, name, default)
     def fset(s, val):
-        s.db_folder[name] = val
+        s.store.set_folder_value(s.foldername, name, val)
     return property(fget, fset, None, None)
 
+FETCH_FIELDS = [
+    b"RFC822.SIZE", b'FLAGS',
+    b"BODY.PEEK[HEADER.FIELDS (FROM TO CC DATE CHAT-VERSION MESSAGE-ID IN-REPLY-TO)]"
+]
+FETCH_HEADER_KEY = FETCH_FIELDS[-1].replace(b'.PEEK', b'')
+
+# a header block is never larger than the message, and rarely larger than this
+HEADER_SIZE_ESTIMATE = 8192
+
+
+def iter_fetch_chunks(uids, sizes, chunk_size, chunk_bytes):
+    """ yield lists of uids to be fetched with one FETCH command each.
+
+    A chunk has at most chunk_size uids and, unless it only holds a single
+    uid, at most chunk_bytes of header data as estimated from RFC822.SIZE.
+    """
+    chunk = []
+    nbytes = 0
+    for uid in uids:
+        size = min(sizes[uid].get(b"RFC822.SIZE", 0), HEADER_SIZE_ESTIMATE)
+        if chunk and (len(chunk) >= chunk_size or nbytes + size > chunk_bytes):
+            yield chunk
+            chunk = []
+            nbytes = 0
+        chunk.append(uid)
+        nbytes += size
+    if chunk:
+        yield chunk
+
+
+def parse_vanished(data):
+    """ return the set of uids of a VANISHED response like b'(EARLIER) 3:5,9' """
+    uids = set()
+    for part in data.split()[-1].decode("ascii").split(","):
+        lo, _, hi = part.partition(":")
+        lo, hi = int(lo), int(hi or lo)
+        uids.update(range(min(lo, hi), max(lo, hi) + 1))
+    return uids
+
+
+def idle_vanished(responses):
+    """ return the data of the VANISHED responses among IMAPClient.idle_check()
+    results, e.g. (b'VANISHED', b'3:5') -> b'3:5' """
+    return [resp[-1] if isinstance(resp[-1], bytes) else str(resp[-1]).encode("ascii")
+            for resp in responses if resp[0] == b"VANISHED"]
+
+
+# IMAPClient has no public API for a UID FETCH of a uid range, nor for
+# the untagged responses which it doesn't parse (VANISHED).  fetch_range()
+# and pop_untagged() are the only users of its private parts, which these
+# major versions have.  With another version ImapConn leaves QRESYNC off.
+IMAPCLIENT_PRIVATE_VERSIONS = (2, 3, 4)
+
+
+def imapclient_private_ok(version=imapclient.__version__):
+    """ whether fetch_range() and pop_untagged() work with IMAPClient version """
+    major = version.split(".")[0]
+    return (major.isdigit() and int(major) in IMAPCLIENT_PRIVATE_VERSIONS and
+            callable(getattr(IMAPClient, "_command_and_check", None)))
+
+
+def fetch_range(conn, uids, data, modifiers=()):
+    """ UID FETCH a uid range like "1:5" (IMAPClient.fetch() only takes
+    single uids) and return imaplib's raw response data """
+    args = [uids, "(%s)" % " ".join(data)]
+    if modifiers:
+        args.append("(%s)" % " ".join(modifiers))
+    return conn._command_and_check("fetch", *args, uid=True)
+
+
+def pop_untagged(conn, name):
+    """ return and forget the data of the untagged responses name (e.g.
+    "VANISHED") of an IMAPClient.  It leaves the responses it doesn't
+    parse in the untagged_responses dict of its imaplib connection. """
+    responses = conn._imap.untagged_responses
+    return responses.pop(name, [])
+
+# errors after which a folder reconnects instead of dying
+CONNECTION_ERRORS = (IMAPClientError, OSError)
+
 lock_log = threading.RLock()
 started = time.time()
 
 
 class ImapConn(object):
-    def __init__(self, db, foldername, conn_info):
-        self.db = db
+    # upper bounds for the uids (and estimated header bytes) per FETCH
+    fetch_chunk_size = 500
+    fetch_chunk_bytes = 2 * 1024 * 1024
+    # uids per FETCH of the sizes, which keeps the command line short
+    fetch_list_size = 5000
+
+    # IMAP port (None for the default) and whether to use TLS
+    port = None
+    use_ssl = True
+
+    # seconds until a blocking IMAP command gives up on a silent server
+    socket_timeout = 120
+
+    # connections fetching the header chunks in parallel if there are
+    # more chunks than that, e.g. on the initial sync of a large folder
+    sync_connections = 4
+
+    # print what we are doing (all folders share stdout and lock_log)
+    verbose = True
+    # registry for the timings of our phases and event counters
+    metrics = METRICS
+
+    # factory of the PollPolicy deciding between IDLE and polling,
+    # None to always IDLE
+    poll_policy = None
+
+    # whether the client lets us see VANISHED responses, see pop_untagged()
+    client_reports_vanished = imapclient_private_ok()
+
+    def __init__(self, store, foldername, conn_info, connmanager=None):
+        # persistent database state lives in the store
+        self.store = store
         self.foldername = foldername
         self._thread = None
         self.MHOST, self.MUSER, self.MPASSWORD = conn_info
+        # folders of one account should share a connection manager
+        if connmanager is None:
+            connmanager = ConnectionManager(self.MHOST, self.use_ssl)
+        self.connmanager = connmanager
+        self.conn = None
         self.event_initial_polling_complete = threading.Event()
-        self.pending_imap_jobs = False
-
-        # persistent database state below
-        self.db_folder = self.db.setdefault(foldername, {})
-        self.db_messages = self.db.setdefault(":message-full", {})
-
-    last_sync_uid = db_folder_attr("last_sync_uid")
+        # QRESYNC enabled on the connection, HIGHESTMODSEQ of the folder
+        # when it was selected (0 if the server has no CONDSTORE) and
+        # whether we synced up to it since selecting the folder
+        self.qresync = False
+        self.select_modseq = 0
+        self.delta_synced = False
+        self.policy = None if self.poll_policy is None else self.poll_policy(now=time.time())
+        # messages fetched so far and when the policy last observed them
+        self.num_fetched = 0
+        self._observed = 0
+        # the connection on which we last caught up with the folder
+        self._synced_conn = None
+
+    last_sync_uid = db_folder_attr("last_sync_uid", 0)
+
+    @property
+    def movequeue(self):
+        """ messages waiting to be moved out of our folder """
+        return self.store.move_queue(self.foldername)
+    # UIDVALIDITY and HIGHESTMODSEQ of the folder at the last complete sync
+    uidvalidity = db_folder_attr("uidvalidity", 0)
+    highest_modseq = db_folder_attr("highest_modseq", 0)
 
     @contextlib.contextmanager
-    def wlog(self, msg):
-        t = time.time() - started
-        with lock_log:
-            print("%03.2f [%s] %s -->" % (t, self.foldername, msg))
-            t0 = time.time()
+    def wlog(self, msg, phase=None):
+        """ log start and finish of msg and record its duration as phase """
+        t0 = time.time()
+        if self.verbose:
+            with lock_log:
+                print("%03.2f [%s] %s -->" % (t0 - started, self.foldername, msg))
         yield
         t1 = time.time()
-        with lock_log:
-            print("%03.2f [%s] ... finish %s (%3.2f secs)" % (t1-started, self.foldername, msg, t1-t0))
+        if phase is not None:
+            self.metrics.observe(self.MUSER, self.foldername, phase, t1 - t0)
+        if self.verbose:
+            with lock_log:
+                print("%03.2f [%s] ... finish %s (%3.2f secs)" % (t1-started, self.foldername, msg, t1-t0))
+
+    def timed(self, phase):
+        return self.metrics.timed(self.MUSER, self.foldername, phase)
+
+    def count(self, name, num=1):
+        self.metrics.count(self.MUSER, self.foldername, name, num)
 
     def log(self, *msgs):
+        if not self.verbose:
+            return
         t = time.time() - started
         bmsg = "%03.2f [%s]" %(t, self.foldername)
         with lock_log:
             print(bmsg, *msgs)
 
     def connect(self):
-        with self.wlog("IMAP_CONNECT {}: {}".format(self.MUSER, self.MPASSWORD)):
-            ssl_context = ssl.create_default_context()
-
-            # don't check if certificate hostname doesn't match target hostname
-            ssl_context.check_hostname = False
-
-            # don't check if the certificate is trusted by a certificate authority
-            ssl_context.verify_mode = ssl.CERT_NONE
-            self.conn = IMAPClient(self.MHOST, ssl_context=ssl_context)
+        with self.wlog("IMAP_CONNECT {}: {}".format(self.MUSER, self.MPASSWORD), "connect"):
+            t0 = time.time()
+            self.conn = IMAPClient(self.MHOST, port=self.port, ssl=self.use_ssl,
+                                   ssl_context=self.connmanager.ssl_context,
+                                   timeout=self.socket_timeout)
             self.conn.login(self.MUSER, self.MPASSWORD)
+            self.connmanager.connected(self.foldername, time.time() - t0,
+                                       self.conn.socket() if self.use_ssl else None)
             self.log(self.conn.welcome)
+            capabilities = self.conn.capabilities()
+            self.check_capabilities(capabilities)
+            if self.want_qresync(capabilities):
+                self.qresync = b"QRESYNC" in self.conn.enable(b"QRESYNC")
             try:
                 self.select_info = self.conn.select_folder(self.foldername)
             except IMAPClientError:
@@ -81,7 +236,68 @@ class ImapConn(object):
                 self.select_info = self.conn.select_folder(self.foldername)
 
             self.log('folder has %d messages' % self.select_info[b'EXISTS'])
-            self.log('capabilities', self.conn.capabilities())
+            self.log('capabilities', capabilities)
+            self.check_select_info()
+
+    def check_capabilities(self, capabilities):
+        if self.policy is not None:
+            self.policy.can_idle = b"IDLE" in capabilities
+
+    def want_qresync(self, capabilities):
+        if b"QRESYNC" not in capabilities or b"ENABLE" not in capabilities:
+            return False
+        if not self.client_reports_vanished:
+            self.log("not enabling QRESYNC, IMAPClient %s is not known to report "
+                     "VANISHED responses" % (imapclient.__version__,))
+            return False
+        return True
+
+    def check_select_info(self):
+        """ compare UIDVALIDITY and HIGHESTMODSEQ of the just selected folder
+        with the state of our last complete sync. """
+        uidvalidity = self.select_info.get(b"UIDVALIDITY", 0)
+        if self.uidvalidity and uidvalidity != self.uidvalidity:
+            self.log("UIDVALIDITY changed from %s to %s, forgetting all uids" % (
+                     self.uidvalidity, uidvalidity))
+            for dbmsg in self.store.in_folder(self.foldername):
+                dbmsg.uid = 0
+                self.store.update(dbmsg)
+            self.movequeue.discard()
+            self.last_sync_uid = 0
+            self.highest_modseq = 0
+        self.uidvalidity = uidvalidity
+        self.select_modseq = self.select_info.get(b"HIGHESTMODSEQ", 0)
+        self.delta_synced = False
+
+    def connect_with_backoff(self):
+        """ connect, waiting a randomized and exponentially growing
+        delay between failed attempts """
+        while True:
+            delay = self.connmanager.delay(self.foldername)
+            if delay:
+                self.log("connecting in %.1f secs" % (delay,))
+                time.sleep(delay)
+            try:
+                self.connect()
+                return
+            except CONNECTION_ERRORS as e:
+                self.connection_failed("connect failed:", e)
+
+    def connection_failed(self, msg, error):
+        """ count and log a failed connect or a broken connection and drop it """
+        self.log(msg, repr(error))
+        self.count("connection_errors")
+        self.connmanager.failed(self.foldername)
+        self.close()
+
+    def close(self):
+        """ drop the connection without talking to the server """
+        if self.conn is not None:
+            try:
+                self.conn.shutdown()
+            except CONNECTION_ERRORS:
+                pass
+            self.conn = None
 
     def ensure_folder_exists(self):
         with self.wlog("ensure_folder_exists: {}".format(self.foldername)):
@@ -94,27 +310,74 @@ class ImapConn(object):
             else:
                 print("Server sent:", resp if resp else "nothing")
 
-    def move(self, messages):
-        self.log("IMAP_MOVE to {}: {}".format(MVBOX, messages))
+    def move(self, uids):
+        """ move uids to the mvbox, return the error if the MOVE failed """
+        uidset = compress_uids(uids)
+        self.log("IMAP_MOVE to {}: {}".format(MVBOX, uidset))
         try:
-            resp = self.conn.move(messages, MVBOX)
+            with self.timed("move"):
+                self.conn.move(uidset, MVBOX)
+        except IMAPClientAbortError:
+            raise
         except IMAPClientError as e:
-            if "EXPUNGEISSUED" in str(e):
-                self.log("IMAP_MOVE errored with EXPUNGEISSUED, probably another client moved it")
+            self.log("IMAP_MOVE {} failed: {}".format(uidset, e))
+            return e
+        self.log("IMAP_MOVE {} successfully completed.".format(uidset))
+
+    def finish_move(self, uids, error):
+        """ take moved uids off the queue, or count a failed move of a single uid """
+        if error is not None:
+            self.count("move_errors")
+            if "EXPUNGEISSUED" in str(error) or "NONEXISTENT" in str(error):
+                self.log("IMAP_MOVE errored with {}, probably another client moved it".format(error))
             else:
-                self.log("IMAP_MOVE {} successfully completed.".format(messages))
-
-    def perform_imap_idle(self):
-        if self.pending_imap_jobs:
-            self.log("perform_imap_idle skipped because jobs are pending")
-            return
-        with self.wlog("IMAP_IDLE()"):
+                for uid in uids:
+                    if self.movequeue.failed(uid):
+                        self.log("giving up moving uid", uid)
+                return
+        else:
+            self.count("moved_messages", len(uids))
+        moved_msgs = [self.store.get(message_id) for message_id in self.movequeue.discard(uids)]
+        self.moves_done([dbmsg for dbmsg in moved_msgs if dbmsg is not None])
+
+    def idle_wait(self, deadline=None):
+        """ seconds to wait for the next IDLE response: at most 30, and not
+        beyond the deadline or the time when queued moves are due """
+        wait = 30
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+        move_wait = self.movequeue.wait_time()
+        if move_wait is not None:
+            wait = min(wait, move_wait)
+        return wait
+
+    def socket_readable(self):
+        """ whether the connection has something to read right now """
+        return bool(select.select([self.conn.socket()], [], [], 0)[0])
+
+    def perform_imap_idle(self, timeout=None):
+        """ IDLE until the server reports new messages, queued moves are due
+        or timeout seconds passed.  Return True if new messages arrived. """
+        if self.movequeue.due():
+            self.log("perform_imap_idle skipped because moves are due")
+            return True
+        with self.wlog("IMAP_IDLE()", "idle"):
             res = self.conn.idle()
+            deadline = None if timeout is None else time.time() + timeout
             interrupted = False
             while not interrupted:
-                # Wait for up to 30 seconds for an IDLE response
-                responses = self.conn.idle_check(timeout=30)
+                wait = self.idle_wait(deadline)
+                if wait <= 0:
+                    break
+                responses = self.conn.idle_check(timeout=wait)
+                if not responses and self.socket_readable():
+                    # idle_check() swallows the EOF of a closed connection:
+                    # ending IDLE fails on it, or returns what arrived meanwhile
+                    responses = self.conn.idle_done()[1]
+                    self.conn.idle()
                 self.log("Server sent:", responses if responses else "nothing")
+                # expunged while we wait, with QRESYNC enabled
+                self.process_vanished(idle_vanished(responses))
                 for resp in responses:
                     if resp[1] == b"EXISTS":
                         # we ignore what is returned and just let
@@ -122,72 +385,257 @@ class ImapConn(object):
                         # id = resp[0]
                         interrupted = True
             resp = self.conn.idle_done()
+        return interrupted
+
+    def next_wait(self):
+        """ tell the policy about the messages fetched since the last call,
+        not counting the catch-up sync of a connection (see fetch_done()),
+        and return its ("idle", seconds) or ("poll", seconds) """
+        now = time.time()
+        self.policy.observe(now, self.num_fetched - self._observed)
+        self._observed = self.num_fetched
+        return self.policy.next_wakeup(now)
+
+    def poll_wait_time(self, seconds):
+        """ seconds to wait before the next poll, less if queued moves are due """
+        move_wait = self.movequeue.wait_time()
+        if move_wait is not None:
+            seconds = min(seconds, move_wait)
+        return seconds
+
+    def wait_for_messages(self):
+        """ IDLE, or wait until the next poll if the poll policy says so """
+        if self.policy is None:
+            return self.perform_imap_idle()
+        mode, seconds = self.next_wait()
+        if mode == "idle":
+            return self.perform_imap_idle(timeout=seconds)
+        seconds = self.poll_wait_time(seconds)
+        if seconds > 0:
+            with self.wlog("POLL_WAIT %.0f secs" % (seconds,), "poll_wait"):
+                time.sleep(seconds)
+        return False
 
     def perform_imap_fetch(self):
+        if self.folder_unchanged():
+            self.log("HIGHESTMODSEQ %s unchanged since last sync, nothing to fetch" % (
+                     self.select_modseq,))
+            self.fetch_done()
+            return
         range = "%s:*" % (self.last_sync_uid + 1,)
         with self.wlog("IMAP_PERFORM_FETCH %s" % (range,)):
-            requested_fields = [
-                b"RFC822.SIZE", b'FLAGS',
-                b"BODY.PEEK[HEADER.FIELDS (FROM TO CC DATE CHAT-VERSION MESSAGE-ID IN-REPLY-TO)]"
-            ]
-            resp = self.conn.fetch(range, requested_fields)
-            timestamp_fetch = time.time()
-            for uid in sorted(resp):  # get lower uids first
-                if uid < self.last_sync_uid:
-                    self.log("IMAP-ODDITY: ignoring bogus uid %s, it is lower than min-requested %s" %(
-                             uid, self.last_sync_uid))
-                    continue
-                data = resp[uid]
-                headers = data[requested_fields[-1].replace(b'.PEEK', b'')]
-                msg_headers = email.message_from_bytes(headers)
-                message_id = normalized_messageid(msg_headers)
-                chat_version = msg_headers.get("Chat-Version")
-                in_reply_to = msg_headers.get("In-Reply-To", "").lower()
-
-                if not self.has_message(normalized_messageid(msg_headers)):
-                    self.log('fetching body of ID %d: %d bytes, message-id=%s '
-                             'in-reply-to=%s chat-version=%s' % (
-                             uid, data[b'RFC822.SIZE'], message_id, in_reply_to, chat_version,))
-                    fetchbody_resp = self.conn.fetch(uid, [b'BODY.PEEK[]'])
-                    msg = email.message_from_bytes(fetchbody_resp[uid][b'BODY[]'])
-                    msg.fetch_retrieve_time = timestamp_fetch
-                    msg.foldername = self.foldername
-                    msg.uid = uid
-                    msg.move_state = DC_CONSTANT_MSG_MOVESTATE_PENDING
-                    self.store_message(message_id, msg)
-                else:
-                    msg = self.get_message_from_db(message_id)
-                    self.log('fetching-from-db: ID %s message-id=%s' % (uid, message_id))
-                    if msg.foldername != self.foldername:
-                        self.log("detected moved message", message_id)
-                        msg.foldername = self.foldername
-                        msg.move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
-
-                if self.foldername in (INBOX, SENT):
-                    if self.resolve_move_status(msg) != DC_CONSTANT_MSG_MOVESTATE_PENDING:
-                        # see if there are pending messages which have a in-reply-to
-                        # to our currnet msg
-                        # NOTE: should be one sql-statement to find the
-                        # possibly multiple messages that waited on us
-                        for dbmid, dbmsg in self.db_messages.items():
-                            if dbmsg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING:
-                                if dbmsg.get("In-Reply-To", "").lower() == message_id:
-                                    self.log("resolving pending message", dbmid)
-                                    # resolving the dependent message must work now
-                                    res = self.resolve_move_status(dbmsg)
-                                    assert res != DC_CONSTANT_MSG_MOVESTATE_PENDING, (dbmid, res)
-
-                if not self.has_message(message_id):
-                    self.store_message(message_id, msg)
-
-                self.last_sync_uid = max(uid, self.last_sync_uid)
+            vanished_args = self.vanished_fetch_args()
+            if vanished_args is not None:
+                # only the server's VANISHED response is of interest here
+                fetch_range(self.conn, vanished_args[0], ["UID"], vanished_args[1])
+            # first learn which uids are new (and how large they are),
+            # then fetch their headers in chunks of multiple uids
+            with self.timed("fetch_list"):
+                sizes = self.fetch_sizes(self.search_new_uids())
+            chunks = list(self.iter_new_uid_chunks(sizes))
+            if 1 < self.sync_connections < len(chunks):
+                self.fetch_chunks_parallel(chunks)
+            else:
+                for chunk in chunks:
+                    with self.timed("fetch_headers"):
+                        resp = self.conn.fetch(chunk, FETCH_FIELDS)
+                    self.process_fetch_chunk(resp)
+                    self.sync_store()
+                    # don't let a long initial sync hold back the moves
+                    self.perform_imap_jobs()
+            self.process_vanished(self.pop_vanished())
 
         self.log("last-sync-uid after fetch:", self.last_sync_uid)
-        self.db.sync()
+        self.fetch_done()
+        self.sync_store()
+
+    def search_new_uids(self):
+        """ return the uids above last_sync_uid.  IMAPClient.fetch() only
+        takes uids, not ranges like "n:*", and "n:*" also matches the
+        highest uid if it is below n. """
+        uids = self.conn.search(["UID", "%d:*" % (self.last_sync_uid + 1)])
+        return sorted(uid for uid in uids if uid > self.last_sync_uid)
+
+    def fetch_sizes(self, uids):
+        sizes = {}
+        for i in range(0, len(uids), self.fetch_list_size):
+            sizes.update(self.conn.fetch(uids[i:i + self.fetch_list_size], [b"RFC822.SIZE"]))
+        return sizes
+
+    def open_fetch_connection(self):
+        """ open another connection with our folder selected read-only """
+        conn = IMAPClient(self.MHOST, port=self.port, ssl=self.use_ssl,
+                          ssl_context=self.connmanager.ssl_context,
+                          timeout=self.socket_timeout)
+        conn.login(self.MUSER, self.MPASSWORD)
+        select_info = conn.select_folder(self.foldername, readonly=True)
+        if select_info.get(b"UIDVALIDITY", 0) != self.uidvalidity:
+            conn.logout()
+            raise IMAPClientAbortError("UIDVALIDITY of %s changed" % (self.foldername,))
+        return conn
+
+    def fetch_chunks_parallel(self, chunks):
+        """ fetch the header chunks over sync_connections extra connections,
+        at most two per connection ahead of processing them in uid order.
+        Every processed chunk is a checkpoint like with the serial fetch. """
+        num = min(self.sync_connections, len(chunks))
+        window = 2 * num
+        conns = queue.Queue()
+        opened = []
+
+        def open_conn():
+            conn = self.open_fetch_connection()
+            opened.append(conn)
+            conns.put(conn)
+
+        def fetch(chunk):
+            conn = conns.get()
+            try:
+                with self.timed("fetch_headers"):
+                    return conn.fetch(chunk, FETCH_FIELDS)
+            finally:
+                conns.put(conn)
+
+        futures = {}
+        executor = concurrent.futures.ThreadPoolExecutor(num)
+        with self.wlog("parallel fetch of %d chunks over %d connections" % (len(chunks), num)):
+            try:
+                for future in [executor.submit(open_conn) for _ in range(num)]:
+                    future.result()
+                for i in range(len(chunks)):
+                    for j in range(i, min(i + window, len(chunks))):
+                        if j not in futures:
+                            futures[j] = executor.submit(fetch, chunks[j])
+                    self.process_fetch_chunk(futures.pop(i).result())
+                    self.sync_store()
+                    self.perform_imap_jobs()
+            finally:
+                for future in futures.values():
+                    future.cancel()
+                executor.shutdown(wait=True)
+                for conn in opened:
+                    try:
+                        conn.logout()
+                    except CONNECTION_ERRORS:
+                        pass
+
+    def folder_unchanged(self):
+        """ Return True if the folder did not change since our last complete sync.
+        This is only known for the first fetch after selecting the folder. """
+        return (not self.delta_synced and self.select_modseq > 0 and
+                self.select_modseq == self.highest_modseq)
+
+    def vanished_fetch_args(self):
+        """ Return (uid range, fetch modifiers) for learning about the messages
+        expunged since our last complete sync, or None if there's no need
+        (or no QRESYNC).  Within a session the server reports expunges
+        as VANISHED responses by itself. """
+        if self.delta_synced or not self.qresync or not self.highest_modseq:
+            return None
+        if self.last_sync_uid < 1:
+            return None
+        return ("1:%d" % self.last_sync_uid,
+                ["CHANGEDSINCE %d" % self.highest_modseq, "VANISHED"])
+
+    def pop_vanished(self):
+        if not self.qresync:
+            # the server doesn't send VANISHED
+            return []
+        return pop_untagged(self.conn, "VANISHED")
+
+    def process_vanished(self, responses):
+        """ forget the uids of our messages which were expunged from the folder """
+        uids = set()
+        for data in responses:
+            uids.update(parse_vanished(data))
+        if not uids:
+            return
+        for dbmsg in self.store.in_folder(self.foldername, uids):
+            self.log("vanished uid=%s message-id=%s" % (dbmsg.uid, dbmsg.message_id))
+            dbmsg.uid = 0
+            self.store.update(dbmsg)
+        self.movequeue.discard(uids)
+
+    def fetch_done(self):
+        if not self.delta_synced:
+            # everything up to the HIGHESTMODSEQ of SELECT time is synced now
+            self.delta_synced = True
+            if self.select_modseq:
+                self.highest_modseq = self.select_modseq
+        if self._synced_conn is not self.conn:
+            # the first fetch on a connection catches up with what arrived
+            # before, which the poll policy shouldn't see as arrivals
+            self._synced_conn = self.conn
+            self._observed = self.num_fetched
+
+    def iter_new_uid_chunks(self, sizes):
+        uids = []
+        for uid in sorted(sizes):  # get lower uids first
+            if uid < self.last_sync_uid:
+                self.log("IMAP-ODDITY: ignoring bogus uid %s, it is lower than min-requested %s" %(
+                         uid, self.last_sync_uid))
+                continue
+            if uid == self.last_sync_uid:
+                # "n:*" also matches the highest uid, which we already have
+                continue
+            uids.append(uid)
+        return iter_fetch_chunks(uids, sizes, self.fetch_chunk_size, self.fetch_chunk_bytes)
+
+    def process_fetch_chunk(self, resp):
+        timestamp_fetch = time.time()
+        for uid in sorted(resp):
+            with self.timed("resolve"):
+                self.process_fetched_message(uid, resp[uid], timestamp_fetch)
+        self.count("fetched_messages", len(resp))
+        self.num_fetched += len(resp)
+
+    def sync_store(self):
+        """ write the store, called after each fetched chunk so that an
+        interrupted initial sync resumes after the last one """
+        with self.timed("sync"):
+            self.store.sync()
+
+    def process_fetched_message(self, uid, data, timestamp_fetch):
+        # the ids come normalized, see headers.py
+        message_id, in_reply_to, chat_version = parse_fields(data[FETCH_HEADER_KEY])
+
+        msg = self.get_message_from_db(message_id)
+        if msg is None:
+            self.log('new message ID %d: %d bytes, message-id=%s '
+                     'in-reply-to=%s chat-version=%s' % (
+                     uid, data[b'RFC822.SIZE'], message_id, in_reply_to, chat_version,))
+            msg = MessageRecord(message_id, in_reply_to, chat_version,
+                                foldername=self.foldername, uid=uid,
+                                fetch_retrieve_time=timestamp_fetch)
+            self.store_message(message_id, msg)
+        else:
+            self.log('fetching-from-db: ID %s message-id=%s' % (uid, message_id))
+            if msg.foldername != self.foldername:
+                self.log("detected moved message", message_id)
+                msg.foldername = self.foldername
+                msg.uid = uid
+                msg.move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
+                self.store.update(msg)
+            elif msg.uid != uid:
+                # e.g. refetched after UIDVALIDITY changed
+                self.log("uid of message-id=%s is now %s" % (message_id, uid))
+                msg.uid = uid
+                self.store.update(msg)
+                if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING:
+                    self.movequeue.add(msg)
+
+        if self.foldername in (INBOX, SENT):
+            self.resolve_move_status(msg)
+            # resolve pending messages down the thread which waited on us
+            for dbmid in self.store.threads.pending_descendants(message_id):
+                self.log("resolving pending message", dbmid)
+                self.resolve_move_status(self.get_message_from_db(dbmid))
+
+        self.last_sync_uid = max(uid, self.last_sync_uid)
 
     def resolve_move_status(self, msg):
         """ Return move-state after this message's next move-state is determined (i.e. it is not PENDING)"""
-        message_id = normalized_messageid(msg)
+        message_id = msg.message_id
         if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING:
             res = self.determine_next_move_state(msg)
             if res == DC_CONSTANT_MSG_MOVESTATE_MOVING:
@@ -198,71 +646,48 @@ class ImapConn(object):
                 msg.move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
             else:
                 self.log("PENDING uid=%s message-id=%s in-reply-to=%s" %(
-                         msg.uid, message_id, msg["In-Reply-To"]))
+                         msg.uid, message_id, msg.in_reply_to))
+            self.store.update(msg)
         return msg.move_state
 
     def determine_next_move_state(self, msg):
         """ Return the next move state for this message.
         Only call this function if the message is pending.
-        This function works with the DB, does not perform any IMAP commands.
+        This function works with the thread index of the store, does not
+        perform any IMAP commands.
         """
-        self.log("shall_move %s " %(normalized_messageid(msg)))
+        self.log("shall_move %s " %(msg.message_id))
         assert self.foldername in (INBOX, SENT)
         assert msg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING
         if msg.foldername == MVBOX:
-            self.log("is already in mvbox, next state is STAY %s" %(normalized_messageid(msg)))
+            self.log("is already in mvbox, next state is STAY %s" %(msg.message_id))
             return DC_CONSTANT_MSG_MOVESTATE_STAY
-        last_dc_count = 0
-        while 1:
-            last_dc_count = (last_dc_count + 1) if is_dc_message(msg) else 0
-            in_reply_to = normalized_messageid(msg.get("In-Reply-To", ""))
-            if not in_reply_to:
-                type_msg = "DC" if last_dc_count else "CLEAR"
-                self.log("detected thread-start %s message" % type_msg, normalized_messageid(msg))
-                if last_dc_count > 0:
-                    return DC_CONSTANT_MSG_MOVESTATE_MOVING
-                else:
-                    return DC_CONSTANT_MSG_MOVESTATE_STAY
-
-            newmsg = self.get_message_from_db(in_reply_to)
-            if not newmsg:
-                self.log("failed to fetch from db:", in_reply_to)
-                # we don't have the parent message ... maybe because
-                # it hasn't arrived (yet), was deleted or we failed to
-                # scan/fetch it:
-                if last_dc_count >= 4:
-                    self.log("no thread-start found, but last 4 messages were DC")
-                    return DC_CONSTANT_MSG_MOVESTATE_MOVING
-                else:
-                    self.log("pending: missing parent, last_dc_count=%x" %(last_dc_count, ))
-                    return DC_CONSTANT_MSG_MOVESTATE_PENDING
-            elif newmsg.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING:
-                self.log("parent was a moved message")
-                return DC_CONSTANT_MSG_MOVESTATE_MOVING
-            else:
-                msg = newmsg
-        assert 0, "should never arrive here"
+        res = self.store.threads.next_move_state(msg.message_id)
+        if res == DC_CONSTANT_MSG_MOVESTATE_PENDING:
+            self.log("pending: missing parent", msg.in_reply_to)
+        return res
 
     def schedule_move(self, msg):
-        message_id = normalized_messageid(msg)
+        message_id = msg.message_id
         assert msg.foldername != MVBOX
+        if not msg.uid:
+            self.log("not scheduling move, message-id=%s is gone" % (message_id,))
+            return
         self.log("scheduling move message-id=%s" % (message_id))
-        self.pending_imap_jobs = True
+        # the message may be in another folder than ours
+        self.store.move_queue(msg.foldername).add(msg)
 
     def has_message(self, message_id):
         assert isinstance(message_id, str)
-        return message_id in self.db_messages
+        return self.store.has(message_id)
 
     def get_message_from_db(self, message_id):
-        return self.db_messages.get(normalized_messageid(message_id))
+        return self.store.get(message_id)
 
     def store_message(self, message_id, msg):
-        mid2 = normalized_messageid(msg)
-        message_id = normalized_messageid(message_id)
-        assert message_id == mid2
-        assert message_id not in self.db_messages, message_id
+        assert message_id == msg.message_id
         assert msg.foldername in (MVBOX, SENT, INBOX)
-        self.db_messages[message_id] = msg
+        self.store.add(msg)
         self.log("stored new message message-id=%s" %(message_id,))
 
     def forget_about_too_old_pending_messages(self):
@@ -270,50 +695,64 @@ class ImapConn(object):
         # because the involved sql-statements
         # probably don't care if there are some foreever-pending messages
         now = time.time()
-        for dbmid, dbmsg in self.db_messages.items():
-            if dbmsg.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING:
-                delay = now - dbmsg.fetch_retrieve_time
-                if delay > self.pendingtimeout:
-                    dbmsg.move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
-                    self.log("pendingtimeout: message now set to stay", dbmid)
+        for dbmsg in self.store.pending_fetched_before(now - self.pendingtimeout):
+            dbmsg.move_state = DC_CONSTANT_MSG_MOVESTATE_STAY
+            self.store.update(dbmsg)
+            self.log("pendingtimeout: message now set to stay", dbmsg.message_id)
+
+    def evict_old_threads(self):
+        """ drop old resolved threads from the database, see retention.py """
+        retention = self.store.retention
+        if retention.due():
+            with self.wlog("evict_old_threads()"):
+                evicted, dropped = retention.run()
+                self.log("evicted %d messages, dropped %d stubs" % (evicted, dropped))
 
     def perform_imap_jobs(self):
+        if not self.movequeue.due():
+            return
         with self.wlog("perform_imap_jobs()"):
-            if self.foldername in (INBOX, SENT):
-                to_move_uids = []
-                to_move_msgs = []
-
-                # determine all uids of messages that are to be moved
-                for dbmid, dbmsg in self.db_messages.items():
-                    if dbmsg.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING:
-                        if dbmsg.uid > 0:  # else it's already moved?
-                            to_move_uids.append(dbmsg.uid)
-                            to_move_msgs.append(dbmsg)
-                if to_move_uids:
-                    self.move(to_move_uids)
-                # now that we moved let's invalidate "uid" because it's
-                # not there anyore in thie folder
-                for dbmsg in to_move_msgs:
-                    dbmsg.uid = 0
-            self.pending_imap_jobs = False
+            for batch in self.movequeue.batches():
+                error = self.move(batch)
+                if error is not None and len(batch) > 1:
+                    # find out which ones fail by moving them one by one
+                    for uid in batch:
+                        self.finish_move([uid], self.move([uid]))
+                else:
+                    self.finish_move(batch, error)
+
+    def moves_done(self, moved_msgs):
+        # now that we moved let's invalidate "uid" because it's
+        # not there anyore in thie folder
+        for dbmsg in moved_msgs:
+            dbmsg.uid = 0
+            self.store.update(dbmsg)
 
     def _run_in_thread(self):
-        self.connect()
+        self.connect_with_backoff()
         if self.foldername == INBOX:
             # INBOX loop should wait until MVBOX polled once
             mvbox.event_initial_polling_complete.wait()
         now = time.time()
         while True:
-            self.perform_imap_jobs()
-            self.perform_imap_fetch()
-            if self.foldername == MVBOX:
-                # signal that MVBOX has polled once
-                self.event_initial_polling_complete.set()
-            elif self.foldername == INBOX:
-                # it's not clear we need to do this housekeeping
-                # (depends on the SQL statements)
-                self.forget_about_too_old_pending_messages()
-            self.perform_imap_idle()
+            try:
+                self.perform_imap_jobs()
+                self.perform_imap_fetch()
+                if self.foldername == MVBOX:
+                    # signal that MVBOX has polled once
+                    self.event_initial_polling_complete.set()
+                elif self.foldername == INBOX:
+                    # it's not clear we need to do this housekeeping
+                    # (depends on the SQL statements)
+                    self.forget_about_too_old_pending_messages()
+                    self.evict_old_threads()
+                self.connmanager.healthy(self.foldername)
+                self.wait_for_messages()
+            except CONNECTION_ERRORS as e:
+                # the database is synced up to the last chunk, so
+                # after reconnecting we continue where we stopped
+                self.connection_failed("connection lost, reconnecting:", e)
+                self.connect_with_backoff()
 
     def start_thread_loop(self):
         assert not self._thread
@@ -322,7 +761,7 @@ class ImapConn(object):
 
 
 def repr_msg(msg):
-    res = ["message-id: " + str(msg["message-id"]),
+    res = ["message-id: " + msg.message_id,
           "foldername: " + msg.foldername,
           "uid: " + str(msg.uid),
      ]
@@ -330,13 +769,19 @@ def repr_msg(msg):
 
 
 def is_dc_message(msg):
-    return msg and msg.get("Chat-Version")
+    return msg and msg.chat_version
 
-def normalized_messageid(msg):
-    if isinstance(msg, str):
-        return msg.lower()
-    return msg["Message-ID"].lower()
 
+def make_store(storage, basepath, db_format="snapshot"):
+    if storage == "sqlite":
+        dbpath = basepath + ".sqlite"
+        print("Using dbfile:", dbpath)
+        return SqliteMessageStore(dbpath)
+    dbpath = basepath + ".db"
+    print("Using dbfile:", dbpath)
+    if storage == "journal":
+        return DictMessageStore(JournaledDict(dbpath, format=db_format))
+    return DictMessageStore(PersistentDict(dbpath, format=db_format))
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
@@ -348,29 +793,112 @@ def normalized_messageid(msg):
               help="directory where database files are stored")
 @click.option("-n", "--name", type=str, default=None,
               help="database name (by default derived from login-user)")
+@click.option("--storage", type=click.Choice(["journal", "pickle", "sqlite"]), default="journal",
+              help="(default journal) 'journal' appends changed messages on each sync "
+                   "and compacts occasionally, 'pickle' rewrites the whole db file, "
+                   "'sqlite' keeps messages in an indexed SQLite database")
+@click.option("--db-format", type=click.Choice(["snapshot", "pickle"]), default="snapshot",
+              help="(default snapshot) file format of the journal and pickle storage, "
+                   "'snapshot' is loaded with mmap, files in the other format are "
+                   "converted on their next write")
+@click.option("--fetch-chunk-size", type=int, default=ImapConn.fetch_chunk_size,
+              help="(default %d) maximum number of messages fetched with one FETCH command"
+                   % ImapConn.fetch_chunk_size)
+@click.option("--fetch-chunk-bytes", type=int, default=ImapConn.fetch_chunk_bytes,
+              help="(default %d) maximum estimated header bytes fetched with one FETCH command"
+                   % ImapConn.fetch_chunk_bytes)
+@click.option("--move-batch", type=int, default=MoveQueue.max_batch,
+              help="(default %d) maximum number of messages moved with one MOVE command"
+                   % MoveQueue.max_batch)
+@click.option("--move-delay", type=float, default=MoveQueue.move_delay,
+              help="(default %s) seconds a message may wait for more messages to be moved "
+                   "with the same MOVE command" % MoveQueue.move_delay)
+@click.option("--retain-days", type=float, default=Retention.max_age / DAY,
+              help="(default %g) evict threads without new messages for this many days "
+                   "from the database" % (Retention.max_age / DAY))
+@click.option("--max-messages", type=int, default=Retention.max_messages,
+              help="evict the least recently active threads while more messages are "
+                   "stored (default: no limit)")
+@click.option("--stub-days", type=float, default=Retention.stub_max_age / DAY,
+              help="(default %g) days after which the stubs kept for evicted messages "
+                   "are dropped" % (Retention.stub_max_age / DAY))
+@click.option("--sync-connections", type=int, default=ImapConn.sync_connections,
+              help="(default %d) connections per folder fetching in parallel when "
+                   "there are more chunks to fetch, e.g. on the initial sync"
+                   % ImapConn.sync_connections)
+@click.option("--engine", type=click.Choice(["asyncio", "threads"]), default="asyncio",
+              help="(default asyncio) run all folders on one asyncio event loop, "
+                   "or use one thread with a blocking connection per folder")
+@click.option("--single-connection", is_flag=True, default=False,
+              help="watch all folders over one connection (asyncio engine only), "
+                   "learning about new messages in the folders which are not "
+                   "selected with NOTIFY or STATUS; implies --sync-connections 1")
+@click.option("--polling", type=click.Choice(["idle", "adaptive", "background"]),
+              default="idle",
+              help="(default idle) 'idle' always waits for new messages with IDLE, "
+                   "'adaptive' polls with an interval adapted to the arrival rate "
+                   "if the server lacks IDLE, 'background' always polls adaptively")
+@click.option("-q", "--quiet", is_flag=True, default=False,
+              help="don't print what every folder is doing")
+@click.option("--metrics-port", type=int, default=None,
+              help="serve per-folder timings and counters on "
+                   "http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json")
+@click.option("--metrics-file", type=click.Path(), default=None,
+              help="periodically write per-folder timings and counters as JSON to this file")
+@click.option("--metrics-interval", type=float, default=30,
+              help="(default 30) seconds between metrics file updates")
 @click.argument("imaphost", type=str, required=True)
 @click.argument("login-user", type=str, required=True)
 @click.argument("login-password", type=str, required=True)
 @click.pass_context
-def main(context, basedir, name, imaphost, login_user, login_password, pendingtimeout):
+def main(context, basedir, name, storage, db_format, fetch_chunk_size, fetch_chunk_bytes, move_batch,
+         move_delay, retain_days, max_messages, stub_days, sync_connections, engine,
+         single_connection, polling, quiet, metrics_port, metrics_file, metrics_interval,
+         imaphost, login_user, login_password, pendingtimeout):
     global mvbox
+    if single_connection and engine != "asyncio":
+        context.fail("--single-connection needs --engine asyncio")
+    ImapConn.verbose = not quiet
+    ImapConn.sync_connections = sync_connections
+    ImapConn.fetch_chunk_size = fetch_chunk_size
+    ImapConn.fetch_chunk_bytes = fetch_chunk_bytes
+    if polling != "idle":
+        ImapConn.poll_policy = functools.partial(PollPolicy,
+                                                 foreground=polling == "adaptive")
+    MoveQueue.max_batch = move_batch
+    MoveQueue.move_delay = move_delay
+    Retention.max_age = retain_days * DAY
+    Retention.max_messages = max_messages
+    Retention.stub_max_age = stub_days * DAY
     if not os.path.exists(basedir):
         os.makedirs(basedir)
     if name is None:
         name = login_user
-    dbpath = os.path.join(basedir, name) + ".db"
-    print("Using dbfile:", dbpath)
-    db = PersistentDict(dbpath)
+    store = make_store(storage, os.path.join(basedir, name), db_format)
     conn_info = (imaphost, login_user, login_password)
-    inbox = ImapConn(db, INBOX, conn_info=conn_info)
-    inbox.connect()
-    assert 0
-    sent = ImapConn(db, SENT, conn_info=conn_info)
+    if metrics_port:
+        serve_http(METRICS, metrics_port)
+    if metrics_file:
+        write_json_periodically(METRICS, metrics_file, metrics_interval)
+    if engine == "asyncio":
+        import asyncio
+        if single_connection:
+            from multifolder import run_account
+        else:
+            from asyncengine import run_account
+        asyncio.run(run_account(store, conn_info, pendingtimeout))
+        return
+    connmanager = ConnectionManager(imaphost, ImapConn.use_ssl)
+    inbox = ImapConn(store, INBOX, conn_info=conn_info, connmanager=connmanager)
+    sent = ImapConn(store, SENT, conn_info=conn_info, connmanager=connmanager)
     inbox.pendingtimeout = pendingtimeout
-    mvbox = ImapConn(db, MVBOX, conn_info=conn_info)
+    mvbox = ImapConn(store, MVBOX, conn_info=conn_info, connmanager=connmanager)
     mvbox.start_thread_loop()
     inbox.start_thread_loop()
     sent.start_thread_loop()
 
 if __name__ == "__main__":
-    main()
+    # run main() of the importable module so that the engine modules
+    # importing move_imap share its classes and settings
+    import move_imap
+    move_imap.main()
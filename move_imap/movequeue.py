@@ -0,0 +1,135 @@
+"""
+Per-folder queue of the messages which are to be moved to the mvbox.
+
+Messages are added when their move state becomes MOVING and leave the
+queue when the MOVE succeeded or the message vanished.  Queued messages
+are moved in batches: as soon as max_batch of them are waiting, or when
+the oldest one waited move_delay seconds, so that a burst of arriving
+messages is moved with one command.  The uids of a batch are sent as a
+compressed sequence-set ("3:7,9").  A message whose single move failed
+waits a jittered exponential backoff (connection.next_backoff) before
+it is tried again, and is given up after max_retries attempts.
+
+The queue is stored as a folder value ({uid: message-id}) and written
+when the store syncs, so after a restart the pending moves are known
+without scanning all messages.
+"""
+
+import threading
+import time
+
+from connection import next_backoff
+
+
+def compress_uids(uids):
+    """ return the IMAP sequence-set for uids, e.g. [1, 2, 3, 5] -> '1:3,5' """
+    parts = []
+    start = prev = None
+    for uid in sorted(set(uids)):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else "%d:%d" % (start, prev))
+        start = prev = uid
+    if start is not None:
+        parts.append(str(start) if start == prev else "%d:%d" % (start, prev))
+    return ",".join(parts)
+
+
+class MoveQueue(object):
+    # move as soon as this many messages are queued ...
+    max_batch = 500
+    # ... or the oldest queued message waited this many seconds
+    move_delay = 0.5
+    # failed single-message moves after which a message is given up
+    max_retries = 5
+    # seconds per backoff step after a failed move, and the maximum backoff
+    retry_constant = 2.0
+    retry_max = 300.0
+
+    def __init__(self, store, foldername):
+        self.store = store
+        self.foldername = foldername
+        self._lock = threading.RLock()
+        jobs = store.get_folder_value(foldername, "move_queue", None)
+        if jobs is None:
+            # database from before the queue was persisted
+            jobs = dict((msg.uid, msg.message_id) for msg in store.moving_in_folder(foldername))
+        self.jobs = jobs
+        self.retries = {}
+        self.retry_at = {}     # uid -> time of its next attempt after a failure
+        self.oldest = time.time() if jobs else None
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, msg):
+        assert msg.foldername == self.foldername and msg.uid > 0
+        with self._lock:
+            now = time.time()
+            if not self._ready(now):
+                self.oldest = now
+            self.jobs[msg.uid] = msg.message_id
+            self.dirty = True
+
+    def discard(self, uids=None):
+        """ forget the jobs for uids (all jobs if uids is None) and return
+        their message-ids """
+        with self._lock:
+            if uids is None:
+                uids = list(self.jobs)
+            message_ids = [self.jobs.pop(uid) for uid in uids if uid in self.jobs]
+            for uid in uids:
+                self.retries.pop(uid, None)
+                self.retry_at.pop(uid, None)
+            if not self.jobs:
+                self.oldest = None
+            self.dirty = True
+            return message_ids
+
+    def _ready(self, now):
+        """ the queued uids which are not waiting for a retry """
+        return [uid for uid in self.jobs if self.retry_at.get(uid, 0.0) <= now]
+
+    def wait_time(self, now=None):
+        """ seconds until queued messages are due (None if there are none) """
+        with self._lock:
+            if not self.jobs:
+                return None
+            now = time.time() if now is None else now
+            ready = self._ready(now)
+            if len(ready) >= self.max_batch:
+                return 0.0
+            if ready:
+                return max(0.0, self.oldest + self.move_delay - now)
+            return max(0.0, min(self.retry_at.values()) - now)
+
+    def due(self, now=None):
+        return self.wait_time(now) == 0.0
+
+    def batches(self, now=None):
+        """ return the queued uids which are not waiting for a retry in
+        batches of at most max_batch """
+        with self._lock:
+            uids = sorted(self._ready(time.time() if now is None else now))
+        return [uids[i:i + self.max_batch] for i in range(0, len(uids), self.max_batch)]
+
+    def failed(self, uid, now=None):
+        """ count a failed move of a single message, return True if it is given up """
+        with self._lock:
+            retries = self.retries[uid] = self.retries.get(uid, 0) + 1
+            if retries >= self.max_retries:
+                self.discard([uid])
+                return True
+            now = time.time() if now is None else now
+            self.retry_at[uid] = now + self.move_delay + next_backoff(
+                retries, self.retry_constant, self.retry_max)
+            return False
+
+    def persist(self):
+        with self._lock:
+            if self.dirty:
+                self.store.set_folder_value(self.foldername, "move_queue", dict(self.jobs))
+                self.dirty = False
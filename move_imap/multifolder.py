@@ -0,0 +1,265 @@
+"""
+Watching all folders of an account over one IMAP connection.
+
+AsyncImapConn keeps a logged-in connection per folder (INBOX, Sent and
+DeltaChat), each in its own IDLE.  MultiFolderConn serves the folders of
+an account from a single connection instead: it selects the folders
+which changed one after the other (DeltaChat first) to perform their
+moves and fetch their new messages, and then IDLEs in INBOX.  It learns
+about new messages in the other folders
+
+- from the STATUS responses of NOTIFY (RFC 5465) if the server
+  advertises it: they arrive during IDLE like the EXISTS responses of
+  the selected folder,
+
+- otherwise by ending IDLE every status_interval seconds to ask for the
+  STATUS (UIDNEXT MESSAGES) of the other folders in turn.
+
+Only a folder whose UIDNEXT changed since it was last selected (or,
+with QRESYNC, whose MESSAGES changed) is selected and fetched again.
+The per-folder work (fetching, resolving, moving) is done by an
+AsyncImapConn per folder which shares the connection, and which doesn't
+open extra connections to fetch a large sync in parallel.
+"""
+
+import asyncio
+import time
+
+from imapclient.exceptions import IMAPClientError
+
+from asyncengine import AsyncImapConn, ASYNC_CONNECTION_ERRORS, parse_status, quote
+from connection import ConnectionManager
+from move_imap import INBOX, SENT, MVBOX
+
+
+class MultiFolderConn(object):
+    # seconds between the STATUS checks of the folders which are not
+    # selected, if the server has no NOTIFY
+    status_interval = 60.0
+
+    def __init__(self, store, conn_info, foldernames=(MVBOX, INBOX, SENT), home=INBOX,
+                 connmanager=None):
+        if connmanager is None:
+            connmanager = ConnectionManager(conn_info[0], AsyncImapConn.use_ssl)
+        self.connmanager = connmanager
+        # served in this order, DeltaChat first so that INBOX finds the
+        # messages which are already there
+        self.folders = [AsyncImapConn(store, foldername, conn_info, connmanager)
+                        for foldername in foldernames]
+        for folder in self.folders:
+            # one connection also for the initial sync
+            folder.sync_connections = 1
+        self.by_name = dict((folder.foldername, folder) for folder in self.folders)
+        # the folder to IDLE in
+        self.home = self.by_name[home]
+        self.conn = None
+        self.selected = None
+        # None until NOTIFY SET was tried on the connection
+        self.notify = False
+        # (UIDNEXT, MESSAGES) per folder when we last looked
+        self.known = {}
+        # names of the folders to select and fetch
+        self.changed = set(foldernames)
+        # time of the last STATUS check of the folders which are not selected
+        self.last_status_check = 0.0
+
+    def __repr__(self):
+        return "<MultiFolderConn %s %s>" % (self.home.MUSER, ",".join(self.by_name))
+
+    async def connect(self):
+        home = self.home
+        with home.wlog("IMAP_CONNECT {} for {}".format(home.MUSER, ", ".join(self.by_name)),
+                       "connect"):
+            capabilities = await home.open_connection()
+            self.conn = home.conn
+            for folder in self.folders:
+                folder.conn = self.conn
+                folder.qresync = home.qresync
+                folder.check_capabilities(capabilities)
+            home.log('capabilities', capabilities)
+        self.selected = None
+        self.notify = None if b"NOTIFY" in capabilities else False
+        # we may have missed changes while we were disconnected
+        self.known.clear()
+        self.changed.update(self.by_name)
+        # all folders get selected, which tells more than STATUS
+        self.last_status_check = time.time()
+
+    async def connect_with_backoff(self):
+        home = self.home
+        while True:
+            delay = self.connmanager.delay(home.foldername)
+            if delay:
+                home.log("connecting in %.1f secs" % (delay,))
+                await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                return
+            except ASYNC_CONNECTION_ERRORS as e:
+                self.connection_failed("connect failed:", e)
+
+    def connection_failed(self, msg, error):
+        self.home.connection_failed(msg, error)
+        for folder in self.folders:
+            folder.conn = None
+        self.conn = None
+
+    async def set_notify(self):
+        """ ask for EXISTS of the selected folder and STATUS of the others,
+        return whether the server accepted it """
+        events = "(MessageNew MessageExpunge)"
+        mailboxes = " ".join(quote(foldername) for foldername in self.by_name)
+        try:
+            await self.conn.notify("SET", "(selected %s)" % events,
+                                   "(mailboxes (%s) %s)" % (mailboxes, events))
+        except IMAPClientError as e:
+            self.home.log("NOTIFY failed, checking the folders with STATUS:", e)
+            return False
+        return True
+
+    def update_known(self, foldername, uidnext, messages):
+        """ remember the state of a folder, return True if it needs a fetch """
+        old = self.known.get(foldername)
+        self.known[foldername] = (uidnext, messages)
+        if old is None or uidnext != old[0]:
+            return True
+        # without QRESYNC there is nothing to learn about expunges
+        return messages != old[1] and self.by_name[foldername].qresync
+
+    async def select(self, folder):
+        if self.selected is folder:
+            return
+        previous = self.selected
+        if previous is not None:
+            # what the server reported about the folder we leave
+            previous.process_vanished(previous.pop_vanished())
+            if self.conn.exists_seen:
+                self.changed.add(previous.foldername)
+        with folder.timed("select"):
+            await folder.select()
+        self.selected = folder
+        self.conn.exists_seen = False
+        info = folder.select_info
+        if self.update_known(folder.foldername, info.get(b"UIDNEXT"), info[b"EXISTS"]):
+            self.changed.add(folder.foldername)
+
+    def process_statuses(self):
+        """ mark the folders changed whose STATUS responses tell about new messages """
+        for data in self.conn.pop_statuses():
+            foldername, status = parse_status(data)
+            folder = self.by_name.get(foldername)
+            if folder is None or folder is self.selected:
+                continue
+            if self.update_known(foldername, status.get(b"UIDNEXT"), status.get(b"MESSAGES")):
+                folder.log("STATUS changed:", status)
+                self.changed.add(foldername)
+
+    async def check_status(self):
+        """ ask for the STATUS of the folders which are not selected """
+        for folder in self.folders:
+            if folder is not self.selected:
+                with folder.timed("status"):
+                    await self.conn.status(folder.foldername, (b"UIDNEXT", b"MESSAGES"))
+        self.last_status_check = time.time()
+        self.process_statuses()
+
+    def status_wait(self):
+        """ seconds until the next STATUS check is due, None with NOTIFY """
+        if self.notify:
+            return None
+        return self.last_status_check + self.status_interval - time.time()
+
+    async def serve(self, folder):
+        """ select the folder, perform its moves and fetch its new messages """
+        await self.select(folder)
+        self.changed.discard(folder.foldername)
+        await folder.perform_imap_jobs()
+        await folder.perform_imap_fetch()
+        uidnext, messages = self.known[folder.foldername]
+        if uidnext is not None:
+            # the fetch went up to the newest message
+            self.known[folder.foldername] = (max(uidnext, folder.last_sync_uid + 1), messages)
+        if folder.foldername == INBOX:
+            folder.forget_about_too_old_pending_messages()
+            await folder.evict_old_threads()
+
+    async def serve_changed(self):
+        for folder in self.folders:
+            if folder.foldername in self.changed or folder.movequeue.due():
+                await self.serve(folder)
+
+    def idle_wait(self, deadline):
+        """ seconds to wait for the next IDLE response, less if the queued
+        moves of any folder are due """
+        return min(folder.idle_wait(deadline) for folder in self.folders)
+
+    async def idle(self, timeout):
+        """ IDLE in the selected folder until a folder changed, moves are
+        due or timeout seconds passed """
+        folder = self.selected
+        with folder.wlog("IMAP_IDLE()", "idle"):
+            await self.conn.idle()
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.changed:
+                wait = self.idle_wait(deadline)
+                if wait <= 0:
+                    break
+                responses = await self.conn.idle_check(timeout=wait)
+                folder.log("Server sent:", responses if responses else "nothing")
+                for resp in responses:
+                    if resp[1] == b"EXISTS":
+                        self.changed.add(folder.foldername)
+                self.process_statuses()
+            await self.conn.idle_done()
+
+    async def wait_for_changes(self):
+        """ wait until a folder changed or moves are due """
+        await self.select(self.home)
+        if self.conn.exists_seen:
+            self.changed.add(self.home.foldername)
+        if self.changed or any(folder.movequeue.due() for folder in self.folders):
+            return
+        if self.notify is None:
+            self.notify = await self.set_notify()
+        mode, seconds = "idle", None
+        if self.home.policy is not None:
+            mode, seconds = self.home.next_wait()
+        if mode == "idle":
+            timeout = self.status_wait()
+            if seconds is not None:
+                timeout = seconds if timeout is None else min(seconds, timeout)
+            if timeout is None or timeout > 0:
+                await self.idle(timeout)
+        else:
+            # a poll looks at all folders, it isn't bound to status_interval
+            seconds = min(folder.poll_wait_time(seconds) for folder in self.folders)
+            if seconds > 0:
+                with self.home.wlog("POLL_WAIT %.0f secs" % (seconds,), "poll_wait"):
+                    await asyncio.sleep(seconds)
+            await self.conn.noop()
+            if self.conn.exists_seen:
+                self.changed.add(self.home.foldername)
+            self.process_statuses()
+        status_wait = self.status_wait()
+        if status_wait is not None and (mode == "poll" or status_wait <= 0):
+            await self.check_status()
+
+    async def run(self):
+        await self.connect_with_backoff()
+        while True:
+            try:
+                await self.serve_changed()
+                self.connmanager.healthy(self.home.foldername)
+                await self.wait_for_changes()
+            except ASYNC_CONNECTION_ERRORS as e:
+                self.connection_failed("connection lost, reconnecting:", e)
+                await self.connect_with_backoff()
+
+
+async def run_account(store, conn_info, pendingtimeout):
+    """ watch INBOX, Sent and DeltaChat of one account over one connection
+    until cancelled """
+    multi = MultiFolderConn(store, conn_info)
+    for folder in multi.folders:
+        folder.pendingtimeout = pendingtimeout
+    await multi.run()
@@ -1,6 +1,7 @@
 
 # from https://code.activestate.com/recipes/576642/
-import pickle, json, csv, os, shutil
+import pickle, json, csv, os, shutil, threading
+import snapshot
 
 class PersistentDict(dict):
     ''' Persistent dictionary with an API compatible with shelve and anydbm.
@@ -11,29 +12,35 @@ class PersistentDict(dict):
     Write to disk is delayed until close or sync (similar to gdbm's fast mode).
 
     Input file format is automatically discovered.
-    Output file format is selectable between pickle, json, and csv.
-    All three serialization formats are backed by fast C implementations.
+    Output file format is selectable between pickle, json, csv, and the
+    memory-mapped snapshot format of snapshot.py, which is only meant for
+    the mover's database.  All three other serialization formats are
+    backed by fast C implementations.
 
     '''
 
     def __init__(self, filename, flag='c', mode=None, format='pickle', *args, **kwds):
         self.flag = flag                    # r=readonly, c=create, or n=new
         self.mode = mode                    # None or an octal triple like 0644
-        self.format = format                # 'csv', 'json', or 'pickle'
+        self.format = format                # 'csv', 'json', 'pickle', or 'snapshot'
         self.filename = filename
+        self.loaded_format = None           # format of the file we loaded
         if flag != 'n' and os.access(filename, os.R_OK):
-            fileobj = open(filename, 'rb' if format=='pickle' else 'r')
+            fileobj = open(filename, 'rb' if self._binary() else 'r')
             with fileobj:
                 self.load(fileobj)
         dict.__init__(self, *args, **kwds)
 
+    def _binary(self):
+        return self.format in ('pickle', 'snapshot')
+
     def sync(self):
         'Write dict to disk'
         if self.flag == 'r':
             return
         filename = self.filename
         tempname = filename + '.tmp'
-        fileobj = open(tempname, 'wb' if self.format=='pickle' else 'w')
+        fileobj = open(tempname, 'wb' if self._binary() else 'w')
         try:
             self.dump(fileobj)
         except Exception:
@@ -44,6 +51,13 @@ class PersistentDict(dict):
         shutil.move(tempname, self.filename)    # atomic commit
         if self.mode is not None:
             os.chmod(self.filename, self.mode)
+        if self.format == 'snapshot':
+            # look the messages up in the new file from now on
+            snapshot.reopen(self, self.filename)
+        self.loaded_format = self.format
+
+    def touch(self, key, subkey=None):
+        'Mark a value which was mutated in place (no-op, sync() writes everything)'
 
     def close(self):
         self.sync()
@@ -61,20 +75,181 @@ class PersistentDict(dict):
             json.dump(self, fileobj, separators=(',', ':'))
         elif self.format == 'pickle':
             pickle.dump(dict(self), fileobj, 2)
+        elif self.format == 'snapshot':
+            snapshot.dump(self, fileobj)
         else:
             raise NotImplementedError('Unknown format: ' + repr(self.format))
 
     def load(self, fileobj):
+        if self._binary() and snapshot.is_snapshot(fileobj):
+            self.loaded_format = 'snapshot'
+            return self.update(snapshot.load(self.filename))
         # try formats from most restrictive to least restrictive
-        for loader in (pickle.load, json.load, csv.reader):
+        for name, loader in (('pickle', pickle.load), ('json', json.load), ('csv', csv.reader)):
             fileobj.seek(0)
             try:
-                return self.update(loader(fileobj))
+                self.update(loader(fileobj))
+                self.loaded_format = name
+                return
             except Exception:
                 pass
         raise ValueError('File not in a supported format')
 
 
+class JournaledDict(PersistentDict):
+    ''' PersistentDict which appends only the changed keys on sync.
+
+    The snapshot is a regular PersistentDict file in pickle or snapshot
+    format.  Keys changed since the last sync are appended as pickled
+    records to a journal file next to it (filename + '.journal'), which is
+    replayed on load.  Once the journal outgrows compact_ratio times the
+    snapshot (and at least compact_min bytes) sync() writes a fresh
+    snapshot and truncates the journal.  A snapshot file in another
+    format than the requested one is rewritten on the first sync.
+
+    Assigning or deleting top-level keys is tracked automatically.  Values
+    mutated in place must be marked with touch(key), or touch(key, subkey)
+    for a single entry of a nested dict, so the next sync picks them up.
+
+    '''
+
+    def __init__(self, filename, flag='c', mode=None, compact_ratio=1.0,
+                 compact_min=1 << 20, format='pickle', *args, **kwds):
+        self.journalname = filename + '.journal'
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._lock = threading.RLock()
+        self._dirty = {}                    # key -> None (whole value) or set of subkeys
+        PersistentDict.__init__(self, filename, flag, mode, format, *args, **kwds)
+        if flag != 'n' and os.access(self.journalname, os.R_OK):
+            with open(self.journalname, 'rb+') as fileobj:
+                # drop a partial trailing record so new appends stay readable
+                fileobj.truncate(self.replay(fileobj))
+        elif flag == 'n' and os.path.exists(self.journalname):
+            # a new dict must not inherit an old journal
+            os.remove(self.journalname)
+        self._dirty.clear()
+
+    # change tracking
+
+    def _mark(self, key, subkey=None, whole=False):
+        with self._lock:
+            if whole:
+                self._dirty[key] = None
+            else:
+                subkeys = self._dirty.setdefault(key, set())
+                if subkeys is not None:
+                    subkeys.add(subkey)
+
+    def touch(self, key, subkey=None):
+        'Mark a value (or one entry of a nested dict value) which was mutated in place'
+        self._mark(key, subkey, whole=subkey is None)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._mark(key, whole=True)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark(key, whole=True)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._mark(key, whole=True)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._mark(key, whole=True)
+        return key, value
+
+    def update(self, *args, **kwds):
+        for key, value in dict(*args, **kwds).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    # journal
+
+    def _take_records(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        for key, subkeys in dirty.items():
+            if subkeys is None:
+                if key in self:
+                    yield ('set', key, dict.__getitem__(self, key))
+                else:
+                    yield ('del', key)
+                continue
+            container = self.get(key)
+            for subkey in subkeys:
+                if container is not None and subkey in container:
+                    yield ('setsub', key, subkey, container[subkey])
+                else:
+                    yield ('delsub', key, subkey)
+
+    def replay(self, fileobj):
+        'Apply journal records and return the offset after the last complete one'
+        while True:
+            offset = fileobj.tell()
+            try:
+                record = pickle.load(fileobj)
+            except Exception:
+                # EOF, or a crash in the middle of appending left a partial record
+                return offset
+            op, key = record[:2]
+            if op == 'set':
+                dict.__setitem__(self, key, record[2])
+            elif op == 'del':
+                dict.pop(self, key, None)
+            elif op == 'setsub':
+                dict.setdefault(self, key, {})[record[2]] = record[3]
+            elif op == 'delsub':
+                dict.get(self, key, {}).pop(record[2], None)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journalname)
+        except OSError:
+            return 0
+
+    def _snapshot_size(self):
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def sync(self):
+        'Append changed keys to the journal, compacting into a snapshot when it got too large'
+        if self.flag == 'r':
+            return
+        with self._lock:
+            with open(self.journalname, 'ab') as fileobj:
+                for record in self._take_records():
+                    pickle.dump(record, fileobj, 2)
+                fileobj.flush()
+                os.fsync(fileobj.fileno())
+            if (self._journal_size() >= max(self.compact_min,
+                                            self.compact_ratio * self._snapshot_size()) or
+                    self.loaded_format not in (None, self.format)):
+                self.compact()
+
+    def compact(self):
+        'Write a full snapshot and truncate the journal'
+        with self._lock:
+            # sync() appended all changes before calling us, so crashing
+            # before the truncation below only replays records onto a
+            # snapshot which already contains their effect.
+            PersistentDict.sync(self)
+            open(self.journalname, 'wb').close()
+
 
 if __name__ == '__main__':
     import random
@@ -0,0 +1,83 @@
+"""
+Policy choosing how an IMAP client waits for new messages.
+
+A client either keeps an IDLE open, which costs a wakeup whenever a
+message arrives and whenever the IDLE is renewed, or polls, which costs
+a wakeup per poll.  PollPolicy decides from the state of the app and
+the observed arrival rate of messages:
+
+- in the foreground and if the server supports IDLE: IDLE for
+  idle_timeout seconds, then renew it,
+
+- otherwise poll.  The interval starts at min_interval, grows by
+  backoff after each poll which found nothing (up to max_interval, or
+  fg_max_interval in the foreground) and falls back to min_interval when
+  a poll found messages or the arrival rate is above busy_rate.
+
+The arrival rate is an exponentially decaying average over half_life
+seconds of the messages reported to observe().  Callers which are woken
+by someone else (like the timer of imap_threads/run.py) ask poll_due()
+whether a poll is worth it, others wait as long as next_wakeup() says.
+
+imap_threads/pollpolicy.py is a symlink to this module.
+"""
+
+import math
+
+
+class PollPolicy(object):
+    # seconds until an IDLE is renewed, below the usual NAT timeouts
+    idle_timeout = 600.0
+    # bounds of the polling interval
+    min_interval = 60.0
+    max_interval = 900.0
+    fg_max_interval = 300.0
+    # factor by which the interval grows after a poll without messages
+    backoff = 2.0
+    # messages per second above which we always poll at min_interval
+    busy_rate = 1.0 / 120
+    # seconds after which an arrival counts half in the arrival rate
+    half_life = 900.0
+
+    def __init__(self, foreground=True, can_idle=True, now=0.0):
+        self.foreground = foreground
+        self.can_idle = can_idle
+        self.interval = self.min_interval
+        self.last_check = now
+        self._rate = 0.0
+        self._rate_time = now
+
+    def rate(self, now):
+        """ the estimated arrival rate in messages per second """
+        tau = self.half_life / math.log(2)
+        return self._rate * math.exp(-(now - self._rate_time) / tau)
+
+    def busy(self, now):
+        return self.rate(now) >= self.busy_rate
+
+    def observe(self, now, num_messages):
+        """ a check (poll, IDLE response or fetch) at now found num_messages new messages """
+        tau = self.half_life / math.log(2)
+        self._rate = self.rate(now) + num_messages / tau
+        self._rate_time = now
+        self.last_check = now
+        if num_messages or self.busy(now):
+            self.interval = self.min_interval
+        else:
+            max_interval = self.fg_max_interval if self.foreground else self.max_interval
+            self.interval = min(self.interval * self.backoff, max_interval)
+
+    def set_foreground(self, foreground):
+        self.foreground = foreground
+        if foreground:
+            self.interval = min(self.interval, self.fg_max_interval)
+
+    def next_wakeup(self, now):
+        """ return ("idle", seconds to IDLE) or ("poll", seconds until the next poll) """
+        if self.foreground and self.can_idle:
+            return "idle", self.idle_timeout
+        return "poll", max(0.0, self.last_check + self.interval - now)
+
+    def poll_due(self, now):
+        mode, seconds = self.next_wakeup(now)
+        return mode == "poll" and seconds <= 0
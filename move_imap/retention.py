@@ -0,0 +1,91 @@
+"""
+Eviction of old threads from the message store.
+
+Without it every message the mover ever saw stays in the store (and in
+every snapshot of it).  A thread (a component of the ThreadIndex) can be
+evicted once all its messages are resolved -- STAY, or MOVING and moved
+or gone (uid 0) -- and either no message arrived in it for max_age
+seconds, or more than max_messages messages are stored and it is among
+the least recently active threads.
+
+The records of an evicted thread are deleted.  Each of its messages is
+kept as a stub in the thread index (see ThreadIndex.collapse), which is
+stored along with the time of the thread's last message, so that
+replies arriving later are still resolved correctly.  Stubs which
+nothing links to are dropped after stub_max_age seconds; replies to
+them are then treated like replies to a message the mover never saw.
+"""
+
+import time
+
+from threadindex import DC_CONSTANT_MSG_MOVESTATE_STAY, DC_CONSTANT_MSG_MOVESTATE_MOVING
+
+DAY = 24 * 3600
+
+
+def is_resolved(msg):
+    if msg.move_state == DC_CONSTANT_MSG_MOVESTATE_STAY:
+        return True
+    # queued moves still need the record
+    return msg.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING and not msg.uid
+
+
+class Retention(object):
+    # evict threads which didn't receive a message for this many seconds ...
+    max_age = 7 * DAY
+    # ... and the least recently active ones while more messages are stored
+    # (0 for no limit), down to low_water times as many
+    max_messages = 0
+    low_water = 0.9
+    # drop stubs of threads which were inactive for this many seconds
+    stub_max_age = 180 * DAY
+    # seconds between eviction passes, unless max_messages is exceeded
+    interval = 3600
+    min_interval = 60
+
+    def __init__(self, store):
+        self.store = store
+        self.last_run = 0.0
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        if now - self.last_run >= self.interval:
+            return True
+        return bool(self.max_messages and now - self.last_run >= self.min_interval and
+                    self.store.count() > self.max_messages)
+
+    def run(self, now=None):
+        """ evict threads and drop old stubs, return the number of evicted
+        messages and dropped stubs """
+        now = time.time() if now is None else now
+        self.last_run = now
+        threads = self.store.threads
+        records = dict((msg.message_id, msg) for msg in self.store.records())
+        candidates = []
+        for message_ids in threads.components().values():
+            msgs = [records[message_id] for message_id in message_ids
+                    if message_id in records]
+            if msgs and all(is_resolved(msg) for msg in msgs):
+                last = max(msg.fetch_retrieve_time for msg in msgs)
+                candidates.append((last, len(msgs), message_ids))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        excess = 0
+        if self.max_messages and len(records) > self.max_messages:
+            excess = len(records) - int(self.max_messages * self.low_water)
+        stubs = {}
+        evicted = 0
+        for last, num, message_ids in candidates:
+            if last >= now - self.max_age and excess <= 0:
+                break
+            for message_id, (parent_id, summary) in threads.collapse(message_ids).items():
+                stubs[message_id] = (parent_id, summary, last)
+            evicted += num
+            excess -= num
+        self.store.evict(stubs)
+
+        dropped = [message_id for message_id, (parent_id, summary, last) in self.store.stubs()
+                   if last < now - self.stub_max_age and message_id not in records and
+                   threads.drop(message_id)]
+        self.store.drop_stubs(dropped)
+        return evicted, len(dropped)
@@ -0,0 +1,405 @@
+"""
+Snapshot file format of the mover's database, loaded with mmap.
+
+Unpickling a database creates an object for every message the mover
+ever saw before it can start.  A snapshot file is mapped into memory
+instead and only its small parts are read on loading:
+
+    header    magic and the number and offsets of the sections
+    strings   offset table and utf8 data of all distinct strings
+              (message-ids, folder names, chat versions), sorted
+    records   one fixed-width row per message, sorted by message-id,
+              with its strings as indexes into the string table
+    links     per row the top of its thread and the Segment below it,
+              as ThreadIndex.link() returned them
+    active    row numbers of the pending and moving messages
+    rest      the other keys of the database (folder values, move
+              queues, thread stubs), pickled
+
+The messages are a SnapshotRecords mapping, which looks a message-id up
+by bisecting the rows and creates its MessageRecord on access.  Added
+and changed records are kept in an overlay dict until the next snapshot
+is written.  The pending and moving messages are put into the overlay
+on loading, so the store's queries for them don't touch the rows.  The
+thread index is restored from the links instead of linking every
+message again (files of the first version, MVSNAP01, have no links).
+After PersistentDict wrote a new snapshot, reopen() bases the mapping on
+it and drops the overlay records which it contains unchanged.
+
+PersistentDict(..., format="snapshot") writes this format.  Loading
+detects it by the magic, so existing pickle files are read as before
+and are converted by their next full write.
+"""
+
+import mmap
+import pickle
+import struct
+
+from messagestore import MessageRecord
+from threadindex import (
+    ThreadIndex, Segment, DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+MAGIC = b"MVSNAP02"
+# magic, number of strings, records and active rows, offsets of the sections
+HEADER = struct.Struct("<8sIIIQQQQQQ")
+# the first version, without the links section
+MAGIC_V1 = b"MVSNAP01"
+HEADER_V1 = struct.Struct("<8sIIIQQQQQ")
+OFFSET = struct.Struct("<Q")
+# message-id, in-reply-to, chat-version (-1 for None), folder, uid,
+# move state, fetch time
+RECORD = struct.Struct("<IIiIIBd")
+ROW = struct.Struct("<I")
+# top message-id, dc_run, all_dc | moved << 1
+LINK = struct.Struct("<IIB")
+
+# the DictMessageStore keys of the messages and the thread stubs
+MESSAGES = ":message-full"
+THREAD_STUBS = ":thread-stubs"
+
+
+class ThreadRow(object):
+    """ what ThreadIndex needs of a record """
+    __slots__ = ("message_id", "in_reply_to", "chat_version", "move_state")
+
+    def __init__(self, message_id, in_reply_to, chat_version, move_state):
+        self.message_id = message_id
+        self.in_reply_to = in_reply_to
+        self.chat_version = chat_version
+        self.move_state = move_state
+
+
+def is_snapshot(fileobj):
+    fileobj.seek(0)
+    return fileobj.read(len(MAGIC)) in (MAGIC, MAGIC_V1)
+
+
+def is_active(move_state, uid):
+    """ whether DictMessageStore may look for the message by its state """
+    return (move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING or
+            move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING and uid > 0)
+
+
+def dump(db, fileobj):
+    """ write the dict db (with MessageRecords under MESSAGES) as snapshot """
+    messages = sorted(db.get(MESSAGES, {}).items(), key=lambda item: item[0])
+    rest = dict((key, value) for key, value in db.items() if key != MESSAGES)
+    links = thread_links(messages, rest.get(THREAD_STUBS, {}))
+    strings = set()
+    for message_id, msg in messages:
+        strings.update((message_id, msg.in_reply_to, msg.foldername))
+        if msg.chat_version is not None:
+            strings.add(msg.chat_version)
+    # tops which are stubs
+    strings.update(top_id for top_id, segment in links)
+    strings = sorted(strings)
+    index = dict((string, i) for i, string in enumerate(strings))
+    data = [string.encode("utf8") for string in strings]
+
+    offsets = bytearray()
+    pos = 0
+    for encoded in data:
+        offsets += OFFSET.pack(pos)
+        pos += len(encoded)
+    offsets += OFFSET.pack(pos)
+    records = bytearray()
+    active = bytearray()
+    for i, (message_id, msg) in enumerate(messages):
+        records += RECORD.pack(
+            index[message_id], index[msg.in_reply_to],
+            -1 if msg.chat_version is None else index[msg.chat_version],
+            index[msg.foldername], msg.uid, msg.move_state, msg.fetch_retrieve_time)
+        if is_active(msg.move_state, msg.uid):
+            active += ROW.pack(i)
+    link_rows = bytearray()
+    for top_id, segment in links:
+        link_rows += LINK.pack(index[top_id], segment.dc_run,
+                               bool(segment.all_dc) | bool(segment.moved) << 1)
+
+    offsets_pos = HEADER.size
+    data_pos = offsets_pos + len(offsets)
+    records_pos = data_pos + pos
+    links_pos = records_pos + len(records)
+    active_pos = links_pos + len(link_rows)
+    rest_pos = active_pos + len(active)
+    fileobj.write(HEADER.pack(MAGIC, len(strings), len(messages), len(active) // ROW.size,
+                              offsets_pos, data_pos, records_pos, active_pos, rest_pos,
+                              links_pos))
+    fileobj.write(offsets)
+    for encoded in data:
+        fileobj.write(encoded)
+    fileobj.write(records)
+    fileobj.write(link_rows)
+    fileobj.write(active)
+    pickle.dump(rest, fileobj, 2)
+
+
+def thread_links(messages, stubs):
+    """ return ThreadIndex.link() of each of messages ([(message-id, record)])
+    in an index of them and the stubs """
+    index = ThreadIndex(
+        (msg for message_id, msg in messages),
+        ((message_id, stub[0], Segment(*stub[1:4])) for message_id, stub in stubs.items()))
+    return [index.link(message_id) for message_id, msg in messages]
+
+
+def load(filename):
+    """ return the dict stored in the snapshot file filename """
+    snapshot = Snapshot(filename)
+    db = snapshot.rest()
+    db[MESSAGES] = SnapshotRecords(snapshot)
+    return db
+
+
+def reopen(db, filename):
+    """ base the SnapshotRecords of db on the snapshot just written to filename """
+    messages = dict.get(db, MESSAGES)
+    if isinstance(messages, SnapshotRecords):
+        messages.rebase(Snapshot(filename))
+
+
+class Snapshot(object):
+    """ read access to the sections of a memory-mapped snapshot file """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fileobj:
+            self.mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.mm[:len(MAGIC)]
+        if magic == MAGIC:
+            fields = HEADER.unpack_from(self.mm, 0)
+        elif magic == MAGIC_V1:
+            fields = HEADER_V1.unpack_from(self.mm, 0) + (None,)
+        else:
+            raise ValueError("%s is not a snapshot" % (filename,))
+        (magic, self.num_strings, self.num_records, self.num_active, self.offsets_pos,
+         self.data_pos, self.records_pos, self.active_pos, self.rest_pos,
+         self.links_pos) = fields
+        # decoded folder names and chat versions, there are only a few
+        self._small_strings = {}
+
+    def string_bytes(self, i):
+        start = OFFSET.unpack_from(self.mm, self.offsets_pos + i * OFFSET.size)[0]
+        end = OFFSET.unpack_from(self.mm, self.offsets_pos + (i + 1) * OFFSET.size)[0]
+        return self.mm[self.data_pos + start:self.data_pos + end]
+
+    def string(self, i):
+        return self.string_bytes(i).decode("utf8")
+
+    def small_string(self, i):
+        if i < 0:
+            return None
+        string = self._small_strings.get(i)
+        if string is None:
+            string = self._small_strings[i] = self.string(i)
+        return string
+
+    def strings(self):
+        """ return the whole string table as list """
+        offsets = [offset for offset, in OFFSET.iter_unpack(
+            memoryview(self.mm)[self.offsets_pos:self.data_pos])]
+        data = self.mm[self.data_pos:self.records_pos]
+        text = data.decode("utf8")
+        if len(text) != len(data):
+            # not ascii, the offsets don't apply to text
+            return [self.string(i) for i in range(self.num_strings)]
+        return [text[offsets[i]:offsets[i + 1]] for i in range(self.num_strings)]
+
+    def row(self, i):
+        return RECORD.unpack_from(self.mm, self.records_pos + i * RECORD.size)
+
+    def rows(self):
+        end = self.records_pos + self.num_records * RECORD.size
+        return RECORD.iter_unpack(memoryview(self.mm)[self.records_pos:end])
+
+    def links(self):
+        """ (top string, dc_run, flags) per row, None if the file has no links """
+        if self.links_pos is None:
+            return None
+        end = self.links_pos + self.num_records * LINK.size
+        return LINK.iter_unpack(memoryview(self.mm)[self.links_pos:end])
+
+    def active_rows(self):
+        end = self.active_pos + self.num_active * ROW.size
+        return [i for i, in ROW.iter_unpack(memoryview(self.mm)[self.active_pos:end])]
+
+    def record(self, i, row=None):
+        message_id, in_reply_to, chat_version, foldername, uid, move_state, fetch_time = (
+            row or self.row(i))
+        return MessageRecord(self.string(message_id), self.string(in_reply_to),
+                             self.small_string(chat_version), self.small_string(foldername),
+                             uid, move_state, fetch_time)
+
+    def find(self, message_id):
+        """ return the row number of message_id or None """
+        key = message_id.encode("utf8")
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string_bytes(self.row(mid)[0]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_records and self.string_bytes(self.row(lo)[0]) == key:
+            return lo
+        return None
+
+    def rest(self):
+        return pickle.loads(self.mm[self.rest_pos:])
+
+
+class SnapshotRecords(object):
+    """ {message-id: MessageRecord} of a Snapshot plus the changes since.
+
+    Records handed out by values()/items() are created for every call,
+    so changes to them must be stored with keep(msg) (DictMessageStore
+    does that in update()).  get() keeps the record it returns.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.overlay = {}      # message-id -> MessageRecord, added or accessed
+        self.deleted = set()   # message-ids of deleted rows
+        self._len = snapshot.num_records
+        for i in snapshot.active_rows():
+            msg = snapshot.record(i)
+            self.overlay[msg.message_id] = msg
+
+    def rebase(self, snapshot):
+        """ continue on snapshot, written from our records (and maybe a few
+        changes since): keep only the overlay records it doesn't have as they
+        are, and the active ones """
+        overlay = {}
+        num_added = 0
+        for message_id, msg in list(self.overlay.items()):
+            i = snapshot.find(message_id)
+            if i is None:
+                num_added += 1
+                overlay[message_id] = msg
+            elif is_active(msg.move_state, msg.uid) or snapshot.record(i) != msg:
+                overlay[message_id] = msg
+        deleted = set(message_id for message_id in list(self.deleted)
+                      if snapshot.find(message_id) is not None)
+        self.snapshot = snapshot
+        self.overlay = overlay
+        self.deleted = deleted
+        self._len = snapshot.num_records + num_added - len(deleted)
+
+    def _in_snapshot(self, message_id):
+        return message_id not in self.deleted and self.snapshot.find(message_id) is not None
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, message_id):
+        return message_id in self.overlay or self._in_snapshot(message_id)
+
+    def get(self, message_id, default=None):
+        msg = self.overlay.get(message_id)
+        if msg is not None:
+            return msg
+        if message_id in self.deleted:
+            return default
+        i = self.snapshot.find(message_id)
+        if i is None:
+            return default
+        msg = self.overlay[message_id] = self.snapshot.record(i)
+        return msg
+
+    def __getitem__(self, message_id):
+        msg = self.get(message_id)
+        if msg is None:
+            raise KeyError(message_id)
+        return msg
+
+    def __setitem__(self, message_id, msg):
+        if message_id not in self:
+            self._len += 1
+        self.overlay[message_id] = msg
+
+    def keep(self, msg):
+        """ store a changed record, unless it was deleted meanwhile """
+        if msg.message_id in self:
+            self.overlay[msg.message_id] = msg
+
+    def pop(self, message_id, default=None):
+        msg = self.get(message_id)
+        if msg is None:
+            return default
+        del self.overlay[message_id]
+        if self.snapshot.find(message_id) is not None:
+            self.deleted.add(message_id)
+        self._len -= 1
+        return msg
+
+    def __delitem__(self, message_id):
+        if self.pop(message_id) is None:
+            raise KeyError(message_id)
+
+    def items(self):
+        snapshot = self.snapshot
+        for i, row in enumerate(snapshot.rows()):
+            message_id = snapshot.string(row[0])
+            if message_id not in self.overlay and message_id not in self.deleted:
+                yield message_id, snapshot.record(i, row)
+        for item in list(self.overlay.items()):
+            yield item
+
+    def values(self):
+        for message_id, msg in self.items():
+            yield msg
+
+    def keys(self):
+        for message_id, msg in self.items():
+            yield message_id
+
+    __iter__ = keys
+
+    def active(self):
+        """ the records which may be pending or moving (and more) """
+        return list(self.overlay.values())
+
+    def thread_index(self, stubs):
+        """ return the ThreadIndex of the records and stubs ((message-id,
+        parent-id, Segment)), restored from the links if the snapshot has them """
+        links = self.snapshot.links()
+        if links is None:
+            return ThreadIndex(self.thread_rows(), stubs)
+        return ThreadIndex.from_links(self.thread_links(links), stubs,
+                                      list(self.overlay.values()))
+
+    def thread_links(self, links):
+        """ the rows for ThreadIndex.from_links() of the rows in the snapshot,
+        the changes in the overlay are left to the caller """
+        snapshot = self.snapshot
+        strings = snapshot.strings()
+        segments = {}
+        for (message_id, in_reply_to, chat_version, _, _, move_state, _), (
+                top_id, dc_run, flags) in zip(snapshot.rows(), links):
+            message_id = strings[message_id]
+            if message_id in self.deleted:
+                continue
+            segment = segments.get((dc_run, flags))
+            if segment is None:
+                segment = segments[dc_run, flags] = Segment(bool(flags & 1), dc_run,
+                                                            bool(flags & 2))
+            yield (message_id, strings[in_reply_to], chat_version >= 0 and
+                   bool(strings[chat_version]), move_state, strings[top_id], segment)
+
+    def thread_rows(self):
+        """ what ThreadIndex needs of every record, without creating them """
+        snapshot = self.snapshot
+        # the index keys its dicts by these strings, decode each only once
+        strings = snapshot.strings()
+        for message_id, in_reply_to, chat_version, _, _, move_state, _ in snapshot.rows():
+            message_id = strings[message_id]
+            if message_id not in self.overlay and message_id not in self.deleted:
+                yield ThreadRow(message_id, strings[in_reply_to],
+                                None if chat_version < 0 else strings[chat_version],
+                                move_state)
+        for msg in list(self.overlay.values()):
+            yield msg
+
+    def __reduce__(self):
+        # pickled (e.g. by a pickle format PersistentDict) as a plain dict
+        return (dict, (list(self.items()),))
@@ -0,0 +1,54 @@
+import asyncio
+
+from asyncengine import AsyncImapConn
+from messagestore import DictMessageStore
+from move_imap import ImapConn, INBOX
+from persistentdict import JournaledDict
+
+CONN_INFO = ("127.0.0.1", "user", "password")
+
+
+def raw_message(i):
+    return ("Message-ID: <m%d@example.org>\r\nSubject: %d\r\n\r\nhello\r\n" % (i, i)).encode()
+
+
+def make_store(tmpdir):
+    return DictMessageStore(JournaledDict(str(tmpdir.join("moves.db"))))
+
+
+def test_idle_cycle_fetches_nothing(tmpdir, imap_server):
+    """ "n:*" matches the highest uid also when it is below n, which
+    must not be fetched again """
+    for i in range(3):
+        imap_server.append(INBOX, raw_message(i))
+
+    async def run():
+        imapconn = AsyncImapConn(make_store(tmpdir), INBOX, CONN_INFO)
+        await imapconn.connect()
+        try:
+            await imapconn.perform_imap_fetch()
+            assert imapconn.num_fetched == 3
+            for _ in range(3):
+                await imapconn.perform_imap_fetch()
+            assert imapconn.num_fetched == 3
+            imap_server.append(INBOX, raw_message(3))
+            await imapconn.perform_imap_fetch()
+            assert imapconn.num_fetched == 4
+            assert imapconn.last_sync_uid == 4
+        finally:
+            await imapconn.conn.logout()
+
+    asyncio.run(run())
+
+
+def test_threaded_idle_cycle_fetches_nothing(tmpdir, imap_server):
+    for i in range(3):
+        imap_server.append(INBOX, raw_message(i))
+    imapconn = ImapConn(make_store(tmpdir), INBOX, CONN_INFO)
+    imapconn.connect()
+    try:
+        for _ in range(3):
+            imapconn.perform_imap_fetch()
+        assert imapconn.num_fetched == 3
+    finally:
+        imapconn.conn.logout()
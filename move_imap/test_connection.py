@@ -0,0 +1,26 @@
+import random
+
+from connection import ConnectionManager, next_backoff
+
+
+def test_next_backoff_range():
+    rng_state = random.getstate()
+    try:
+        random.seed(0)
+        for retries in range(6):
+            delays = set(next_backoff(retries, 2.0) for _ in range(500))
+            assert delays == set(2.0 * i for i in range(2 ** retries))
+        assert max(next_backoff(20, 1.0, 300.0) for _ in range(500)) == 300.0
+    finally:
+        random.setstate(rng_state)
+
+
+def test_next_backoff_many_retries():
+    """ a folder which fails forever must not overflow the exponent """
+    for retries in (1023, 1024, 10 ** 6):
+        assert 0 <= next_backoff(retries, 1.0, 300.0) <= 300.0
+        assert next_backoff(retries, 1.0) >= 0
+    manager = ConnectionManager("localhost", use_ssl=False)
+    for _ in range(2000):
+        manager.failed("INBOX")
+    assert 0 <= manager.delay("INBOX") <= manager.backoff_max
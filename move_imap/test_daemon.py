@@ -0,0 +1,32 @@
+import asyncio
+
+from daemon import Account, Daemon
+from messagestore import DictMessageStore
+from move_imap import INBOX
+from persistentdict import JournaledDict
+from test_asyncengine import CONN_INFO, raw_message
+
+
+def test_idle_folder_backs_off(tmpdir, imap_server):
+    """ a folder gets min_interval while messages arrive, and backs off to
+    max_interval once nothing arrives anymore """
+    for i in range(2):
+        imap_server.append(INBOX, raw_message(i))
+
+    async def run():
+        store = DictMessageStore(JournaledDict(str(tmpdir.join("moves.db"))))
+        account = Account("user", CONN_INFO, store, 3600, min_interval=1)
+        # no IDLE, every service() is one poll
+        daemon = Daemon([account], connections=2, max_idle=0, min_interval=1,
+                        max_interval=8)
+        folder = [folder for folder in account.folders if folder.foldername == INBOX][0]
+        intervals = []
+        for _ in range(6):
+            intervals.append(await daemon.service(folder))
+        imap_server.append(INBOX, raw_message(2))
+        intervals.append(await daemon.service(folder))
+        return intervals, account.fetched
+
+    intervals, fetched = asyncio.run(run())
+    assert intervals == [1, 2, 4, 8, 8, 8, 1]
+    assert fetched == 3
@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+from messagestore import DictMessageStore, MessageRecord, SqliteMessageStore
+from persistentdict import JournaledDict
+from threadindex import (
+    DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+    DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+STATES = [DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+          DC_CONSTANT_MSG_MOVESTATE_MOVING]
+FOLDERS = ["INBOX", "Sent", "DeltaChat"]
+
+
+def open_stores(tmpdir):
+    return [
+        DictMessageStore(JournaledDict(str(tmpdir.join("moves.db")))),
+        DictMessageStore(JournaledDict(str(tmpdir.join("moves.snap")), format="snapshot",
+                                       compact_min=0)),
+        SqliteMessageStore(str(tmpdir.join("moves.sqlite"))),
+    ]
+
+
+def random_record(rng, i, message_ids):
+    parent = rng.choice(message_ids) if message_ids and rng.random() < 0.7 else ""
+    return MessageRecord("<m%d@example.org>" % (i,), parent and "<%s>" % (parent,),
+                         "1.0" if rng.random() < 0.6 else None, rng.choice(FOLDERS),
+                         rng.randint(0, 50), rng.choice(STATES), float(rng.randint(0, 100)))
+
+
+def key(msgs):
+    return sorted(msg.astuple() for msg in msgs)
+
+
+def query_all(store, message_ids):
+    """ the results of every query of the store, comparable across stores """
+    results = {
+        "count": store.count(),
+        "records": key(store.records()),
+        "stubs": sorted(store.stubs()),
+        "value": store.get_folder_value("INBOX", "last_sync_uid"),
+    }
+    for message_id in message_ids[:20]:
+        results["pending_children", message_id] = key(store.pending_children(message_id))
+        msg = store.get(message_id)
+        results["get", message_id] = msg and msg.astuple()
+        results["has", message_id] = store.has(message_id)
+        if message_id in store.threads:
+            results["next", message_id] = store.threads.next_move_state(message_id)
+    for foldername in FOLDERS:
+        results["moving", foldername] = key(store.moving_in_folder(foldername))
+        results["in_folder", foldername] = key(store.in_folder(foldername))
+        results["in_folder_uids", foldername] = key(store.in_folder(foldername, set(range(10))))
+    for timestamp in (0.0, 30.0, 101.0):
+        results["expired", timestamp] = key(store.pending_fetched_before(timestamp))
+    return results
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_stores_agree(tmpdir, seed):
+    """ the indexed queries of the SQLite store (and those of the dict
+    store on a snapshot) answer like the scans of the dict store, also
+    after reopening """
+    rng = random.Random(seed)
+    stores = open_stores(tmpdir)
+    message_ids = []
+    for i in range(300):
+        msg = random_record(rng, i, message_ids)
+        for store in stores:
+            store.add(MessageRecord(*msg.astuple()))
+        message_ids.append(msg.message_id)
+        if rng.random() < 0.3:
+            message_id = rng.choice(message_ids)
+            # the changes the mover makes: resolving, and moving away
+            move_state = stores[0].get(message_id).move_state
+            if move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING:
+                move_state = rng.choice(STATES[1:])
+            for store in stores:
+                changed = store.get(message_id)
+                if changed.move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING:
+                    changed.uid = 0
+                changed.move_state = move_state
+                store.update(changed)
+        if rng.random() < 0.05:
+            for store in stores:
+                store.set_folder_value("INBOX", "last_sync_uid", i)
+                store.sync()
+        if rng.random() < 0.02:
+            stores = reopen(tmpdir, stores)
+    # evict a few threads like Retention does
+    components = sorted(stores[0].threads.components().values())
+    evicted = [message_id for component in rng.sample(components, 5)
+               for message_id in component]
+    for store in stores:
+        stubs = store.threads.collapse(evicted)
+        store.evict(dict((message_id, (parent_id, summary, 5.0))
+                         for message_id, (parent_id, summary) in stubs.items()))
+    rng.shuffle(message_ids)
+    expected = query_all(stores[0], message_ids)
+    for store in stores[1:]:
+        assert query_all(store, message_ids) == expected
+    stores = reopen(tmpdir, stores)
+    for store in stores:
+        assert query_all(store, message_ids) == expected
+    for store in stores:
+        store.close()
+
+
+def reopen(tmpdir, stores):
+    for store in stores:
+        store.close()
+    return open_stores(tmpdir)
@@ -0,0 +1,110 @@
+import pytest
+
+from messagestore import MessageRecord, DC_CONSTANT_MSG_MOVESTATE_MOVING
+from move_imap import ImapConn, INBOX, MVBOX
+from movequeue import MoveQueue, compress_uids
+from test_asyncengine import CONN_INFO, make_store
+
+
+def dc_message(i):
+    return ("Message-ID: <m%d@example.org>\r\nChat-Version: 1.0\r\n\r\nhello\r\n" % (i,)).encode()
+
+
+@pytest.mark.parametrize("uids, uidset", [
+    ([], ""),
+    ([7], "7"),
+    ([1, 2, 3, 5], "1:3,5"),
+    ([9, 3, 4, 1, 2, 4], "1:4,9"),
+    ([1, 3, 5, 6], "1,3,5:6"),
+])
+def test_compress_uids(uids, uidset):
+    assert compress_uids(uids) == uidset
+
+
+@pytest.fixture
+def mover(tmpdir, imap_server, monkeypatch):
+    """ an INBOX ImapConn which queued five Delta thread starts for moving """
+    # the fetch moves due messages itself, let them wait until we're ready
+    monkeypatch.setattr(MoveQueue, "move_delay", 3600.0)
+    imap_server.create_folder(MVBOX)
+    for i in range(5):
+        imap_server.append(INBOX, dc_message(i))
+    imapconn = ImapConn(make_store(tmpdir), INBOX, CONN_INFO)
+    imapconn.connect()
+    imapconn.perform_imap_fetch()
+    assert sorted(imapconn.movequeue.jobs) == [1, 2, 3, 4, 5]
+    monkeypatch.setattr(MoveQueue, "move_delay", 0.0)
+    yield imapconn
+    imapconn.conn.logout()
+
+
+def inbox_uids(imapconn):
+    """ the uids of the INBOX messages the store knows, moved ones have none """
+    return sorted(msg.uid for msg in imapconn.store.in_folder(INBOX))
+
+
+def test_batch_moves_all(mover, imap_server):
+    commands = []
+    imap_server.check_move = lambda foldername, uids: commands.append(sorted(uids))
+    mover.perform_imap_jobs()
+    assert commands == [[1, 2, 3, 4, 5]]
+    assert len(imap_server.folders[MVBOX].messages) == 5
+    assert not imap_server.folders[INBOX].messages
+    assert len(mover.movequeue) == 0
+    assert inbox_uids(mover) == []
+
+
+def test_batch_falls_back_to_single_moves(mover, imap_server):
+    """ a refused batch is moved one by one, the failing message is retried later """
+    commands = []
+
+    def check_move(foldername, uids):
+        commands.append(sorted(uids))
+        if 3 in uids:
+            return "NO [SERVERBUG] can't move 3"
+    imap_server.check_move = check_move
+    mover.perform_imap_jobs()
+    assert commands == [[1, 2, 3, 4, 5], [1], [2], [3], [4], [5]]
+    assert sorted(imap_server.folders[INBOX].messages) == [3]
+    assert list(mover.movequeue.jobs) == [3]
+    assert mover.movequeue.retries == {3: 1}
+    assert inbox_uids(mover) == [3]
+    # it waits for its retry
+    retry_at = mover.movequeue.retry_at[3]
+    assert mover.movequeue.batches(now=retry_at - 0.001) == []
+    assert mover.movequeue.batches(now=retry_at) == [[3]]
+
+
+def test_drop_messages_moved_by_another_client(mover, imap_server):
+    def check_move(foldername, uids):
+        if not uids.issubset(imap_server.folders[foldername].messages):
+            return "NO [EXPUNGEISSUED] some messages were expunged"
+    imap_server.check_move = check_move
+    imap_server.move(INBOX, [2, 4], MVBOX)
+    mover.perform_imap_jobs()
+    assert len(imap_server.folders[MVBOX].messages) == 5
+    # nothing is retried
+    assert len(mover.movequeue) == 0
+    assert mover.movequeue.retries == {}
+    assert inbox_uids(mover) == []
+
+
+def test_failed_backs_off_and_gives_up(tmpdir):
+    queue = MoveQueue(make_store(tmpdir), INBOX)
+    queue.add(MessageRecord("<m1@example.org>", "", "1.0", INBOX, 1,
+                            DC_CONSTANT_MSG_MOVESTATE_MOVING))
+    queue.add(MessageRecord("<m2@example.org>", "", "1.0", INBOX, 2,
+                            DC_CONSTANT_MSG_MOVESTATE_MOVING))
+    now = 1000.0
+    for retries in range(1, queue.max_retries):
+        assert not queue.failed(1, now=now)
+        assert queue.retries[1] == retries
+        # the backoff grows with the retries but stays below retry_max
+        delay = queue.retry_at[1] - now - queue.move_delay
+        assert 0 <= delay <= min((2 ** retries - 1) * queue.retry_constant, queue.retry_max)
+        assert queue.batches(now=now) == [[2]]
+        assert queue.batches(now=queue.retry_at[1]) == [[1, 2]]
+        now = queue.retry_at[1]
+    assert queue.failed(1, now=now)
+    assert queue.batches(now=now + queue.retry_max * 2) == [[2]]
+    assert 1 not in queue.retries and 1 not in queue.retry_at
@@ -0,0 +1,136 @@
+import os
+import pickle
+
+import pytest
+
+from persistentdict import JournaledDict, PersistentDict
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("db"))
+
+
+def test_persistentdict_formats(tmpdir):
+    for fmt in ("pickle", "json"):
+        path = str(tmpdir.join("db." + fmt))
+        with PersistentDict(path, format=fmt) as db:
+            db["a"] = {"x": 1}
+        db = PersistentDict(path, format=fmt)
+        assert dict(db) == {"a": {"x": 1}}
+        assert db.loaded_format == fmt
+        assert not os.path.exists(path + ".tmp")
+
+
+def test_journal_replay(path):
+    db = JournaledDict(path)
+    db["folder"] = {"last_sync_uid": 1}
+    db["gone"] = 1
+    db.sync()
+    db["folder"]["last_sync_uid"] = 2
+    db.touch("folder", "last_sync_uid")
+    db.setdefault("messages", {})["m1"] = "one"
+    db.touch("messages", "m1")
+    del db["gone"]
+    db.sync()
+    # nothing was compacted, everything comes from the journal
+    assert not os.path.exists(path)
+    db = JournaledDict(path)
+    assert dict(db) == {"folder": {"last_sync_uid": 2}, "messages": {"m1": "one"}}
+
+
+def test_untouched_changes_are_not_journaled(path):
+    db = JournaledDict(path)
+    db["folder"] = {"last_sync_uid": 1}
+    db.sync()
+    db["folder"]["last_sync_uid"] = 2
+    db.sync()
+    assert JournaledDict(path)["folder"] == {"last_sync_uid": 1}
+
+
+def test_subkey_delete(path):
+    db = JournaledDict(path)
+    db["messages"] = {"m1": 1, "m2": 2}
+    db.sync()
+    del db["messages"]["m1"]
+    db.touch("messages", "m1")
+    db.sync()
+    assert JournaledDict(path)["messages"] == {"m2": 2}
+
+
+@pytest.mark.parametrize("fmt", ["pickle", "snapshot"])
+def test_compaction(path, fmt):
+    db = JournaledDict(path, compact_min=2000, format=fmt)
+    messages = db.setdefault("values", {})
+    for i in range(200):
+        messages[i] = "value %d" % (i,)
+        db.touch("values", i)
+        db.sync()
+        # the journal never grows much beyond compact_min
+        assert os.path.getsize(db.journalname) < 4000
+    assert os.path.exists(path)
+    assert os.path.getsize(db.journalname) < os.path.getsize(path) + 2000
+    reopened = JournaledDict(path, format=fmt)
+    assert reopened.loaded_format == fmt
+    assert reopened["values"] == dict((i, "value %d" % (i,)) for i in range(200))
+
+
+def test_format_change_compacts(path):
+    db = JournaledDict(path)
+    db["a"] = 1
+    db.compact()
+    db = JournaledDict(path, format="snapshot")
+    assert db.loaded_format == "pickle"
+    db["b"] = 2
+    db.sync()
+    assert db.loaded_format == "snapshot"
+    assert os.path.getsize(db.journalname) == 0
+    db = JournaledDict(path, format="snapshot")
+    # a snapshot always has the messages of the mover
+    assert (db["a"], db["b"], len(db[":message-full"])) == (1, 2, 0)
+
+
+def test_torn_journal_tail(path):
+    """ a crash while appending leaves a partial record, which is dropped
+    so that later appends stay readable """
+    db = JournaledDict(path)
+    db["a"] = 1
+    db.sync()
+    size = os.path.getsize(db.journalname)
+    db["b"] = 2
+    db.sync()
+    full = os.path.getsize(db.journalname)
+    with open(db.journalname, "rb+") as f:
+        f.truncate(size + (full - size) // 2)
+    db = JournaledDict(path)
+    assert dict(db) == {"a": 1}
+    assert os.path.getsize(db.journalname) == size
+    db["c"] = 3
+    db.sync()
+    assert dict(JournaledDict(path)) == {"a": 1, "c": 3}
+
+
+def test_journal_after_compaction_crash(path):
+    """ records replayed onto a snapshot which already contains them
+    (a crash between writing the snapshot and truncating the journal) """
+    db = JournaledDict(path)
+    db["a"] = {"x": 1}
+    db.sync()
+    with open(db.journalname, "rb") as f:
+        journal = f.read()
+    db.compact()
+    with open(db.journalname, "wb") as f:
+        f.write(journal)
+    assert dict(JournaledDict(path)) == {"a": {"x": 1}}
+
+
+def test_new_flag_drops_journal(path):
+    db = JournaledDict(path)
+    db["a"] = 1
+    db.sync()
+    db = JournaledDict(path, flag="n")
+    assert dict(db) == {}
+    assert not os.path.exists(db.journalname)
+    with open(path + ".journal", "ab") as f:
+        pickle.dump(("set", "b", 2), f, 2)
+    assert dict(JournaledDict(path)) == {"b": 2}
@@ -0,0 +1,82 @@
+import asyncio
+import functools
+
+from asyncengine import AsyncImapConn
+from move_imap import INBOX
+from pollpolicy import PollPolicy
+from test_asyncengine import CONN_INFO, make_store, raw_message
+
+
+def make_policy(foreground=False):
+    policy = PollPolicy(foreground=foreground, can_idle=False, now=0.0)
+    policy.min_interval = 10.0
+    policy.max_interval = 80.0
+    policy.fg_max_interval = 40.0
+    policy.interval = policy.min_interval
+    # only the interval, not the arrival rate, is of interest here
+    policy.busy_rate = float("inf")
+    return policy
+
+
+def test_interval_doubles_up_to_max():
+    policy = make_policy()
+    intervals = []
+    now = 0.0
+    for _ in range(6):
+        now += policy.interval
+        policy.observe(now, 0)
+        intervals.append(policy.interval)
+    assert intervals == [20.0, 40.0, 80.0, 80.0, 80.0, 80.0]
+    assert policy.next_wakeup(now) == ("poll", 80.0)
+
+
+def test_arrival_resets_interval():
+    policy = make_policy()
+    for now in (10.0, 30.0, 70.0):
+        policy.observe(now, 0)
+    assert policy.interval == 80.0
+    policy.observe(80.0, 1)
+    assert policy.interval == 10.0
+    policy.observe(90.0, 0)
+    assert policy.interval == 20.0
+
+
+def test_foreground_caps_interval():
+    policy = make_policy()
+    for now in (10.0, 30.0, 70.0):
+        policy.observe(now, 0)
+    policy.set_foreground(True)
+    assert policy.interval == 40.0
+    policy.observe(110.0, 0)
+    assert policy.interval == 40.0
+
+
+def test_busy_rate_keeps_min_interval():
+    policy = PollPolicy(foreground=False, now=0.0)
+    policy.observe(0.0, 100)
+    policy.observe(policy.min_interval, 0)
+    assert policy.interval == policy.min_interval
+
+
+def test_asyncio_engine_backs_off(tmpdir, imap_server, monkeypatch):
+    """ idle fetch cycles of the asyncio engine let the policy back off """
+    monkeypatch.setattr(AsyncImapConn, "poll_policy",
+                        functools.partial(PollPolicy, foreground=False))
+    for i in range(3):
+        imap_server.append(INBOX, raw_message(i))
+
+    async def run():
+        imapconn = AsyncImapConn(make_store(tmpdir), INBOX, CONN_INFO)
+        await imapconn.connect()
+        intervals = []
+        try:
+            for _ in range(4):
+                await imapconn.perform_imap_fetch()
+                imapconn.next_wait()
+                intervals.append(imapconn.policy.interval)
+        finally:
+            await imapconn.conn.logout()
+        return intervals
+
+    intervals = asyncio.run(run())
+    assert intervals == [120.0, 240.0, 480.0, PollPolicy.max_interval]
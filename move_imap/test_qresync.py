@@ -0,0 +1,74 @@
+import threading
+
+import imapclient
+from imapclient import IMAPClient
+
+from messagestore import DC_CONSTANT_MSG_MOVESTATE_MOVING
+from move_imap import ImapConn, INBOX, idle_vanished, imapclient_private_ok, pop_untagged
+from test_asyncengine import CONN_INFO, make_store, raw_message
+
+
+def connect(store):
+    imapconn = ImapConn(store, INBOX, CONN_INFO)
+    imapconn.connect()
+    return imapconn
+
+
+def test_imapclient_private_parts(qresync_server):
+    """ the installed IMAPClient still has what fetch_range() and
+    pop_untagged() use """
+    assert imapclient_private_ok(imapclient.__version__)
+    assert not imapclient_private_ok("99.0.0")
+    assert not imapclient_private_ok("dev")
+    conn = IMAPClient("127.0.0.1", port=qresync_server.port, ssl=False)
+    conn.login("user", "password")
+    try:
+        assert isinstance(conn._imap.untagged_responses, dict)
+        conn.select_folder(INBOX)
+        conn.noop()
+        assert pop_untagged(conn, "VANISHED") == []
+    finally:
+        conn.logout()
+
+
+def test_idle_vanished():
+    responses = [(3, b"EXISTS"), (b"VANISHED", b"3:5,9"), (b"VANISHED", 7)]
+    assert idle_vanished(responses) == [b"3:5,9", b"7"]
+
+
+def test_reconnect_learns_vanished(tmpdir, qresync_server):
+    uids = [qresync_server.append(INBOX, raw_message(i)) for i in range(5)]
+    store = make_store(tmpdir)
+    imapconn = connect(store)
+    imapconn.perform_imap_fetch()
+    imapconn.conn.logout()
+    qresync_server.expunge(INBOX, uids[1])
+    imapconn = connect(store)
+    assert imapconn.qresync
+    try:
+        imapconn.perform_imap_fetch()
+    finally:
+        imapconn.conn.logout()
+    assert sorted(msg.uid for msg in store.in_folder(INBOX)) == [1, 3, 4, 5]
+
+
+def test_vanished_during_idle(tmpdir, qresync_server):
+    """ a message expunged during IDLE leaves the move queue """
+    uids = [qresync_server.append(INBOX, raw_message(i)) for i in range(2)]
+    store = make_store(tmpdir)
+    imapconn = connect(store)
+    try:
+        imapconn.perform_imap_fetch()
+        msg = store.in_folder(INBOX, [uids[0]])[0]
+        msg.move_state = DC_CONSTANT_MSG_MOVESTATE_MOVING
+        store.update(msg)
+        imapconn.movequeue.move_delay = 3600
+        imapconn.movequeue.add(msg)
+        timer = threading.Timer(0.2, qresync_server.expunge, (INBOX, uids[0]))
+        timer.start()
+        imapconn.perform_imap_idle(timeout=1.0)
+        timer.join()
+    finally:
+        imapconn.conn.logout()
+    assert len(imapconn.movequeue) == 0
+    assert store.get(msg.message_id).uid == 0
@@ -0,0 +1,193 @@
+import random
+
+import pytest
+
+from headers import parse_fields
+from messagestore import DictMessageStore, SqliteMessageStore
+from move_imap import ImapConn, INBOX, FETCH_HEADER_KEY
+from persistentdict import JournaledDict
+from threadindex import (
+    ThreadIndex, DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+    DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+PENDING = DC_CONSTANT_MSG_MOVESTATE_PENDING
+STAY = DC_CONSTANT_MSG_MOVESTATE_STAY
+MOVING = DC_CONSTANT_MSG_MOVESTATE_MOVING
+
+
+class Record(object):
+    def __init__(self, message_id, in_reply_to, dc, move_state=PENDING):
+        self.message_id = message_id
+        self.in_reply_to = in_reply_to
+        self.chat_version = "1.0" if dc else None
+        self.move_state = move_state
+
+
+def header(message_id, in_reply_to, dc):
+    lines = ["Message-ID: <%s>" % (message_id,)]
+    if in_reply_to:
+        lines.append("In-Reply-To: <%s>" % (in_reply_to,))
+    if dc:
+        lines.append("Chat-Version: 1.0")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("ascii")
+
+
+def random_threads(rng, num_threads, max_len):
+    """ return [[(message-id, in-reply-to, dc), ...], ...], parents first.
+
+    A thread's top replies to nothing or to a message which never arrives.
+    """
+    threads = []
+    for t in range(num_threads):
+        top_parent = "" if rng.random() < 0.5 else "lost%d@example.org" % (t,)
+        dc = rng.random() < 0.7
+        msgs = []
+        for i in range(rng.randint(1, max_len)):
+            message_id = "t%dm%d@example.org" % (t, i)
+            parent = top_parent if i == 0 else msgs[rng.randrange(i)][0]
+            msgs.append((message_id, parent, dc and rng.random() < 0.9))
+        threads.append(msgs)
+    return threads
+
+
+def arrival_order(rng, threads):
+    """ the messages of all threads, a thread's messages mostly in order """
+    timed = []
+    t0 = 0.0
+    for msgs in threads:
+        t0 += rng.expovariate(1.0 / 600)
+        for i, msg in enumerate(msgs):
+            timed.append((t0 + 60 * i + rng.uniform(-300, 300), msg))
+    timed.sort(key=lambda item: item[0])
+    return [(max(t, 0.0), msg) for t, msg in timed]
+
+
+class Mover(object):
+    """ an INBOX ImapConn fed with header fetches, without a connection """
+
+    def __init__(self, make_store):
+        self.make_store = make_store
+        self.open()
+
+    def open(self):
+        self.store = self.make_store()
+        self.conn = ImapConn(self.store, INBOX, ("localhost", "user", "password"))
+        self.conn.verbose = False
+
+    def reopen(self):
+        self.store.sync()
+        self.store.close()
+        self.open()
+
+    def fetched(self, uid, message_id, in_reply_to, dc, now):
+        data = {FETCH_HEADER_KEY: header(message_id, in_reply_to, dc), b"RFC822.SIZE": 100}
+        self.conn.process_fetched_message(uid, data, now)
+
+    def finish_moves(self):
+        """ the queued moves went through, the messages are gone from INBOX """
+        queue = self.conn.movequeue
+        for msg in self.store.moving_in_folder(INBOX):
+            msg.uid = 0
+            self.store.update(msg)
+        queue.discard()
+
+    def state(self, message_id):
+        msg = self.store.get(message_id)
+        return None if msg is None else msg.move_state
+
+
+def make_dict_store(tmpdir):
+    return lambda: DictMessageStore(JournaledDict(str(tmpdir.join("moves.db"))))
+
+
+def make_snapshot_store(tmpdir):
+    # compacting often rebases the records on the new snapshot
+    return lambda: DictMessageStore(JournaledDict(str(tmpdir.join("moves.db")),
+                                                  format="snapshot", compact_min=1000))
+
+
+def make_sqlite_store(tmpdir):
+    return lambda: SqliteMessageStore(str(tmpdir.join("moves.sqlite")))
+
+
+@pytest.mark.parametrize("make_store", [make_dict_store, make_snapshot_store,
+                                        make_sqlite_store])
+@pytest.mark.parametrize("seed", range(5))
+def test_eviction_keeps_resolution(tmpdir, make_store, seed):
+    """ a store which evicts threads and gets reloaded resolves every
+    message like one which keeps everything """
+    rng = random.Random(seed)
+    threads = random_threads(rng, num_threads=60, max_len=8)
+    reference = Mover(make_store(tmpdir.mkdir("reference")))
+    evicting = Mover(make_store(tmpdir.mkdir("evicting")))
+    evicted = 0
+    for uid, (now, (message_id, in_reply_to, dc)) in enumerate(
+            arrival_order(rng, threads), 1):
+        for mover in (reference, evicting):
+            mover.fetched(uid, message_id, in_reply_to, dc, now)
+        message_id = parse_fields(header(message_id, in_reply_to, dc))[0]
+        assert evicting.state(message_id) == reference.state(message_id)
+        if rng.random() < 0.2:
+            for mover in (reference, evicting):
+                mover.finish_moves()
+        if rng.random() < 0.1:
+            retention = evicting.store.retention
+            retention.max_age = rng.choice([60, 600, 3600])
+            retention.stub_max_age = rng.choice([600, 36000])
+            retention.max_messages = rng.choice([0, 20])
+            evicted += retention.run(now)[0]
+        if rng.random() < 0.05:
+            evicting.reopen()
+        elif rng.random() < 0.05:
+            # a snapshot store continues on the compacted file
+            evicting.store.sync()
+    assert evicted > 0
+    for msg in reference.store.records():
+        state = evicting.state(msg.message_id)
+        assert state is None or state == msg.move_state
+    for msg in evicting.store.records():
+        # pending messages and queued moves are never evicted
+        assert reference.state(msg.message_id) == msg.move_state
+
+
+def chain(index, ids, top_parent="", dc=True):
+    parent = top_parent
+    for message_id in ids:
+        index.add(Record(message_id, parent, dc, STAY if dc else PENDING))
+        parent = message_id
+
+
+def test_collapse_keeps_replies_resolving():
+    index, full = ThreadIndex(), ThreadIndex()
+    for i in (index, full):
+        # an incomplete chain of four Delta messages lets replies move
+        chain(i, ["a", "b", "c", "d"], top_parent="missing")
+        i.add(Record("e", "d", False))
+    assert index.next_move_state("e") == MOVING
+    stubs = index.collapse(["a", "b", "c", "d", "e"])
+    assert stubs["d"] == ("missing", stubs["d"][1])
+    assert stubs["d"][1].dc_run == 4
+    for i in (index, full):
+        i.add(Record("f", "e", False))
+    assert index.next_move_state("f") == full.next_move_state("f") == MOVING
+    # a late thread start adopts the stubs, and being no Delta message
+    # it decides against moving
+    for i in (index, full):
+        i.add(Record("missing", "", False))
+        i.add(Record("g", "b", False))
+    assert index.next_move_state("g") == full.next_move_state("g") == STAY
+
+
+def test_drop_only_unlinked_stubs():
+    index = ThreadIndex()
+    chain(index, ["a", "b"], dc=False)
+    index.collapse(["a", "b"])
+    index.add(Record("c", "b", False))
+    # "b" has a reply, "a" is only its parent
+    assert not index.drop("b")
+    assert index.drop("a")
+    assert "a" not in index
+    assert index.next_move_state("c") == STAY
+    # not a stub
+    assert not index.drop("c")
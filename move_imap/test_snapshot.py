@@ -0,0 +1,217 @@
+import random
+
+import pytest
+
+import snapshot
+from messagestore import DictMessageStore, MessageRecord
+from persistentdict import JournaledDict
+from snapshot import MESSAGES, THREAD_STUBS, SnapshotRecords
+from threadindex import (
+    ThreadIndex, Segment, DC_CONSTANT_MSG_MOVESTATE_PENDING, DC_CONSTANT_MSG_MOVESTATE_STAY,
+    DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+PENDING = DC_CONSTANT_MSG_MOVESTATE_PENDING
+STAY = DC_CONSTANT_MSG_MOVESTATE_STAY
+MOVING = DC_CONSTANT_MSG_MOVESTATE_MOVING
+
+
+def random_db(rng, num_messages=200):
+    """ a mover's database: messages, a few thread stubs and folder values """
+    stubs = {}
+    for i in range(5):
+        stubs["<s%d@example.org>" % (i,)] = (
+            "" if i == 0 else "<s%d@example.org>" % (i - 1,), True, i + 1, i == 3, 100.0)
+    messages = {}
+    parents = [""] + list(stubs)
+    for i in range(num_messages):
+        # a non-ascii message-id makes the string table not ascii
+        local = "m%d" % (i,) if i != 7 else "m\xfc%d" % (i,)
+        move_state = rng.choice([PENDING, STAY, MOVING])
+        msg = MessageRecord("<%s@example.org>" % (local,), rng.choice(parents),
+                            "1.0" if rng.random() < 0.7 else None,
+                            rng.choice(["INBOX", "Sent", "DeltaChat"]),
+                            rng.choice([0, rng.randint(1, 1000)]), move_state,
+                            float(rng.randint(0, 10 ** 6)))
+        messages[msg.message_id] = msg
+        parents.append(msg.message_id)
+    return {MESSAGES: messages, THREAD_STUBS: stubs, "INBOX": {"last_sync_uid": 17}}
+
+
+def write(db, path):
+    with open(path, "wb") as fileobj:
+        snapshot.dump(db, fileobj)
+
+
+def write_v1(db, path):
+    """ write db as a MVSNAP01 file, which has no links section """
+    write(db, path)
+    with open(path, "rb") as fileobj:
+        data = fileobj.read()
+    (magic, num_strings, num_records, num_active, offsets_pos, data_pos, records_pos,
+     active_pos, rest_pos, links_pos) = snapshot.HEADER.unpack_from(data, 0)
+    # the sections start earlier after the smaller header, and the ones
+    # after the links even earlier
+    shift = snapshot.HEADER.size - snapshot.HEADER_V1.size
+    links = active_pos - links_pos
+    header = snapshot.HEADER_V1.pack(
+        snapshot.MAGIC_V1, num_strings, num_records, num_active, offsets_pos - shift,
+        data_pos - shift, records_pos - shift, active_pos - links - shift,
+        rest_pos - links - shift)
+    with open(path, "wb") as fileobj:
+        fileobj.write(header + data[snapshot.HEADER.size:links_pos] + data[active_pos:])
+
+
+def stub_list(stubs):
+    return [(message_id, stub[0], Segment(*stub[1:4])) for message_id, stub in stubs.items()]
+
+
+def resolutions(index, message_ids):
+    return dict((message_id, index.next_move_state(message_id)) for message_id in message_ids)
+
+
+@pytest.fixture
+def db():
+    return random_db(random.Random(1))
+
+
+@pytest.mark.parametrize("writer", [write, write_v1])
+def test_round_trip(tmpdir, db, writer):
+    path = str(tmpdir.join("db.snap"))
+    writer(db, path)
+    with open(path, "rb") as fileobj:
+        assert snapshot.is_snapshot(fileobj)
+    loaded = snapshot.load(path)
+    messages = loaded.pop(MESSAGES)
+    assert isinstance(messages, SnapshotRecords)
+    assert loaded == dict((key, value) for key, value in db.items() if key != MESSAGES)
+    assert len(messages) == len(db[MESSAGES])
+    assert dict(messages.items()) == db[MESSAGES]
+    assert sorted(messages) == sorted(db[MESSAGES])
+
+
+def test_lazy_access(tmpdir, db):
+    path = str(tmpdir.join("db.snap"))
+    write(db, path)
+    messages = snapshot.load(path)[MESSAGES]
+    # only the pending and queued messages are created on loading
+    active = [msg for msg in db[MESSAGES].values() if snapshot.is_active(msg.move_state, msg.uid)]
+    assert sorted(messages.overlay) == sorted(msg.message_id for msg in active)
+    stay = next(msg for msg in db[MESSAGES].values() if msg.move_state == STAY)
+    assert stay.message_id not in messages.overlay
+    assert messages.get(stay.message_id) == stay
+    # and is kept from now on
+    assert messages.get(stay.message_id) is messages.overlay[stay.message_id]
+    assert messages.get("unknown@example.org") is None
+    assert "unknown@example.org" not in messages
+    with pytest.raises(KeyError):
+        messages["unknown@example.org"]
+
+    # deleting a row hides it without touching the file
+    gone = next(message_id for message_id in db[MESSAGES] if message_id not in messages.overlay)
+    del messages[gone]
+    assert gone not in messages
+    assert messages.get(gone) is None
+    assert len(messages) == len(db[MESSAGES]) - 1
+    new = MessageRecord("<new@example.org>", "", None, "INBOX", 5)
+    messages[new.message_id] = new
+    assert len(messages) == len(db[MESSAGES])
+    expected = dict(db[MESSAGES])
+    del expected[gone]
+    expected[new.message_id] = new
+    assert dict(messages.items()) == expected
+
+
+@pytest.mark.parametrize("writer", [write, write_v1])
+def test_thread_index(tmpdir, db, writer):
+    """ the index restored from the links (or linked anew from an old
+    file) resolves like one built from the records """
+    path = str(tmpdir.join("db.snap"))
+    writer(db, path)
+    messages = snapshot.load(path)[MESSAGES]
+    assert (messages.snapshot.links() is None) == (writer is write_v1)
+    stubs = stub_list(db[THREAD_STUBS])
+    # changed since the snapshot
+    changed = messages.get(next(message_id for message_id, msg in db[MESSAGES].items()
+                                if msg.move_state == PENDING))
+    changed.move_state = MOVING
+    messages.keep(changed)
+    reply = MessageRecord("<reply@example.org>", changed.message_id, None,
+                          "INBOX", 1000)
+    messages[reply.message_id] = reply
+    expected = dict(db[MESSAGES])
+    expected[changed.message_id] = changed
+    expected[reply.message_id] = reply
+    reference = ThreadIndex(expected.values(), stubs)
+    index = messages.thread_index(stubs)
+    assert len(index) == len(reference)
+    ids = list(expected) + list(db[THREAD_STUBS])
+    assert resolutions(index, ids) == resolutions(reference, ids)
+    assert index.next_move_state(reply.message_id) == MOVING
+
+
+def test_rebase(tmpdir, db):
+    path = str(tmpdir.join("db.snap"))
+    write(db, path)
+    loaded = snapshot.load(path)
+    messages = loaded[MESSAGES]
+    stay = [message_id for message_id, msg in db[MESSAGES].items() if msg.move_state == STAY]
+    changed = messages.get(stay[0])
+    changed.uid = 4711
+    messages.keep(changed)
+    messages.get(stay[1])
+    del messages[stay[2]]
+    new = MessageRecord("<new@example.org>", "", None, "INBOX", 5, STAY)
+    messages[new.message_id] = new
+    write(loaded, str(tmpdir.join("db2.snap")))
+    # a change after the snapshot was written
+    late = messages.get(stay[3])
+    late.uid = 4712
+    messages.keep(late)
+    expected = dict(messages.items())
+
+    snapshot.reopen(loaded, str(tmpdir.join("db2.snap")))
+    assert dict(messages.items()) == expected
+    assert len(messages) == len(expected)
+    assert stay[2] not in messages
+    # the new snapshot has the records which were only in the overlay
+    assert stay[1] not in messages.overlay
+    assert changed.message_id not in messages.overlay
+    assert new.message_id not in messages.overlay
+    assert messages.overlay[late.message_id].uid == 4712
+    assert not messages.deleted
+
+
+def test_migrate_pickle(tmpdir):
+    """ a store in an old pickle file continues in snapshot format """
+    path = str(tmpdir.join("moves.db"))
+    records = random_db(random.Random(2))[MESSAGES]
+    store = DictMessageStore(JournaledDict(path))
+    for msg in records.values():
+        store.add(msg)
+    store.set_folder_value("INBOX", "last_sync_uid", 17)
+    top = next(message_id for message_id, msg in records.items()
+               if msg.in_reply_to == "" and msg.move_state == STAY)
+    store.evict({top: ("", Segment(True, 1, False), 5.0)})
+    del records[top]
+    store.db.compact()
+    store.close()
+
+    db = JournaledDict(path, format="snapshot")
+    assert db.loaded_format == "pickle"
+    store = DictMessageStore(db)
+    store.set_folder_value("INBOX", "last_sync_uid", 18)
+    store.sync()
+    assert db.loaded_format == "snapshot"
+    store.close()
+
+    db = JournaledDict(path, format="snapshot")
+    assert db.loaded_format == "snapshot"
+    store = DictMessageStore(db)
+    assert store.lazy
+    assert store.get_folder_value("INBOX", "last_sync_uid") == 18
+    assert dict((msg.message_id, msg) for msg in store.records()) == records
+    assert [message_id for message_id, stub in store.stubs()] == [top]
+    reference = ThreadIndex(records.values(), [(top, "", Segment(True, 1, False))])
+    ids = list(records) + [top]
+    assert resolutions(store.threads, ids) == resolutions(reference, ids)
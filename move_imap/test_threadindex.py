@@ -0,0 +1,127 @@
+import random
+
+import pytest
+
+from threadindex import (
+    ThreadIndex, MIN_DC_CHAIN, DC_CONSTANT_MSG_MOVESTATE_PENDING,
+    DC_CONSTANT_MSG_MOVESTATE_STAY, DC_CONSTANT_MSG_MOVESTATE_MOVING,
+)
+
+PENDING = DC_CONSTANT_MSG_MOVESTATE_PENDING
+STAY = DC_CONSTANT_MSG_MOVESTATE_STAY
+MOVING = DC_CONSTANT_MSG_MOVESTATE_MOVING
+
+
+class Record(object):
+    def __init__(self, message_id, in_reply_to, dc, move_state=PENDING):
+        self.message_id = message_id
+        self.in_reply_to = in_reply_to
+        self.chat_version = "1.0" if dc else None
+        self.move_state = move_state
+
+
+def walk_next_move_state(records, message_id):
+    """ the In-Reply-To walk which determine_next_move_state used to do """
+    msg = records[message_id]
+    last_dc_count = 0
+    while 1:
+        last_dc_count = (last_dc_count + 1) if msg.chat_version else 0
+        if not msg.in_reply_to:
+            return MOVING if last_dc_count > 0 else STAY
+        parent = records.get(msg.in_reply_to)
+        if parent is None:
+            return MOVING if last_dc_count >= MIN_DC_CHAIN else PENDING
+        if parent.move_state == MOVING:
+            return MOVING
+        msg = parent
+
+
+def random_messages(rng, count):
+    """ return [(message-id, in-reply-to, dc)], parents before their replies.
+
+    Some messages reply to nothing, some to messages which never arrive,
+    and long Delta chains are likely.
+    """
+    msgs = []
+    for i in range(count):
+        r = rng.random()
+        if not msgs or r < 0.1:
+            parent = ""
+        elif r < 0.2:
+            parent = "lost%d@example.org" % (i,)
+        elif r < 0.6:
+            # mostly continue a recent message, which makes long chains
+            parent = msgs[max(0, len(msgs) - rng.randint(1, 3))][0]
+        else:
+            parent = rng.choice(msgs)[0]
+        msgs.append(("m%d@example.org" % (i,), parent, rng.random() < 0.8))
+    return msgs
+
+
+def check_all(index, records):
+    for message_id, record in records.items():
+        if record.move_state != MOVING:
+            assert index.next_move_state(message_id) == \
+                walk_next_move_state(records, message_id), message_id
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_index_matches_walk(seed):
+    """ replies arriving before their parents, parents merging waiting
+    sub-trees and messages becoming moved resolve like the walk """
+    rng = random.Random(seed)
+    msgs = random_messages(rng, 150)
+    # out of order: many replies arrive before their parents
+    order = list(msgs)
+    for i in range(len(order)):
+        j = min(len(order) - 1, i + rng.randint(0, 20))
+        order[i], order[j] = order[j], order[i]
+    index = ThreadIndex()
+    records = {}
+    for message_id, in_reply_to, dc in order:
+        record = Record(message_id, in_reply_to, dc)
+        records[message_id] = record
+        index.add(record)
+        for other in rng.sample(list(records.values()), min(3, len(records))):
+            # a moved message stays moved for the index, the walk only
+            # agrees as long as it isn't seen as STAY afterwards
+            if other.move_state == PENDING:
+                other.move_state = rng.choice([PENDING, STAY, MOVING])
+                index.update(other)
+        check_all(index, records)
+    # and an index built from all records at once
+    check_all(ThreadIndex(records.values()), records)
+
+
+def test_merge_waiting_subtrees():
+    index = ThreadIndex()
+    records = {}
+
+    def add(message_id, in_reply_to, dc=True):
+        records[message_id] = Record(message_id, in_reply_to, dc)
+        index.add(records[message_id])
+
+    # two sub-trees wait for "b", which waits for "a"
+    add("c", "b")
+    add("d", "c")
+    add("x", "b")
+    add("y", "x", dc=False)
+    assert index.next_move_state("d") == PENDING
+    add("b", "a")
+    # three Delta messages on top of the incomplete chain aren't enough
+    assert index.next_move_state("d") == PENDING
+    add("a", "top")
+    assert index.next_move_state("d") == MOVING
+    # only a, b and x are on top of "y"
+    assert index.next_move_state("y") == PENDING
+    check_all(index, records)
+    # a clear thread start decides against moving for all of them
+    add("top", "", dc=False)
+    assert index.next_move_state("d") == STAY
+    check_all(index, records)
+    # until a message in between was moved
+    records["x"].move_state = MOVING
+    index.update(records["x"])
+    assert index.next_move_state("y") == MOVING
+    assert index.next_move_state("d") == STAY
+    check_all(index, records)
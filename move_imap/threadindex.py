@@ -0,0 +1,326 @@
+"""
+In-Reply-To thread index for the move engine.
+
+The next move state of a pending message depends on the chain of its
+ancestors: it moves if an ancestor was moved, if the thread-start message
+is a Delta message, or -- while the chain is still incomplete -- if the
+topmost four known messages are Delta messages.  Walking that chain for
+every message (and again for all waiting messages when a parent arrives)
+is quadratic on long threads.
+
+ThreadIndex keeps the known messages in a union-find forest over their
+In-Reply-To links.  Every link caches an aggregate of the chain segment it
+skips (is every message in it a Delta message, how long is the run of
+Delta messages from its top, was any message in it moved), so with path
+compression the aggregate from the topmost known ancestor down to a
+message is available in near constant time.  Arriving parents merge the
+waiting sub-trees below them.  Messages becoming moved invalidate the
+compressed links of their component, which are then lazily rebuilt.
+
+Threads which are evicted from the message store (see retention.py) are
+collapsed into stubs: every message of the thread keeps only the
+aggregate of its chain from the thread's top down to itself and the
+In-Reply-To of that top.  A stub is a component of its own which behaves
+like the whole chain above it, so replies to evicted messages are still
+resolved as before.
+"""
+
+import threading
+from collections import deque, namedtuple
+
+DC_CONSTANT_MSG_MOVESTATE_PENDING = 1
+DC_CONSTANT_MSG_MOVESTATE_STAY = 2
+DC_CONSTANT_MSG_MOVESTATE_MOVING = 3
+
+# number of Delta messages on top of an incomplete chain which let us move
+MIN_DC_CHAIN = 4
+
+
+class Segment(namedtuple("Segment", "all_dc dc_run moved")):
+    """ aggregate of a chain of messages, read from top to bottom """
+
+    def __add__(self, lower):
+        return Segment(self.all_dc and lower.all_dc,
+                       self.dc_run + lower.dc_run if self.all_dc else self.dc_run,
+                       self.moved or lower.moved)
+
+
+EMPTY = Segment(True, 0, False)
+
+
+class Node(object):
+    __slots__ = ("parent_id", "dc", "move_state", "moved", "link", "segment", "stamp",
+                 "summary")
+
+    def __init__(self, parent_id, dc, move_state, summary=None):
+        self.parent_id = parent_id
+        self.dc = dc
+        self.move_state = move_state
+        # moved stays set when a moved message is later seen as STAY in the mvbox
+        self.moved = move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING
+        # union-find link to an ancestor (None for the top of a component)
+        # and the aggregate of the chain below that ancestor down to us
+        self.link = None
+        self.segment = None
+        self.stamp = 0
+        # for stubs: the Segment of the collapsed chain down to us
+        self.summary = summary
+
+    def value(self):
+        if self.summary is not None:
+            return self.summary._replace(moved=self.summary.moved or self.moved)
+        return Segment(self.dc, 1 if self.dc else 0, self.moved)
+
+
+class ThreadIndex(object):
+    def __init__(self, records=(), stubs=()):
+        self._lock = threading.RLock()
+        self.nodes = {}
+        self.children = {}   # parent message-id (known or not) -> [message-id]
+        self._clock = 0
+        self._moved_stamp = {}   # component top -> clock of last move inside
+        # stubs share the few distinct summaries
+        self._summaries = {}
+        for message_id, parent_id, summary in stubs:
+            self.add_stub(message_id, parent_id, summary)
+        for record in records:
+            self.add(record)
+
+    def __contains__(self, message_id):
+        return message_id in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, record):
+        with self._lock:
+            message_id = record.message_id
+            if message_id in self.nodes:
+                return self.update(record)
+            self._insert(message_id, Node(record.in_reply_to, bool(record.chat_version),
+                                          record.move_state))
+
+    def add_stub(self, message_id, parent_id, summary):
+        """ add an evicted message, see collapse() """
+        with self._lock:
+            summary = self._summaries.setdefault(summary, summary)
+            self._insert(message_id, Node(parent_id, summary.dc_run > 0,
+                                          DC_CONSTANT_MSG_MOVESTATE_STAY, summary))
+
+    def _insert(self, message_id, node):
+        self.nodes[message_id] = node
+        if node.parent_id and node.parent_id != message_id:
+            self.children.setdefault(node.parent_id, []).append(message_id)
+            if node.parent_id in self.nodes:
+                self._link(message_id, node.parent_id)
+        # adopt the components which waited for us
+        for child_id in self.children.get(message_id, ()):
+            # an In-Reply-To cycle leaves the child unlinked (and pending)
+            if self._find_top(message_id) != child_id:
+                self._link(child_id, message_id)
+        if node.moved:
+            self._mark_moved(message_id)
+
+    @classmethod
+    def from_links(cls, rows, stubs=(), records=()):
+        """ build the index from the links which link() returned for every
+        message of a previous index, without linking the messages anew.
+
+        rows are (message-id, parent-id, dc, move state, top message-id,
+        Segment) and records the messages added or changed since.
+        """
+        index = cls(stubs=stubs)
+        nodes = index.nodes
+        children = index.children
+        segments = {}
+        linked = []
+        changed = []
+        for message_id, parent_id, dc, move_state, top_id, segment in rows:
+            if message_id in nodes:
+                # also a stub, as add() would have done
+                changed.append((message_id, move_state))
+                continue
+            node = nodes[message_id] = Node(parent_id, dc, move_state)
+            if parent_id and parent_id != message_id:
+                children.setdefault(parent_id, []).append(message_id)
+            if top_id != message_id:
+                linked.append((node, top_id, segments.setdefault(segment, segment)))
+        for node, top_id, segment in linked:
+            if top_id in nodes:
+                node.link = top_id
+                node.segment = segment
+        with index._lock:
+            for message_id, node in list(nodes.items()):
+                if node.link is None and node.parent_id in nodes:
+                    # the stubs and messages whose top is gone
+                    if index._find_top(node.parent_id) != message_id:
+                        index._link(message_id, node.parent_id)
+            for message_id, move_state in changed:
+                index._set_move_state(message_id, nodes[message_id], move_state)
+            for record in records:
+                index.add(record)
+        return index
+
+    def link(self, message_id):
+        """ return (top message-id, Segment below the top down to message_id)
+        for storing the index, see from_links() """
+        with self._lock:
+            top_id = self._find(message_id)[0]
+            if top_id == message_id:
+                return top_id, EMPTY
+            return top_id, self.nodes[message_id].segment
+
+    def update(self, record):
+        with self._lock:
+            node = self.nodes.get(record.message_id)
+            if node is None:
+                return self.add(record)
+            self._set_move_state(record.message_id, node, record.move_state)
+
+    def _set_move_state(self, message_id, node, move_state):
+        node.move_state = move_state
+        if move_state == DC_CONSTANT_MSG_MOVESTATE_MOVING and not node.moved:
+            node.moved = True
+            self._mark_moved(message_id)
+
+    def components(self):
+        """ return {top message-id: [message-ids of its component]} """
+        with self._lock:
+            components = {}
+            for message_id in list(self.nodes):
+                components.setdefault(self._find(message_id)[0], []).append(message_id)
+            return components
+
+    def collapse(self, message_ids):
+        """ turn the given messages (whole components) into stubs and return
+        {message-id: (parent-id, Segment)} for storing them """
+        with self._lock:
+            stubs = {}
+            for message_id in message_ids:
+                top_id, summary = self._find(message_id)
+                parent_id = self.nodes[top_id].parent_id
+                if parent_id in self.nodes:
+                    # an In-Reply-To cycle, keep the stub unlinked like its top
+                    parent_id = message_id
+                stubs[message_id] = (parent_id, self._summaries.setdefault(summary, summary))
+            for message_id, (parent_id, summary) in stubs.items():
+                node = self.nodes[message_id]
+                self._unlist_child(message_id, node.parent_id)
+                self._moved_stamp.pop(message_id, None)
+                node.parent_id = parent_id
+                node.dc = summary.dc_run > 0
+                node.moved = summary.moved
+                node.summary = summary
+                node.link = node.segment = None
+                node.stamp = 0
+                if parent_id and parent_id != message_id:
+                    self.children.setdefault(parent_id, []).append(message_id)
+            return stubs
+
+    def drop(self, message_id):
+        """ forget a stub nobody links to, return False if it is still needed """
+        with self._lock:
+            node = self.nodes.get(message_id)
+            if (node is None or node.summary is None or node.link is not None or
+                    self.children.get(message_id)):
+                return False
+            del self.nodes[message_id]
+            self._unlist_child(message_id, node.parent_id)
+            self._moved_stamp.pop(message_id, None)
+            return True
+
+    def _unlist_child(self, message_id, parent_id):
+        siblings = self.children.get(parent_id)
+        if siblings and message_id in siblings:
+            siblings.remove(message_id)
+            if not siblings:
+                del self.children[parent_id]
+
+    def _link(self, message_id, parent_id):
+        node = self.nodes[message_id]
+        parent_top = self._find_top(parent_id)
+        node.link = parent_id
+        node.segment = node.value()
+        node.stamp = self._clock
+        stamp = self._moved_stamp.pop(message_id, 0)
+        if stamp > self._moved_stamp.get(parent_top, 0):
+            self._moved_stamp[parent_top] = stamp
+
+    def _mark_moved(self, message_id):
+        self._clock += 1
+        self._moved_stamp[self._find_top(message_id)] = self._clock
+
+    def _find_top(self, message_id):
+        while True:
+            link = self.nodes[message_id].link
+            if link is None:
+                return message_id
+            message_id = link
+
+    def _find(self, message_id):
+        """ return (top message-id, Segment from top down to message_id) """
+        top = self._find_top(message_id)
+        valid_since = self._moved_stamp.get(top, 0)
+        path = []
+        current = message_id
+        while current != top:
+            node = self.nodes[current]
+            if node.stamp < valid_since and not node.segment.moved:
+                # something in the skipped segment may have been moved since
+                node.link = node.parent_id
+                node.segment = node.value()
+            path.append(node)
+            current = node.link
+        segment = EMPTY
+        for node in reversed(path):
+            segment = segment + node.segment
+            node.link = top
+            node.segment = segment
+            node.stamp = self._clock
+        return top, self.nodes[top].value() + segment
+
+    def next_move_state(self, message_id):
+        """ Return the next move state for a pending message by looking at its ancestors. """
+        with self._lock:
+            top_id, segment = self._find(message_id)
+            top = self.nodes[top_id]
+            if segment.moved:
+                return DC_CONSTANT_MSG_MOVESTATE_MOVING
+            if not top.parent_id:
+                # the thread-start message decides
+                if top.dc:
+                    return DC_CONSTANT_MSG_MOVESTATE_MOVING
+                return DC_CONSTANT_MSG_MOVESTATE_STAY
+            # we don't have the parent message ... maybe because
+            # it hasn't arrived (yet), was deleted or we failed to
+            # scan/fetch it
+            if segment.dc_run >= MIN_DC_CHAIN:
+                return DC_CONSTANT_MSG_MOVESTATE_MOVING
+            return DC_CONSTANT_MSG_MOVESTATE_PENDING
+
+    def pending_descendants(self, message_id):
+        """ yield the message-ids of pending messages below message_id, top-down.
+
+        The caller is expected to resolve (and update()) each yielded
+        message before continuing the iteration.  Below messages which
+        remain pending we only look MIN_DC_CHAIN - 1 levels deep: further
+        down their state can't have changed.
+        """
+        todo = deque((child_id, 1) for child_id in self._children(message_id))
+        while todo:
+            child_id, depth = todo.popleft()
+            node = self.nodes.get(child_id)
+            if node is None:
+                continue
+            if node.move_state == DC_CONSTANT_MSG_MOVESTATE_PENDING:
+                yield child_id
+                resolved = node.move_state != DC_CONSTANT_MSG_MOVESTATE_PENDING
+            else:
+                resolved = False
+            if resolved or depth < MIN_DC_CHAIN - 1:
+                todo.extend((grandchild_id, depth + 1)
+                            for grandchild_id in self._children(child_id))
+
+    def _children(self, message_id):
+        with self._lock:
+            return list(self.children.get(message_id, ()))